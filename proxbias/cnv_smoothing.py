@@ -0,0 +1,239 @@
+import concurrent.futures as cf
+import os
+import re
+from typing import TYPE_CHECKING, List, Optional, Sequence, Tuple
+
+import numpy as np
+import pandas as pd
+import scipy.sparse
+
+if TYPE_CHECKING:
+    from anndata import AnnData
+
+
+def _natural_sort(chromosomes: Sequence[str]) -> List[str]:
+    """
+    Sort chromosome names so that numbers are compared numerically (chr2 < chr10), matching infercnvpy's ordering.
+
+    Args:
+        chromosomes (Sequence[str]): Chromosome names to sort.
+
+    Returns:
+        List[str]: The naturally sorted chromosome names.
+    """
+
+    def _key(name: str) -> list:
+        return [int(tok) if tok.isdigit() else tok.lower() for tok in re.split("([0-9]+)", name)]
+
+    return sorted(chromosomes, key=_key)
+
+
+def _pyramid_box_sizes(window_size: int) -> Tuple[int, int]:
+    """
+    Decompose the pyramid filter `min(r, r[::-1])` of length `window_size` into two box filters whose convolution
+    reproduces it. Two successive moving sums with these widths then equal a pyramid-weighted moving sum.
+
+    Args:
+        window_size (int): Length of the pyramid filter.
+
+    Returns:
+        Tuple[int, int]: Widths of the two box filters. Their product is the sum of the pyramid weights.
+    """
+    first = (window_size + 1) // 2
+    return first, window_size + 1 - first
+
+
+CONVOLUTION_MODES = ("same", "valid")
+
+
+def _running_mean(x: np.ndarray, window_size: int, step: int, mode: str = "same") -> np.ndarray:
+    """
+    Pyramid-weighted running mean of the rows of `x`, equivalent to `np.convolve(row, pyramid, mode=mode)` sampled
+    every `step` columns, computed from cumulative sums in O(cells x genes) instead of O(cells x genes x window).
+    "same" windows are centered on every gene, zero-padded at the chromosome ends, as in infercnvpy < 0.5.
+    "valid" windows lie within the chromosome, as in infercnvpy >= 0.5.
+
+    Args:
+        x (np.ndarray): Dense cells x genes matrix for a single chromosome, genes in genomic order.
+        window_size (int): Length of the running window.
+        step (int): Only return every `step`-th window.
+        mode (str, optional): Convolution mode, "same" or "valid". Default is "same".
+
+    Returns:
+        np.ndarray: Smoothed cells x windows matrix.
+    """
+    n_cells, n_genes = x.shape
+    if window_size >= n_genes:
+        # Fewer genes than the window: a single mean over the whole chromosome, pyramid-weighted in "same" mode
+        if mode == "valid":
+            return x.mean(axis=1, keepdims=True)
+        r = np.arange(1, n_genes + 1)
+        pyramid = np.minimum(r, r[::-1])
+        return (x @ pyramid.reshape(-1, 1)) / pyramid.sum()
+
+    box_a, box_b = _pyramid_box_sizes(window_size)
+    csum = np.zeros((n_cells, n_genes + 1), dtype=np.float64)
+    np.cumsum(x, axis=1, out=csum[:, 1:])
+    # Full convolution positions k = 0..n_genes + window_size - 2 correspond to zero-padded windows ending at k
+    first_pos = np.arange(n_genes + 2 * window_size - 1 - box_a) - (window_size - 1)
+    box_a_sums = csum[:, np.clip(first_pos + box_a, 0, n_genes)] - csum[:, np.clip(first_pos, 0, n_genes)]
+    box_a_csum = np.zeros((n_cells, box_a_sums.shape[1] + 1), dtype=np.float64)
+    np.cumsum(box_a_sums, axis=1, out=box_a_csum[:, 1:])
+    # "same" mode keeps full convolution positions starting at (window_size - 1) // 2, "valid" mode the positions of
+    # windows without padding, starting at window_size - 1
+    if mode == "valid":
+        keep = window_size - 1 + np.arange(0, n_genes - window_size + 1, step)
+    else:
+        keep = (window_size - 1) // 2 + np.arange(0, n_genes, step)
+    return (box_a_csum[:, keep + box_b] - box_a_csum[:, keep]) / (box_a * box_b)
+
+
+def _n_windows(n_genes: int, window_size: int, step: int, mode: str = "same") -> int:
+    """Number of windows returned by `_running_mean` for a chromosome with `n_genes` genes."""
+    if window_size >= n_genes:
+        return 1
+    return len(range(0, n_genes - window_size + 1 if mode == "valid" else n_genes, step))
+
+
+def _smooth_chunk(
+    chunk: scipy.sparse.csr_matrix,
+    reference: np.ndarray,
+    chr_bounds: List[Tuple[int, int]],
+    lfc_clip: float,
+    window_size: int,
+    step: int,
+    dynamic_threshold: Optional[float],
+    mode: str = "same",
+) -> scipy.sparse.csr_matrix:
+    """
+    Reference-center, clip, smooth per chromosome, cell-center and denoise a chunk of cells. The columns of `chunk`
+    and `reference` are expected to already be sorted by chromosome and genomic position.
+
+    Args:
+        chunk (scipy.sparse.csr_matrix): Cells x genes expression for a chunk of cells.
+        reference (np.ndarray): Mean reference expression per gene.
+        chr_bounds (List[Tuple[int, int]]): Start and end column of each chromosome in the sorted gene order.
+        lfc_clip (float): Clip log fold changes at this value.
+        window_size (int): Length of the running window.
+        step (int): Only keep every `step`-th window.
+        dynamic_threshold (float, optional): Values below `dynamic_threshold` standard deviations are set to 0.
+        mode (str, optional): Convolution mode of the running mean, "same" or "valid". Default is "same".
+
+    Returns:
+        scipy.sparse.csr_matrix: Smoothed CNV values for the chunk.
+    """
+    x = np.asarray(chunk.todense()) - reference
+    np.clip(x, -lfc_clip, lfc_clip, out=x)
+    smoothed = np.hstack([_running_mean(x[:, start:end], window_size, step, mode) for start, end in chr_bounds])
+    smoothed -= np.median(smoothed, axis=1)[:, np.newaxis]
+    if dynamic_threshold is not None:
+        smoothed[np.abs(smoothed) < dynamic_threshold * np.std(smoothed)] = 0
+    return scipy.sparse.csr_matrix(smoothed.astype(chunk.dtype, copy=False))
+
+
+def _sorted_gene_layout(var: pd.DataFrame) -> Tuple[np.ndarray, List[str], List[Tuple[int, int]]]:
+    """
+    Order genes by chromosome and start position the same way infercnvpy does.
+
+    Args:
+        var (pd.DataFrame): Gene annotations with `chromosome` and `start` columns, restricted to usable genes.
+
+    Returns:
+        Tuple[np.ndarray, List[str], List[Tuple[int, int]]]: Integer positions of the genes in sorted order, the
+            chromosomes in order, and the column bounds of each chromosome in the sorted order.
+    """
+    chromosomes = _natural_sort([c for c in var["chromosome"].unique() if c.startswith("chr") and c != "chrM"])
+    order: List[int] = []
+    chr_bounds = []
+    for chrom in chromosomes:
+        genes = var.loc[var["chromosome"] == chrom].sort_values("start").index.values
+        chr_bounds.append((len(order), len(order) + len(genes)))
+        order.extend(var.index.get_indexer(genes))
+    return np.asarray(order, dtype=np.int64), chromosomes, chr_bounds
+
+
+def infercnv(
+    adata: "AnnData",
+    reference_key: str,
+    reference_cat: str,
+    window_size: int = 100,
+    step: int = 10,
+    lfc_clip: float = 3.0,
+    dynamic_threshold: Optional[float] = 1.5,
+    exclude_chromosomes: Optional[Sequence[str]] = ("chrX", "chrY"),
+    chunksize: int = 5000,
+    n_jobs: Optional[int] = 1,
+    key_added: str = "cnv",
+    mode: str = "same",
+) -> None:
+    """
+    Compute windowed, reference-centered CNV values directly from the log-normalized (sparse) expression matrix.
+    This is a drop-in alternative to `infercnvpy.tl.infercnv` for the chromosomal loss computation: it follows the
+    same steps (reference centering, clipping, pyramid-weighted running mean per chromosome, cell centering and
+    noise filtering) but computes the running means from per-chromosome cumulative sums and processes chunks of cells
+    in a thread pool rather than in separate processes, which avoids pickling the expression matrix.
+    Results are stored in `adata.obsm[f"X_{key_added}"]` and `adata.uns[key_added]["chr_pos"]` like infercnvpy does.
+    Each thread densifies a chunk of `chunksize` cells x genes and holds it with its float64 smoothing temporaries,
+    about 12 bytes per cell and gene, e.g. 1.2 GB for 5000 cells x 20000 genes, so peak memory grows with `n_jobs`.
+
+    Args:
+        adata (AnnData): AnnData object with log-normalized expression and `chromosome`/`start` columns in `var`.
+        reference_key (str): Column in `adata.obs` holding the reference annotation.
+        reference_cat (str): Value in `adata.obs[reference_key]` for the reference (control) cells.
+        window_size (int, optional): Number of genes in the running window. Default is 100.
+        step (int, optional): Only compute every `step`-th window. Default is 10.
+        lfc_clip (float, optional): Clip log fold changes at this value. Default is 3.0.
+        dynamic_threshold (float, optional): Values below `dynamic_threshold` standard deviations of the smoothed
+            chunk are set to 0. Default is 1.5. Set to None to disable.
+        exclude_chromosomes (Sequence[str], optional): Chromosomes to skip. Default is ("chrX", "chrY").
+        chunksize (int, optional): Number of cells densified at a time. Default is 5000.
+        n_jobs (int, optional): Number of threads, each processing one chunk at a time. Default is 1.
+            None uses all available cores.
+        key_added (str, optional): Key used for storing the results. Default is "cnv".
+        mode (str, optional): Convolution mode of the running mean. "same" (default) centers a window on every gene
+            like infercnvpy 0.4.x, "valid" only keeps windows within the chromosome like infercnvpy >= 0.5.
+
+    Returns:
+        None
+
+    Raises:
+        ValueError: If gene positions are missing, the reference category is not found or `mode` is unknown.
+    """
+    if mode not in CONVOLUTION_MODES:
+        raise ValueError(f"mode must be one of {CONVOLUTION_MODES}, got {mode}.")
+    if not {"chromosome", "start"}.issubset(adata.var.columns):
+        raise ValueError("Genomic positions not found. `chromosome` and `start` columns are required in `adata.var`.")
+    ref_mask = (adata.obs[reference_key] == reference_cat).to_numpy()
+    if not ref_mask.any():
+        raise ValueError(f"Reference category {reference_cat} not found in adata.obs[{reference_key}].")
+
+    var_mask = adata.var["chromosome"].isnull()
+    if exclude_chromosomes is not None:
+        var_mask = var_mask | adata.var["chromosome"].isin(exclude_chromosomes)
+    usable = np.flatnonzero(~var_mask.to_numpy())
+    order, chromosomes, chr_bounds = _sorted_gene_layout(adata.var.iloc[usable])
+    columns = usable[order]
+
+    expr = scipy.sparse.csr_matrix(adata.X)
+    reference = np.asarray(expr[ref_mask][:, columns].mean(axis=0)).ravel()
+
+    def _process(start: int) -> scipy.sparse.csr_matrix:
+        return _smooth_chunk(
+            expr[start : start + chunksize][:, columns],
+            reference,
+            chr_bounds,
+            lfc_clip,
+            window_size,
+            step,
+            dynamic_threshold,
+            mode,
+        )
+
+    n_workers = n_jobs or os.cpu_count() or 1
+    with cf.ThreadPoolExecutor(n_workers) as executor:
+        chunks = list(executor.map(_process, range(0, adata.shape[0], chunksize)))
+
+    block_counts = [_n_windows(end - start, window_size, step, mode) for start, end in chr_bounds]
+    block_starts = np.cumsum([0] + block_counts)
+    adata.obsm[f"X_{key_added}"] = scipy.sparse.vstack(chunks).tocsr()
+    adata.uns[key_added] = {"chr_pos": {chrom: int(block_starts[i]) for i, chrom in enumerate(chromosomes)}}
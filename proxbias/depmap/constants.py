@@ -1,9 +1,12 @@
 DEPMAP_API_URL = "https://depmap.org/portal/api/download/files"
+RELEASE_INDEX_FILENAME = "release_files.csv"
+RELEASE_INDEX_TTL = 7 * 24 * 60 * 60  # seconds
 DEPMAP_RELEASE_DEFAULT = "DepMap Public 22Q4"
 
 CNV_FILENAME = "OmicsCNGene.csv"
 CRISPR_DEPENDENCY_EFFECT_FILENAME = "CRISPRGeneEffect.csv"
 MUTATION_FILENAME = "OmicsSomaticMutations.csv"
+MUTATION_ROW_GROUP_SIZE = 10_000
 
 DEMETER2_RELEASE_DEFAULT = "DEMETER2 Data v6"
 RNAI_DEPENDENCY_EFFECT_FILENAME = "D2_combined_gene_dep_scores.csv"
@@ -0,0 +1,201 @@
+import concurrent.futures as cf
+import hashlib
+import os
+import shutil
+import time
+import urllib.error
+import urllib.parse
+import urllib.request
+from typing import Callable, Dict, List, Optional, Tuple
+
+import pandas as pd
+
+from proxbias.depmap.constants import DEPMAP_API_URL, RELEASE_INDEX_FILENAME, RELEASE_INDEX_TTL
+
+# HTTP status codes of expired or withdrawn download urls, e.g. signed urls of an outdated file index
+EXPIRED_URL_CODES = (403, 404)
+
+
+def _md5(path: str, chunk_size: int = 1 << 20) -> str:
+    digest = hashlib.md5()  # nosec B324 - used as a checksum, not for security
+    with open(path, "rb") as fh:
+        for chunk in iter(lambda: fh.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def download_file(
+    url: str,
+    target_path: str,
+    md5_hash: Optional[str] = None,
+    n_retries: int = 3,
+    timeout: float = 60,
+    chunk_size: int = 1 << 20,
+) -> str:
+    """
+    Download `url` to `target_path`. Data is streamed into `target_path + ".part"`, which is resumed with an
+    HTTP range request if it already exists (e.g. after an interrupted download or a failed attempt). The file size
+    is checked against the Content-Length reported by the server and, if given, the md5 checksum is verified before
+    the file is atomically renamed to `target_path`.
+
+    Parameters
+    ----------
+    url : str
+        http(s) url to download
+    target_path : str
+        local path of the downloaded file
+    md5_hash : str, optional
+        expected md5 checksum of the file, by default None (not verified)
+    n_retries : int, optional
+        number of attempts before giving up, by default 3
+    timeout : float, optional
+        socket timeout in seconds, by default 60
+    chunk_size : int, optional
+        number of bytes written at a time, by default 1 MiB
+
+    Returns
+    -------
+    str, the target path
+    """
+    if urllib.parse.urlparse(url).scheme not in ("http", "https"):
+        raise ValueError(f"Only http(s) urls are supported, got {url}")
+    target_dir = os.path.dirname(target_path)
+    if target_dir:
+        os.makedirs(target_dir, exist_ok=True)
+    part_path = f"{target_path}.part"
+    for attempt in range(1, n_retries + 1):
+        try:
+            offset = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+            request = urllib.request.Request(url)
+            if offset:
+                request.add_header("Range", f"bytes={offset}-")
+            with urllib.request.urlopen(request, timeout=timeout) as response:  # nosec B310 - scheme checked above
+                if offset and response.status != 206:
+                    # The server ignored the range request and sends the whole file
+                    offset = 0
+                content_length = response.headers.get("Content-Length")
+                expected_size = offset + int(content_length) if content_length is not None else None
+                with open(part_path, "ab" if offset else "wb") as fh:
+                    shutil.copyfileobj(response, fh, chunk_size)
+            if expected_size is not None and os.path.getsize(part_path) != expected_size:
+                raise IOError(f"Incomplete download of {url}: {os.path.getsize(part_path)} of {expected_size} bytes")
+            if md5_hash and _md5(part_path) != md5_hash:
+                os.remove(part_path)
+                raise IOError(f"Checksum mismatch for {url}")
+            os.replace(part_path, target_path)
+            return target_path
+        except OSError as e:
+            if isinstance(e, urllib.error.HTTPError) and e.code == 416:
+                # The partial file is not a prefix of the remote file anymore, start over
+                os.remove(part_path)
+            if attempt == n_retries or (isinstance(e, urllib.error.HTTPError) and e.code in EXPIRED_URL_CODES):
+                raise
+            print(f"Download of {url} failed ({e}), retrying ({attempt}/{n_retries})...")
+    return target_path
+
+
+def get_release_files(
+    cache_dir: str,
+    ttl: float = RELEASE_INDEX_TTL,
+    url: str = DEPMAP_API_URL,
+) -> pd.DataFrame:
+    """
+    Get the DepMap file index, listing the release, filename and url of all downloadable files.
+    The index is cached in `cache_dir` and only downloaded again once the cached copy is older than `ttl` seconds.
+
+    Parameters
+    ----------
+    cache_dir : str
+        directory to cache the index in
+    ttl : float, optional
+        maximum age of the cached index in seconds, by default RELEASE_INDEX_TTL
+    url : str, optional
+        url of the index, by default DEPMAP_API_URL
+
+    Returns
+    -------
+    pd.DataFrame with the DepMap file index
+    """
+    index_path = f"{cache_dir}/{RELEASE_INDEX_FILENAME}"
+    if not os.path.isfile(index_path) or time.time() - os.path.getmtime(index_path) > ttl:
+        print("Downloading the DepMap file index...")
+        download_file(url, index_path)
+    return pd.read_csv(index_path)
+
+
+def _pending_downloads(
+    release_files: pd.DataFrame,
+    requested_files: Dict[str, List[str]],
+    target_base_dir: str,
+) -> Dict[str, Tuple[str, Optional[str]]]:
+    """Url and md5 checksum of the requested files that are not present yet, keyed by target path."""
+    downloads = {}
+    for release, filenames in requested_files.items():
+        release_index = (
+            release_files.loc[release_files.release == release].drop_duplicates("filename").set_index("filename")
+        )
+        for filename in filenames:
+            target_path = f"{target_base_dir}/{release}/{filename}"
+            if os.path.isfile(target_path):
+                continue
+            if filename not in release_index.index:
+                raise KeyError(f"{filename} is not available in {release}")
+            file_info = release_index.loc[filename]
+            md5_hash = file_info.get("md5_hash")
+            downloads[target_path] = (file_info.url, md5_hash if isinstance(md5_hash, str) else None)
+    return downloads
+
+
+def _download_all(downloads: Dict[str, Tuple[str, Optional[str]]], n_workers: int):
+    with cf.ThreadPoolExecutor(max(1, min(n_workers, len(downloads)))) as executor:
+        futures = {
+            executor.submit(download_file, url, target_path, md5_hash): target_path
+            for target_path, (url, md5_hash) in downloads.items()
+        }
+        for fut in cf.as_completed(futures):
+            print(f"Downloaded {fut.result()}")
+
+
+def fetch_release_files(
+    release_files: pd.DataFrame,
+    requested_files: Dict[str, List[str]],
+    target_base_dir: str,
+    n_workers: int = 4,
+    refresh_index: Optional[Callable[[], pd.DataFrame]] = None,
+) -> List[str]:
+    """
+    Download release files concurrently to `{target_base_dir}/{release}/{filename}`, skipping files that are already
+    present. Files are verified against the `md5_hash` column of the index when it is available.
+
+    Parameters
+    ----------
+    release_files : pd.DataFrame
+        DepMap file index, as returned by `get_release_files`
+    requested_files : Dict[str, List[str]]
+        filenames to download, keyed by release name
+    target_base_dir : str
+        base directory to download into
+    n_workers : int, optional
+        number of concurrent downloads, by default 4
+    refresh_index : Callable[[], pd.DataFrame], optional
+        returns a freshly downloaded file index, by default None. If given and a download fails with 403 or 404,
+        e.g. because the signed url in a cached index expired, the missing files are downloaded once more with the
+        urls of the fresh index
+
+    Returns
+    -------
+    List[str], paths of the requested files
+    """
+    paths = [
+        f"{target_base_dir}/{release}/{filename}"
+        for release, filenames in requested_files.items()
+        for filename in filenames
+    ]
+    try:
+        _download_all(_pending_downloads(release_files, requested_files, target_base_dir), n_workers)
+    except urllib.error.HTTPError as e:
+        if refresh_index is None or e.code not in EXPIRED_URL_CODES:
+            raise
+        print(f"Download failed ({e}), refreshing the DepMap file index and retrying...")
+        _download_all(_pending_downloads(refresh_index(), requested_files, target_base_dir), n_workers)
+    return paths
@@ -1,29 +1,143 @@
 import os
-from functools import partial
-from typing import Tuple
+import shutil
+import tempfile
+from typing import Callable, Dict, Iterable, List, Optional, Tuple, Union
 
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
 
 from proxbias.depmap.constants import (
     CNV_FILENAME,
     CRISPR_DEPENDENCY_EFFECT_FILENAME,
     DEMETER2_RELEASE_DEFAULT,
-    DEPMAP_API_URL,
     DEPMAP_RELEASE_DEFAULT,
     MUTATION_FILENAME,
+    MUTATION_ROW_GROUP_SIZE,
+    RELEASE_INDEX_TTL,
     RNAI_DEPENDENCY_EFFECT_FILENAME,
 )
+from proxbias.depmap.fetch import fetch_release_files, get_release_files
 
 
-def _download_file(_release_files: pd.DataFrame, _filename: str, **read_kwargs):
-    url = _release_files.loc[_release_files.filename == _filename].iloc[0].url
-    return pd.read_csv(url, **read_kwargs)
+def _matrix_cache_path(_prefix: str, _filename: str, dtype: Optional[str] = None) -> str:
+    suffix = f".{np.dtype(dtype).name}" if dtype is not None else ""
+    return f"{_prefix}/{os.path.splitext(_filename)[0]}{suffix}"
 
 
-def _cache_file(_df: pd.DataFrame, _prefix: str, _filename: str):
-    if not os.path.exists(_prefix):
-        os.makedirs(_prefix)
-    _df.to_csv(f"{_prefix}/{_filename}")
+def _cache_matrix(_df: pd.DataFrame, _path: str):
+    """Store a processed gene x model matrix as `.npy` arrays so that it can be memory-mapped on load."""
+    tmp_path = f"{_path}.tmp"
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    os.makedirs(tmp_path)
+    np.save(f"{tmp_path}/values.npy", np.ascontiguousarray(_df.to_numpy()))
+    np.save(f"{tmp_path}/index.npy", _df.index.to_numpy(dtype=str))
+    np.save(f"{tmp_path}/columns.npy", _df.columns.to_numpy(dtype=str))
+    shutil.rmtree(_path, ignore_errors=True)
+    os.replace(tmp_path, _path)
+
+
+def _load_cached_matrix(_path: str, mmap_mode: Optional[str] = None) -> pd.DataFrame:
+    values = np.load(f"{_path}/values.npy", mmap_mode=mmap_mode)  # type: ignore[arg-type]
+    index = pd.Index(np.load(f"{_path}/index.npy").astype(object))
+    columns = pd.Index(np.load(f"{_path}/columns.npy").astype(object), name="ModelID")
+    return pd.DataFrame(values, index=index, columns=columns, copy=False)
+
+
+def _mutation_cache_path(_prefix: str) -> str:
+    return f"{_prefix}/{os.path.splitext(MUTATION_FILENAME)[0]}.parquet"
+
+
+# Column of the mutation cache with the row of each mutation in the csv file, to restore the csv order
+_MUTATION_ROW_COLUMN = "csv_row"
+
+
+def _format_mutations(_df: pd.DataFrame) -> pd.DataFrame:
+    """Cast the mutation table to the same dtypes whether it is read from the csv file or from the parquet cache."""
+    return _df.astype({"ModelID": object, "HugoSymbol": object, "VariantInfo": object})
+
+
+def _cache_mutations(_df: pd.DataFrame, _path: str, row_group_size: int = MUTATION_ROW_GROUP_SIZE):
+    """
+    Store the mutation table as parquet sorted by gene, so that the per row group min/max statistics of `HugoSymbol`
+    allow reading the rows of a few genes without scanning the whole file. `ModelID` and `VariantInfo` are
+    dictionary encoded, and the csv row of each mutation is kept to restore the csv order when loading.
+    """
+    _df = _df.assign(**{_MUTATION_ROW_COLUMN: np.arange(len(_df))})
+    _df = _df.sort_values("HugoSymbol", kind="stable").reset_index(drop=True)
+    table = pa.Table.from_pandas(_df.astype({"ModelID": "category", "VariantInfo": "category"}), preserve_index=False)
+    tmp_path = f"{_path}.tmp"
+    pq.write_table(table, tmp_path, row_group_size=row_group_size)
+    os.replace(tmp_path, _path)
+
+
+def _load_cached_mutations(
+    _path: str,
+    genes: Optional[Iterable[str]] = None,
+) -> pd.DataFrame:
+    """Read the mutations of `genes`, or all of them, in csv order and with the dtypes of the csv path."""
+    filters = [("HugoSymbol", "in", list(genes))] if genes is not None else None
+    mutation_data = pd.read_parquet(_path, engine="pyarrow", filters=filters)
+    mutation_data = mutation_data.sort_values(_MUTATION_ROW_COLUMN).drop(columns=_MUTATION_ROW_COLUMN)
+    return _format_mutations(mutation_data.reset_index(drop=True))
+
+
+def load_gene_mutations(
+    genes: Union[str, Iterable[str]],
+    depmap_release: str = DEPMAP_RELEASE_DEFAULT,
+    cache_base_dir: str = "depmap",
+) -> pd.DataFrame:
+    """
+    Read the mutations of one or several genes from the mutation cache written by `get_depmap_data`.
+    Only the parquet row groups that can contain the requested genes are read.
+
+    Parameters
+    ----------
+    genes : Union[str, Iterable[str]]
+        a gene symbol or a collection of gene symbols
+    depmap_release : str, optional
+        a depmap release string, by default DEPMAP_RELEASE_DEFAULT
+    cache_base_dir : str, optional
+        path of the cache, by default "depmap"
+
+    Returns
+    -------
+    pd.DataFrame with the `ModelID`, `HugoSymbol` and `VariantInfo` columns of the requested genes
+
+    Examples
+    --------
+    >>> tp53_mutations = load_gene_mutations("TP53", depmap_release="DepMap Public 22Q4")
+    """
+    path = _mutation_cache_path(f"{cache_base_dir}/{depmap_release}")
+    if not os.path.isfile(path):
+        raise FileNotFoundError(f"{path} is not found. Run `get_depmap_data` with `cache=True` first.")
+    return _load_cached_mutations(path, [genes] if isinstance(genes, str) else genes)
+
+
+def _clean_gene_symbols(_index: pd.Index) -> pd.Index:
+    """Strip the Entrez ID from DepMap gene labels, e.g. "TP53 (7157)" -> "TP53"."""
+    return pd.Index(_index.astype(str).str.split(" ").str[0])
+
+
+def _format_model_by_gene(_df: pd.DataFrame) -> pd.DataFrame:
+    """Transpose a model x gene DepMap matrix (CRISPR effect, CNV) into gene x model with clean gene symbols."""
+    _df.index.name = "ModelID"
+    _df = _df.T
+    _df.index = _clean_gene_symbols(_df.index)
+    return _df
+
+
+def _format_rnai(_df: pd.DataFrame) -> pd.DataFrame:
+    _df.columns.name = "ModelID"
+    _df.index = _clean_gene_symbols(_df.index)
+    # remove multi-mapping oligos
+    _df = _df.loc[~_df.index.str.contains("&")]
+    # some genes are not available for a majority of cell models.
+    # most are deprecated or low confidence genes. remove them.
+    n_missed_models = _df.isna().sum(axis=1)
+    rnai_models = n_missed_models[n_missed_models < 200].index
+    return _df.loc[rnai_models].dropna(axis=1)
 
 
 def get_depmap_data(
@@ -31,6 +145,10 @@ def get_depmap_data(
     rnai_release: str = DEMETER2_RELEASE_DEFAULT,
     cache: bool = True,
     cache_base_dir: str = "depmap",
+    mmap_mode: Optional[str] = None,
+    dtype: Optional[str] = None,
+    n_download_workers: int = 4,
+    index_ttl: float = RELEASE_INDEX_TTL,
 ) -> Tuple[pd.DataFrame, pd.DataFrame, pd.DataFrame, pd.DataFrame]:
     """
     Obtain and format DepMap data.
@@ -43,9 +161,24 @@ def get_depmap_data(
         a rnai release string, by default DEMETER2_RELEASE_DEFAULT. If an empty string,
         do not check cache and return an empty dataframe
     cache : bool, optional
-        whether cache the data as csv or not, by default True
+        whether to cache the data or not, by default True. Release files are downloaded as csv,
+        and the CRISPR, RNAi and CNV matrices are additionally cached as `.npy` arrays in their
+        final gene x model orientation. The mutation table is cached as parquet sorted by gene,
+        see `load_gene_mutations`. If all files are cached, the network is not used at all.
     cache_base_dir : str, optional
         path to cache the data, by default "depmap"
+    mmap_mode : str, optional
+        passed to `np.load` when reading cached matrices, by default None (load into memory).
+        Use "r" to memory-map the cached matrices read-only, e.g. to share them between worker processes.
+    dtype : str, optional
+        dtype of the CRISPR, RNAi and CNV matrices, by default None (float64 as parsed from the csv files).
+        Use "float32" to halve their memory footprint. Matrices are cached separately for each dtype,
+        so they can be memory-mapped in the requested precision.
+    n_download_workers : int, optional
+        number of files downloaded concurrently, by default 4
+    index_ttl : float, optional
+        maximum age in seconds of the cached DepMap file index, by default RELEASE_INDEX_TTL. The index is also
+        downloaded again, and the downloads retried once, if a url of the cached index has expired (403 or 404)
 
     Returns
     -------
@@ -63,76 +196,97 @@ def get_depmap_data(
     >>> )
     """
 
-    def _read_and_cache(release_name, release_files, file_prefix, filename, **read_kwargs):
-        target_file = f"{file_prefix}/{filename}"
-        if os.path.isfile(target_file):
-            print(f"{filename} from {release_name} is found. Reading dataframe from cache.")
-            target_data = pd.read_csv(target_file, **read_kwargs)
+    matrix_filenames = [CRISPR_DEPENDENCY_EFFECT_FILENAME, CNV_FILENAME, RNAI_DEPENDENCY_EFFECT_FILENAME]
+    release_filenames = {depmap_release: [CRISPR_DEPENDENCY_EFFECT_FILENAME, CNV_FILENAME, MUTATION_FILENAME]}
+    if rnai_release:
+        release_filenames[rnai_release] = [RNAI_DEPENDENCY_EFFECT_FILENAME]
+
+    def _is_cached(release_name, filename):
+        file_prefix = f"{cache_base_dir}/{release_name}"
+        if filename in matrix_filenames and any(
+            os.path.isdir(_matrix_cache_path(file_prefix, filename, matrix_dtype)) for matrix_dtype in (None, dtype)
+        ):
+            return True
+        if filename == MUTATION_FILENAME and os.path.isfile(_mutation_cache_path(file_prefix)):
+            return True
+        return os.path.isfile(f"{file_prefix}/{filename}")
+
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        download_base_dir = cache_base_dir if cache else tmp_dir
+        missing_files: Dict[str, List[str]] = {}
+        for release_name, filenames in release_filenames.items():
+            missing = [filename for filename in filenames if not _is_cached(release_name, filename)]
+            if missing:
+                missing_files[release_name] = missing
+        if missing_files:
+            print(f"Cached files are not found. Downloading {missing_files}...")
+            release_files = get_release_files(download_base_dir, ttl=index_ttl)
+            fetch_release_files(
+                release_files,
+                missing_files,
+                download_base_dir,
+                n_workers=n_download_workers,
+                refresh_index=lambda: get_release_files(download_base_dir, ttl=0),
+            )
             print("Done!")
+
+        def _read_raw(release_name, filename, **read_kwargs):
+            for base_dir in (cache_base_dir, download_base_dir):
+                target_file = f"{base_dir}/{release_name}/{filename}"
+                if os.path.isfile(target_file):
+                    print(f"Reading {filename} from {release_name}.")
+                    return pd.read_csv(target_file, **read_kwargs)
+            raise FileNotFoundError(f"{filename} from {release_name} is not available.")
+
+        def _read_matrix(release_name, filename, format_fn: Callable, **read_kwargs):
+            matrix_path = _matrix_cache_path(f"{cache_base_dir}/{release_name}", filename, dtype)
+            if os.path.isdir(matrix_path):
+                print(f"{filename} from {release_name} is found in the matrix cache. Loading.")
+                return _load_cached_matrix(matrix_path, mmap_mode=mmap_mode)
+            default_path = _matrix_cache_path(f"{cache_base_dir}/{release_name}", filename)
+            if dtype is not None and os.path.isdir(default_path):
+                target_data = _load_cached_matrix(default_path)
+            else:
+                target_data = format_fn(_read_raw(release_name, filename, **read_kwargs))
+            if dtype is not None:
+                target_data = target_data.astype(dtype, copy=False)
+            if cache:
+                _cache_matrix(target_data, matrix_path)
+                if mmap_mode is not None:
+                    return _load_cached_matrix(matrix_path, mmap_mode=mmap_mode)
+            return target_data
+
+        # CRISPR Dependency Effect
+        crispr_effect_data = _read_matrix(
+            depmap_release, CRISPR_DEPENDENCY_EFFECT_FILENAME, _format_model_by_gene, index_col=0
+        )
+
+        # RNAi Dependency Effect
+        if rnai_release:
+            rnai_effect_data = _read_matrix(rnai_release, RNAI_DEPENDENCY_EFFECT_FILENAME, _format_rnai, index_col=0)
         else:
-            print(f"Cached file {filename} is not found. Downloading from {release_name}...")
-            target_data = _download_file(release_files, filename, **read_kwargs)
-            print("Done!")
+            rnai_effect_data = pd.DataFrame()
+
+        # Copy Number Variation
+        cnv_data = _read_matrix(depmap_release, CNV_FILENAME, _format_model_by_gene, index_col=0)
+
+        # Mutations
+        mutation_path = _mutation_cache_path(f"{cache_base_dir}/{depmap_release}")
+        if os.path.isfile(mutation_path):
+            print(f"{MUTATION_FILENAME} from {depmap_release} is found in the parquet cache. Loading.")
+            mutation_data = _load_cached_mutations(mutation_path)
+        else:
+            mutation_usecols = ["DepMap_ID", "HugoSymbol", "VariantInfo"]
+            mutation_data = _read_raw(depmap_release, MUTATION_FILENAME, usecols=mutation_usecols)
+            mutation_data = _format_mutations(mutation_data.rename(columns={"DepMap_ID": "ModelID"}))
             if cache:
-                _cache_file(target_data, file_prefix, filename)
-        return target_data
-
-    release_files = pd.read_csv(DEPMAP_API_URL)
-
-    depmap_file_prefix = f"{cache_base_dir}/{depmap_release}"
-    depmap_release_files = release_files.loc[release_files.release == depmap_release]
-    rnai_file_prefix = f"{cache_base_dir}/{rnai_release}"
-    rnai_release_files = release_files.loc[release_files.release == rnai_release]
-
-    _read_cache_depmap = partial(
-        _read_and_cache,
-        depmap_release,
-        depmap_release_files,
-        depmap_file_prefix,
-    )
-    _read_cache_rnai = partial(
-        _read_and_cache,
-        rnai_release,
-        rnai_release_files,
-        rnai_file_prefix,
-    )
-
-    # CRISPR Dependency Effect
-    crispr_effect_data = _read_cache_depmap(CRISPR_DEPENDENCY_EFFECT_FILENAME, index_col=0)
-    crispr_effect_data.index.name = "ModelID"
-    crispr_effect_data = crispr_effect_data.T
-    crispr_effect_data.index = [g.split(" ")[0] for g in crispr_effect_data.index]
-
-    # RNAi Dependency Effect
-    if rnai_release:
-        rnai_effect_data = _read_cache_rnai(RNAI_DEPENDENCY_EFFECT_FILENAME, index_col=0)
-        rnai_effect_data.columns.name = "ModelID"
-        rnai_effect_data.index = [g.split(" ")[0] for g in rnai_effect_data.index]
-        # remove multi-mapping oligos
-        rnai_effect_data = rnai_effect_data.query("~index.str.contains('&')")
-        # some genes are not available for a majority of cell models.
-        # most are deprecated or low confidence genes. remove them.
-        n_missed_models = rnai_effect_data.isna().sum(axis=1)
-        rnai_models = n_missed_models[n_missed_models < 200].index
-        rnai_effect_data = rnai_effect_data.loc[rnai_models].dropna(axis=1)
-    else:
-        rnai_effect_data = pd.DataFrame()
-
-    # Copy Number Variation
-    cnv_data = _read_cache_depmap(CNV_FILENAME, index_col=0)
-    cnv_data.index.name = "ModelID"
-    cnv_data = cnv_data.T
-    cnv_data.index = [g.split(" ")[0] for g in cnv_data.index]
-
-    # Mutations
-    mutation_usecols = ["DepMap_ID", "HugoSymbol", "VariantInfo"]
-    mutation_data = _read_cache_depmap(MUTATION_FILENAME, usecols=mutation_usecols)
-    mutation_data = mutation_data.rename(columns={"DepMap_ID": "ModelID"})
+                _cache_mutations(mutation_data, mutation_path)
+                mutation_data = _load_cached_mutations(mutation_path)
 
     return crispr_effect_data, rnai_effect_data, cnv_data, mutation_data
 
 
-def center_gene_effects(embeddings: pd.DataFrame) -> pd.DataFrame:
+def center_gene_effects(embeddings: pd.DataFrame, inplace: bool = False) -> pd.DataFrame:
     """
     Subtract the mean effect for each row.
 
@@ -140,10 +294,21 @@ def center_gene_effects(embeddings: pd.DataFrame) -> pd.DataFrame:
     ----------
     embeddings : pd.DataFrame
         a dataframe with index as genes and column as features
+    inplace : bool, optional
+        whether to center `embeddings` in place instead of returning a new dataframe, by default False.
+        The dtype of `embeddings` is preserved, e.g. float32 data stays float32.
 
     Returns
     -------
     pd.DataFrame after row centering
     """
-    embeddings = embeddings.sub(embeddings.mean(axis=1), axis=0)
+    if not inplace:
+        return embeddings.sub(embeddings.mean(axis=1), axis=0)
+    values = embeddings.to_numpy()
+    if not values.flags.writeable:
+        raise ValueError("Cannot center read-only (e.g. memory-mapped) data in place. Copy it first.")
+    values -= embeddings.mean(axis=1).to_numpy(dtype=values.dtype)[:, np.newaxis]
+    if not np.shares_memory(values, embeddings.to_numpy()):
+        # mixed dtypes: the values were a copy, write them back
+        embeddings.iloc[:, :] = values
     return embeddings
@@ -1,15 +1,22 @@
 import concurrent.futures as cf
+import glob
+import hashlib
+import itertools
+import json
 import multiprocessing as mp
 import os
 import time
-from typing import Any, Callable, Dict, List, Set, Tuple
+import uuid
+from statistics import NormalDist
+from typing import Any, Callable, Dict, List, Optional, Set, Tuple, Union
 
+import numba
 import numpy as np
 import pandas as pd
 
 from proxbias.depmap.constants import CN_GAIN_CUTOFF, CN_LOSS_CUTOFF, COMPLETE_LOF_MUTATION_TYPES
-from proxbias.depmap.load import center_gene_effects
-from proxbias.metrics import genome_proximity_bias_score
+from proxbias.metrics import genome_proximity_bias_score, warm_up_samplers
+from proxbias.utils import instrumentation
 
 
 def split_models(
@@ -75,6 +82,124 @@ def split_models(
     return lof, wt_low_change, amp, mutant_low_change
 
 
+def _gene_seed_sequence(seed: int, gene_symbol: str) -> np.random.SeedSequence:
+    """
+    Seed sequence of a gene, derived from the run seed and the gene symbol only. Results of a gene then do not depend
+    on which other genes are processed in the same run or shard.
+    """
+    gene_key = int.from_bytes(hashlib.sha1(gene_symbol.encode()).digest()[:8], "little")  # nosec B324 - not security
+    return np.random.SeedSequence(seed, spawn_key=(gene_key,))
+
+
+def _model_status(
+    gene_of_interest: str,
+    dep_columns: pd.Index,
+    cnv_data: pd.DataFrame,
+    mutation_data: pd.DataFrame,
+    candidate_models: List[str],
+) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Copy number and mutation status of the models in `dep_columns` for a gene. The model split of any cutoffs and
+    options can be derived from it with `_split_columns` without going through the data again.
+    """
+    copy_number = (np.power(2, cnv_data.loc[gene_of_interest]) - 1) * 2
+    copy_number = copy_number.loc[~copy_number.index.duplicated()].reindex(dep_columns).to_numpy(dtype=np.float64)
+    mutants_for_gene = mutation_data.loc[mutation_data["HugoSymbol"] == gene_of_interest]
+    is_mutant = dep_columns.isin(mutants_for_gene.loc[~mutants_for_gene["VariantInfo"].isna(), "ModelID"].unique())
+    is_complete_lof = dep_columns.isin(
+        mutants_for_gene.loc[mutants_for_gene["VariantInfo"].isin(COMPLETE_LOF_MUTATION_TYPES), "ModelID"].unique()
+    )
+    return copy_number, is_mutant, is_complete_lof, dep_columns.isin(candidate_models)
+
+
+def _split_columns(
+    status: Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray],
+    search_mode: str,
+    cnv_cutoffs: Tuple[float, float],
+    complete_lof: bool,
+    filter_amp: bool,
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Positions of the wild type and test models in a `_model_status`, split like `split_models` does."""
+    copy_number, is_mutant, is_complete_lof, is_candidate = status
+    lof = copy_number < cnv_cutoffs[0]
+    amp = copy_number >= cnv_cutoffs[1]
+    if complete_lof:
+        wt = ~(lof | amp | is_complete_lof)
+        test = is_complete_lof if search_mode == "lof" else np.zeros_like(amp)
+    else:
+        if filter_amp:
+            amp &= ~is_complete_lof
+        wt = ~(is_mutant | lof | amp)
+        test = lof if search_mode == "lof" else amp
+    return np.flatnonzero(wt & is_candidate), np.flatnonzero(test & is_candidate)
+
+
+def _select_gene_columns(
+    gene_of_interest: str,
+    dep_columns: pd.Index,
+    cnv_data: pd.DataFrame,
+    mutation_data: pd.DataFrame,
+    candidate_models: List[str],
+    search_mode: str,
+    cnv_cutoffs: Tuple[float, float],
+    complete_lof: bool,
+    filter_amp: bool,
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Positions in `dep_columns` of the wild type and test models of a gene."""
+    status = _model_status(gene_of_interest, dep_columns, cnv_data, mutation_data, candidate_models)
+    return _split_columns(status, search_mode, cnv_cutoffs, complete_lof, filter_amp)
+
+
+def _gene_sample_size(
+    n_test: int,
+    n_wt: int,
+    n_min_cell_lines: int,
+    model_sample_rate: float,
+    fixed_cell_line_sampling: bool,
+) -> int:
+    """Number of models sampled per group in each iteration, 0 if there are not enough models."""
+    available_samples = min(n_test, n_wt)
+    if available_samples < n_min_cell_lines:
+        return 0
+    if fixed_cell_line_sampling:
+        return int(n_min_cell_lines * model_sample_rate)
+    return int(available_samples * model_sample_rate)
+
+
+def _confidence_sequence_half_width(diffs: List[float], confidence: float, planned_iterations: int) -> float:
+    """
+    Half width of the asymptotic normal-mixture confidence sequence of Waudby-Smith et al. (2021, "Time-uniform
+    central limit theory and asymptotic confidence sequences") for the mean of `diffs`. The mean is covered at all
+    numbers of iterations at once with probability `confidence`, so the sequence may be checked after every
+    iteration. The mixture is tuned to be tightest at `planned_iterations`, where it is about 1.5 times as wide as the
+    fixed-sample interval.
+    """
+    n = len(diffs)
+    alpha = 1 - confidence
+    rho2 = (-2 * np.log(alpha) + np.log(-2 * np.log(alpha) + 1)) / planned_iterations
+    return np.std(diffs, ddof=1) * np.sqrt(2 * (n * rho2 + 1) / (n**2 * rho2) * np.log(np.sqrt(n * rho2 + 1) / alpha))
+
+
+def _is_settled(
+    diffs: List[float],
+    target_ci_width: Optional[float],
+    stop_on_sign: bool,
+    confidence: float,
+    planned_iterations: int,
+) -> bool:
+    """
+    Whether the mean of the paired test - wt differences is precise enough: its normal confidence interval is
+    narrower than `target_ci_width`, or, with `stop_on_sign`, its confidence sequence excludes 0. The sign uses the
+    time-uniform sequence, because repeatedly checking a fixed interval for 0 stops on the wrong sign far more often
+    than 1 - `confidence`, e.g. for a quarter to 40% of null genes after 40 to 200 iterations.
+    """
+    if target_ci_width is not None:
+        half_width = NormalDist().inv_cdf(0.5 + confidence / 2) * np.std(diffs, ddof=1) / np.sqrt(len(diffs))
+        if 2 * half_width <= target_ci_width:
+            return True
+    return stop_on_sign and abs(np.mean(diffs)) > _confidence_sequence_half_width(diffs, confidence, planned_iterations)
+
+
 def _compute_stats_for_gene(
     gene_of_interest: str,
     dep_data: pd.DataFrame,
@@ -85,7 +210,7 @@ def _compute_stats_for_gene(
     search_mode: str,
     n_min_cell_lines: int,
     n_iterations: int,
-    seed: int,
+    seed: Union[int, np.random.SeedSequence],
     cnv_cutoffs: Tuple[float, float],
     eval_function: Callable,
     eval_kwargs: Dict[str, Any],
@@ -93,47 +218,85 @@ def _compute_stats_for_gene(
     filter_amp: bool,
     verbose: bool,
     fixed_cell_line_sampling: bool,
+    target_ci_width: Optional[float] = None,
+    stop_on_sign: bool = False,
+    min_iterations: int = 10,
+    confidence: float = 0.95,
+    paired: bool = False,
 ):
     start_gene_time = time.time()
-    rng = np.random.default_rng(seed)
-    lof, wt, amp, _ = split_models(
-        gene_symbol=gene_of_interest,
-        candidate_models=candidate_models,
-        cnv_data=cnv_data,
-        mutation_data=mutation_data,
-        cutoffs=cnv_cutoffs,
-        complete_only=complete_lof,
-        filter_amp=filter_amp,
+    seed_seq = seed if isinstance(seed, np.random.SeedSequence) else np.random.SeedSequence(seed)
+    # Independent streams for sampling models and for seeding the eval function
+    sampling_seq, eval_seq = seed_seq.spawn(2)
+    rng = np.random.default_rng(sampling_seq)
+    # Positions of the candidate columns, so that samples select columns by position rather than by label
+    wt_columns, test_columns = _select_gene_columns(
+        gene_of_interest,
+        dep_data.columns,
+        cnv_data,
+        mutation_data,
+        candidate_models,
+        search_mode,
+        cnv_cutoffs,
+        complete_lof,
+        filter_amp,
     )
-    wt_columns = dep_data.columns.intersection(list(wt))
-    test_columns = dep_data.columns.intersection(list(lof if search_mode == "lof" else amp))
     n_test = len(test_columns)
     n_wt = len(wt_columns)
-    available_samples = min(n_test, n_wt)
-
-    if available_samples < n_min_cell_lines:
+    choose_n = _gene_sample_size(n_test, n_wt, n_min_cell_lines, model_sample_rate, fixed_cell_line_sampling)
+    if choose_n == 0:
         if verbose:
             print(f"Insufficient samples for {gene_of_interest}")
+        instrumentation.emit("gene", gene=gene_of_interest, duration=time.time() - start_gene_time, skipped=True)
         return {}
-    if fixed_cell_line_sampling:
-        choose_n = int(n_min_cell_lines * model_sample_rate)
-    else:
-        choose_n = int(available_samples * model_sample_rate)
-    test_stats = []
-    wt_stats = []
-    for _ in range(n_iterations):
-        wt_deps = list(rng.choice(wt_columns, size=choose_n, replace=False))
-        test_deps = list(rng.choice(test_columns, size=choose_n, replace=False))
-        wt_df = dep_data.loc[:, wt_deps].copy()
-        test_df = dep_data.loc[:, test_deps].copy()
-        wt, _ = eval_function(wt_df, seed=rng.integers(low=0, high=9001, size=1)[0], **eval_kwargs)
-        test, _ = eval_function(test_df, seed=rng.integers(low=0, high=9001, size=1)[0], **eval_kwargs)
+    eval_seeds = eval_seq.generate_state(2 * n_iterations).reshape(n_iterations, 2)
+    early_stopping = target_ci_width is not None or stop_on_sign
+    test_stats: List[float] = []
+    wt_stats: List[float] = []
+    for wt_seed, test_seed in eval_seeds:
+        wt_deps = rng.choice(wt_columns, size=choose_n, replace=False)
+        test_deps = rng.choice(test_columns, size=choose_n, replace=False)
+        wt_df = dep_data.iloc[:, wt_deps]
+        test_df = dep_data.iloc[:, test_deps]
+        # Common random numbers: both groups have the same genes, so with the same seed the eval function draws the
+        # same gene pairs for both and the pair sampling noise cancels in the difference
+        if paired:
+            test_seed = wt_seed
+        # The score is the first element, eval functions may return more (p-values, samples, trials used)
+        wt = eval_function(wt_df, seed=int(wt_seed), **eval_kwargs)[0]
+        test = eval_function(test_df, seed=int(test_seed), **eval_kwargs)[0]
         wt_stats.append(wt)
         test_stats.append(test)
+        if (
+            early_stopping
+            and len(test_stats) >= max(min_iterations, 2)
+            and _is_settled(
+                list(np.subtract(test_stats, wt_stats)),
+                target_ci_width,
+                stop_on_sign,
+                confidence,
+                n_iterations,
+            )
+        ):
+            break
 
     duration = time.time() - start_gene_time
     diff = np.array(test_stats).mean() - np.array(wt_stats).mean()
-    print(f"Stats for {gene_of_interest} computed in {duration} - diff is {diff}, {n_wt} wt and {n_test} {search_mode}")
+    if verbose:
+        print(
+            f"Stats for {gene_of_interest} computed in {duration} - diff is {diff}, "
+            f"{n_wt} wt and {n_test} {search_mode}"
+        )
+    instrumentation.emit(
+        "gene",
+        gene=gene_of_interest,
+        duration=duration,
+        skipped=False,
+        n_models=choose_n,
+        n_iterations=len(test_stats),
+        n_test=n_test,
+        n_wt=n_wt,
+    )
     return {
         "test_stats": test_stats,
         "test_mean": np.array(test_stats).mean(),
@@ -144,9 +307,256 @@ def _compute_stats_for_gene(
         "n_models": choose_n,
         "n_test": len(test_columns),
         "n_wt": len(wt_columns),
+        "n_iterations": len(test_stats),
     }
 
 
+# Dependency data of a monte carlo worker process, sent once per worker instead of once per task
+_WORKER_DEP_DATA: Dict[str, pd.DataFrame] = {}
+
+# Cheap genes are batched until the batches are at most this many per worker, or cost as much as an average gene
+_BATCHES_PER_WORKER = 4
+
+
+def _init_monte_carlo_worker(dep_data: pd.DataFrame, n_threads: int, warm_up: bool):
+    _WORKER_DEP_DATA["dep_data"] = dep_data
+    # Share the cores between the workers instead of every worker starting a thread per core for the samplers
+    numba.set_num_threads(n_threads)
+    if warm_up:
+        warm_up_samplers()
+
+
+def _compute_stats_for_gene_batch(
+    gene_tasks: List[Dict[str, Any]],
+    instrumented: bool = False,
+    **shared_kwargs,
+) -> Tuple[List[Dict[str, Any]], List[Dict[str, Any]]]:
+    """
+    Compute the stats of a batch of gene tasks in a worker process, returning the results in the order of the tasks.
+    If `instrumented`, the instrumentation events of the worker are recorded and returned with the results, so that
+    the driver can pass them on to its hooks.
+    """
+    recorder = instrumentation.EventRecorder()
+    if instrumented:
+        instrumentation.add_hook(recorder)
+    try:
+        start = time.perf_counter()
+        results = [
+            _compute_stats_for_gene(dep_data=_WORKER_DEP_DATA["dep_data"], **task, **shared_kwargs)
+            for task in gene_tasks
+        ]
+        instrumentation.emit(
+            "task",
+            n_genes=len(gene_tasks),
+            duration=time.perf_counter() - start,
+            peak_rss_mb=instrumentation.peak_rss_mb(),
+        )
+    finally:
+        if instrumented:
+            instrumentation.remove_hook(recorder)
+    return results, recorder.events
+
+
+def _schedule_gene_batches(costs: Dict[Any, float], n_batches: int, max_genes: Optional[int] = None) -> List[List[Any]]:
+    """
+    Group genes into batches, most expensive first, so the stragglers start first. Batches cost at most the smaller of
+    `total cost / n_batches` and the mean cost of a gene, and hold at most `max_genes` genes. Genes costing more than
+    that form their own batch, and only cheaper genes are packed together to save task overhead. Results are returned
+    per batch, so this also bounds the work lost between checkpoints.
+    """
+    if not costs:
+        return []
+    max_cost = sum(costs.values()) / max(n_batches, len(costs), 1)
+    batches: List[List[Any]] = []
+    batch: List[Any] = []
+    batch_cost = 0.0
+    for gene in sorted(costs, key=lambda gene: -costs[gene]):
+        if batch and (batch_cost + costs[gene] > max_cost or (max_genes is not None and len(batch) >= max_genes)):
+            batches.append(batch)
+            batch, batch_cost = [], 0.0
+        batch.append(gene)
+        batch_cost += costs[gene]
+    batches.append(batch)
+    return batches
+
+
+def _run_monte_carlo_tasks(
+    make_task: Callable[[Any], Dict[str, Any]],
+    costs: Dict[Any, float],
+    dep_data: pd.DataFrame,
+    shared_kwargs: Dict[str, Any],
+    n_workers: int,
+    max_in_flight: Optional[int],
+    on_results: Callable[[Dict[Any, Dict[str, Any]]], None],
+    max_batch_genes: Optional[int] = None,
+) -> Tuple[float, float]:
+    """
+    Compute the gene tasks keyed like `costs` in spawned worker processes. Tasks are built with `make_task` when
+    their batch is submitted, and the results of every finished batch are passed to `on_results`, keyed like `costs`.
+    Batches hold at most `max_batch_genes` tasks. Returns the total time the workers spent computing and their peak
+    memory.
+    """
+    batches = iter(_schedule_gene_batches(costs, _BATCHES_PER_WORKER * n_workers, max_genes=max_batch_genes))
+    instrumented = instrumentation.is_enabled()
+    busy_time = 0.0
+    worker_peak_rss_mb = 0.0
+    in_flight: Dict[cf.Future, List[Any]] = {}
+    n_worker_threads: int = max(1, min(numba.get_num_threads(), (os.cpu_count() or 1) // n_workers))
+    with cf.ProcessPoolExecutor(
+        n_workers,
+        mp_context=mp.get_context("spawn"),
+        initializer=_init_monte_carlo_worker,
+        initargs=(dep_data, n_worker_threads, shared_kwargs["eval_function"] is genome_proximity_bias_score),
+    ) as executor:
+
+        def _submit_next() -> bool:
+            batch = next(batches, None)
+            if batch is None:
+                return False
+            gene_tasks = [make_task(key) for key in batch]
+            in_flight[executor.submit(_compute_stats_for_gene_batch, gene_tasks, instrumented, **shared_kwargs)] = batch
+            return True
+
+        while len(in_flight) < (max_in_flight or 2 * n_workers) and _submit_next():
+            pass
+        while in_flight:
+            done, _ = cf.wait(in_flight, return_when=cf.FIRST_COMPLETED)
+            for fut in done:
+                batch = in_flight.pop(fut)
+                batch_results, events = fut.result()
+                for event in events:
+                    if event["event"] == "task":
+                        busy_time += event["duration"]
+                        worker_peak_rss_mb = max(worker_peak_rss_mb, event["peak_rss_mb"])
+                    instrumentation.dispatch(event)
+                on_results(dict(zip(batch, batch_results)))
+                _submit_next()
+    return busy_time, worker_peak_rss_mb
+
+
+def _monte_carlo_params_hash(params: Dict[str, Any], data: List[pd.DataFrame]) -> str:
+    """
+    Hash the parameters of a monte carlo run together with a fingerprint of its input data, so that checkpointed
+    results are only reused by runs that would compute the same values.
+    """
+    digest = hashlib.sha1(json.dumps(params, sort_keys=True, default=str).encode())  # nosec B324 - not security
+    for df in data:
+        digest.update(pd.util.hash_pandas_object(df, index=True).to_numpy().tobytes())
+        digest.update(str(df.columns.tolist()).encode())
+    return digest.hexdigest()[:16]
+
+
+def _write_checkpoint(results: Dict[str, Dict[str, Any]], checkpoint_dir: str):
+    """Atomically write a batch of per-gene results as new parquet part files."""
+    # Genes with insufficient samples have empty results. They are written to a separate part without columns,
+    # so that they are skipped on resume without turning the columns of the other genes into nullable floats.
+    computed = {gene: result for gene, result in results.items() if result}
+    skipped = [gene for gene, result in results.items() if not result]
+    for part in (pd.DataFrame.from_dict(computed, orient="index"), pd.DataFrame(index=skipped)):
+        if part.index.empty:
+            continue
+        part_path = f"{checkpoint_dir}/part-{uuid.uuid4().hex}.parquet"
+        part.to_parquet(f"{part_path}.tmp", engine="pyarrow", index=True)
+        os.replace(f"{part_path}.tmp", part_path)
+
+
+def _load_checkpoint(checkpoint_dir: str) -> Dict[str, Dict[str, Any]]:
+    """Read all part files of a checkpoint directory back into per-gene result dicts."""
+    results: Dict[str, Dict[str, Any]] = {}
+    for part_path in sorted(glob.glob(f"{checkpoint_dir}/part-*.parquet")):
+        part = pd.read_parquet(part_path, engine="pyarrow")
+        for gene, result in part.to_dict(orient="index").items():
+            results[str(gene)] = {k: list(v) if isinstance(v, np.ndarray) else v for k, v in result.items()}
+    return results
+
+
+def merge_monte_carlo_shards(output_path: str, params_hash: Optional[str] = None) -> pd.DataFrame:
+    """
+    Combine the results written by the shards of a sharded `compute_monte_carlo_stats` run (or by a checkpointed
+    run). Genes are sorted by symbol, so the merged results do not depend on the number of shards.
+
+    Inputs:
+    -------
+    - output_path: `output_path` passed to `compute_monte_carlo_stats`
+    - params_hash: name of the run directory in `output_path`. Only needed if `output_path` holds several runs
+
+    Returns:
+    --------
+    - df: dataframe with results
+    """
+    if params_hash is None:
+        runs = sorted(run for run in os.listdir(output_path) if os.path.isdir(f"{output_path}/{run}"))
+        if len(runs) != 1:
+            raise ValueError(f"Found {len(runs)} runs in {output_path}: {runs}. Please specify `params_hash`.")
+        params_hash = runs[0]
+    results = _load_checkpoint(f"{output_path}/{params_hash}")
+    return pd.DataFrame.from_dict(results, orient="index").sort_index()
+
+
+# Parameters that only affect the results of a gene through its model split, which is part of its cache key
+_MODEL_SPLIT_PARAMS = ("cnv_cutoffs", "complete_lof", "filter_amp")
+
+
+def _results_cache_keys(
+    params: Dict[str, Any],
+    dep_data: pd.DataFrame,
+    gene_columns: Dict[str, Tuple[np.ndarray, np.ndarray, int]],
+) -> Dict[str, str]:
+    """
+    Results cache key of each gene: a hash of the run parameters, the genes in `dep_data`, the gene itself, its
+    sample size and the ordered models of its wt and test groups with the content of their dependency data columns.
+    Equal keys mean equal results, whichever release or copy number and mutation data the split came from.
+    `dep_data` is hashed after centering, whose per-gene means depend on all candidate models.
+    """
+    split_free_params = {k: v for k, v in params.items() if k not in _MODEL_SPLIT_PARAMS}
+    base = hashlib.sha1(json.dumps(split_free_params, sort_keys=True, default=str).encode())  # nosec B324
+    base.update(pd.util.hash_pandas_object(dep_data.index, index=False).to_numpy().tobytes())
+    # One hash per model over its id and its column of dependency data
+    model_hashes = pd.util.hash_pandas_object(dep_data.T, index=True).to_numpy()
+    keys = {}
+    for gene, (wt_columns, test_columns, choose_n) in gene_columns.items():
+        digest = base.copy()
+        digest.update(f"{gene}|{choose_n}|{len(wt_columns)}".encode())
+        digest.update(model_hashes[wt_columns].tobytes())
+        digest.update(model_hashes[test_columns].tobytes())
+        keys[gene] = digest.hexdigest()
+    return keys
+
+
+def _prepare_monte_carlo_inputs(
+    genes_of_interest: List[str],
+    dependency_data: pd.DataFrame,
+    cnv_data: pd.DataFrame,
+    mutation_data: pd.DataFrame,
+    candidate_models: List[str],
+    center_genes: bool,
+    dtype: Optional[str],
+) -> Tuple[pd.DataFrame, pd.Index]:
+    """Dependency data of the candidate models, cast and centered, and the genes of interest found in all inputs."""
+    columns = dependency_data.columns.intersection(candidate_models)  # type: ignore
+    # Fancy indexing makes an explicit, writable copy of the candidate columns that is cast and centered in place.
+    # Frames only expose read-only arrays under copy-on-write (the default in pandas 3), even after `.loc` or `.copy()`
+    values = dependency_data.to_numpy()[:, dependency_data.columns.get_indexer(columns)]
+    if dtype is not None:
+        values = values.astype(dtype, copy=False)
+    genes_of_interest_index = pd.Index(genes_of_interest, dtype=object)  # type: ignore
+    # TODO: test if it's okay to do this here or if I need to do it for wt/test specifically
+    if center_genes:
+        # same as center_gene_effects(..., inplace=True)
+        values -= pd.DataFrame(values, copy=False).mean(axis=1).to_numpy(dtype=values.dtype)[:, np.newaxis]
+    dep_data = pd.DataFrame(values, index=dependency_data.index, columns=columns, copy=False)
+
+    available_genes = (
+        dep_data.index.intersection(mutation_data.HugoSymbol.unique())  # type: ignore
+        .intersection(cnv_data.index)
+        .intersection(genes_of_interest_index)
+    )
+    invalid_genes = genes_of_interest_index.difference(available_genes)
+    if not invalid_genes.empty:  # type: ignore
+        print(f"{invalid_genes} not found in data.")
+    return dep_data, available_genes
+
+
 def compute_monte_carlo_stats(
     genes_of_interest: List[str],
     dependency_data: pd.DataFrame,
@@ -167,6 +577,18 @@ def compute_monte_carlo_stats(
     verbose: bool = False,
     n_workers: int = int(os.getenv("SLURM_JOB_CPUS_PER_NODE", 1)),
     fixed_cell_line_sampling: bool = False,
+    dtype: Optional[str] = None,
+    output_path: Optional[str] = None,
+    checkpoint_every: int = 10,
+    shard_index: Optional[int] = None,
+    n_shards: int = 1,
+    max_in_flight: Optional[int] = None,
+    target_ci_width: Optional[float] = None,
+    stop_on_sign: bool = False,
+    min_iterations: int = 10,
+    confidence: float = 0.95,
+    paired: bool = False,
+    results_cache: Optional[str] = None,
 ) -> pd.DataFrame:
     """
     Compute proximity bias scores for a list of genes of interest using a monte carlo approach
@@ -182,8 +604,9 @@ def compute_monte_carlo_stats(
     - search_mode: whether to search for models with a loss of function mutation
         and decreased copy number (lof) or a copy number gain (amp)
     - n_min_cell_lines: minimum number of cell lines to use for each sample
-    - n_iterations: number of iterations to perform
-    - seed: random seed
+    - n_iterations: number of iterations to perform, or the maximum number of iterations with early stopping
+    - seed: random seed. Each gene draws from its own `SeedSequence` derived from `seed` and the gene symbol,
+        so results of a gene do not depend on the other genes in the run
     - center_genes: whether to center gene effects
     - cnv_cutoffs: tuple of cutoffs for copy number gain and loss
     - eval_function: function to use for evaluating proximity bias
@@ -193,52 +616,365 @@ def compute_monte_carlo_stats(
     - verbose: whether to print progress
     - n_workers: number of workers to use for multiprocessing
     - fixed_cell_line_sampling: whether to sample the same number of cell lines for each iteration
+    - dtype: dtype of the dependency data sent to the workers, e.g. "float32" to halve memory per worker.
+        By default the dtype of `dependency_data` is kept
+    - output_path: directory to checkpoint results in. Finished genes are appended as parquet part files to
+        `{output_path}/{params_hash}`, where `params_hash` identifies the parameters and input data of the run.
+        A restarted run with the same parameters and data skips the genes that are already stored.
+        By default results are only kept in memory
+    - checkpoint_every: number of finished genes written per part file when `output_path` is set
+    - shard_index: index of the shard to process, e.g. `SLURM_ARRAY_TASK_ID`. The available genes are sorted
+        and every `n_shards`-th gene starting at `shard_index` is processed. Requires `output_path`, where all
+        shards write their results. Combine them with `merge_monte_carlo_shards`
+    - n_shards: total number of shards
+    - max_in_flight: maximum number of tasks submitted to the workers at a time, by default 2 * n_workers.
+        Genes are scheduled longest first, based on their number of sampled models and `n_iterations`,
+        and genes cheaper than average are batched into single tasks of at most `checkpoint_every` genes
+    - target_ci_width: enables early stopping. The iterations of a gene stop once the `confidence` interval of the
+        mean test - wt difference is narrower than this. The number of iterations used is stored in `n_iterations`
+    - stop_on_sign: enables early stopping once an always-valid `confidence` sequence of the difference excludes 0.
+        The sequence holds at all iterations at once, so the chance of stopping on the wrong sign is at most
+        1 - `confidence` (up to the normal approximation), even though it is checked after every iteration.
+        It is tuned to `n_iterations` and is about 1.5 times as wide as a fixed interval at that point
+    - min_iterations: minimum number of iterations before early stopping is considered
+    - confidence: confidence level of the early stopping intervals. The `target_ci_width` interval is a fixed-sample
+        interval checked after every iteration, so its actual coverage is lower than this
+    - paired: whether to evaluate the wt and test samples of an iteration with the same `eval_function` seed.
+        `genome_proximity_bias_score` then scores both on the same gene pairs, which removes the pair sampling noise
+        from the test - wt differences, so fewer iterations reach the same precision, e.g. with `target_ci_width`.
+        Only meaningful for eval functions whose random draws depend on the seed and the genes but not the models
+    - results_cache: directory of a per-gene results cache shared between runs, e.g. of consecutive DepMap releases.
+        A gene's results are reused if its wt and test models, their (centered) dependency data, the genes in the
+        dependency data and the parameters of the run are unchanged. Other genes are computed and added to the cache.
+        The number of cache hits and misses is printed. With `center_genes`, the keys hash the centered columns, and
+        centering subtracts each gene's mean over all candidate models. So any added, removed or updated candidate
+        model changes every key, and hits across releases or candidate sets are rare. The cache mainly pays off
+        with `center_genes=False` or when rerunning on the same data
 
     Returns:
     --------
     - df: dataframe with results
     """
-    dep_data = dependency_data.loc[:, dependency_data.columns.intersection(candidate_models)].copy()  # type: ignore
-    genes_of_interest_index = pd.Index(genes_of_interest, dtype=object)  # type: ignore
-    # TODO: test if it's okay to do this here or if I need to do it for wt/test specifically
-    if center_genes:
-        dep_data = center_gene_effects(dep_data)
+    run_start = time.perf_counter()
+    dep_data, available_genes = _prepare_monte_carlo_inputs(
+        genes_of_interest, dependency_data, cnv_data, mutation_data, candidate_models, center_genes, dtype
+    )
+    if shard_index is not None:
+        if output_path is None:
+            raise ValueError("Sharded runs need an `output_path` to write their results to.")
+        if not 0 <= shard_index < n_shards:
+            raise ValueError(f"`shard_index` must be in [0, {n_shards}), got {shard_index}.")
+        available_genes = available_genes.sort_values()[shard_index::n_shards]
 
-    available_genes = (
-        dep_data.index.intersection(mutation_data.HugoSymbol.values)  # type: ignore
-        .intersection(cnv_data.index)
-        .intersection(genes_of_interest_index)
+    results: Dict[str, Dict[str, Any]] = {}
+    checkpoint_dir = None
+    params = {
+        "model_sample_rate": model_sample_rate,
+        "search_mode": search_mode,
+        "n_min_cell_lines": n_min_cell_lines,
+        "n_iterations": n_iterations,
+        "seed": seed,
+        "center_genes": center_genes,
+        "cnv_cutoffs": cnv_cutoffs,
+        "eval_function": f"{eval_function.__module__}.{eval_function.__qualname__}",
+        "eval_kwargs": eval_kwargs,
+        "complete_lof": complete_lof,
+        "filter_amp": filter_amp,
+        "fixed_cell_line_sampling": fixed_cell_line_sampling,
+        "dtype": dtype,
+        "seeding": "per-gene SeedSequence",
+        "target_ci_width": target_ci_width,
+        "stop_on_sign": stop_on_sign,
+        "min_iterations": min_iterations,
+        "confidence": confidence,
+        "paired": paired,
+    }
+    if output_path is not None:
+        params_hash = _monte_carlo_params_hash(params, [dep_data, cnv_data, mutation_data])
+        checkpoint_dir = f"{output_path}/{params_hash}"
+        os.makedirs(checkpoint_dir, exist_ok=True)
+        # Shards of the same run share the directory, write the parameters atomically
+        params_tmp_path = f"{checkpoint_dir}/params.json.{uuid.uuid4().hex}.tmp"
+        with open(params_tmp_path, "w") as fh:
+            json.dump(params, fh, indent=2, default=str)
+        os.replace(params_tmp_path, f"{checkpoint_dir}/params.json")
+        results = {gene: result for gene, result in _load_checkpoint(checkpoint_dir).items() if gene in available_genes}
+        if verbose:
+            print(f"Resuming from {checkpoint_dir}: {len(results)} of {len(available_genes)} genes are done.")
+
+    prep_end = time.perf_counter()
+    instrumentation.emit("stage", stage="prep", function="compute_monte_carlo_stats", duration=prep_end - run_start)
+
+    # Only send the mutation and copy number rows of each gene to its task instead of pickling the full tables
+    mutation_rows_by_gene = mutation_data.groupby("HugoSymbol", observed=True).indices
+
+    def _gene_task(gene_of_interest: str) -> Dict[str, Any]:
+        return {
+            "gene_of_interest": gene_of_interest,
+            "cnv_data": cnv_data.loc[[gene_of_interest]],
+            "mutation_data": mutation_data.iloc[mutation_rows_by_gene[gene_of_interest]],
+            "seed": _gene_seed_sequence(seed, gene_of_interest),
+        }
+
+    pending: Dict[str, Dict[str, Any]] = {}
+    gene_columns: Dict[str, Tuple[np.ndarray, np.ndarray, int]] = {}
+    for gene_of_interest in available_genes.difference(list(results), sort=False):
+        task = _gene_task(gene_of_interest)
+        wt_columns, test_columns = _select_gene_columns(
+            gene_of_interest,
+            dep_data.columns,
+            task["cnv_data"],
+            task["mutation_data"],
+            candidate_models,
+            search_mode,
+            cnv_cutoffs,
+            complete_lof,
+            filter_amp,
+        )
+        choose_n = _gene_sample_size(
+            len(test_columns), len(wt_columns), n_min_cell_lines, model_sample_rate, fixed_cell_line_sampling
+        )
+        gene_columns[gene_of_interest] = (wt_columns, test_columns, choose_n)
+
+    cache_keys: Dict[str, str] = {}
+    cache_pending: Dict[str, Dict[str, Any]] = {}
+    if results_cache is not None:
+        os.makedirs(results_cache, exist_ok=True)
+        cache_keys = _results_cache_keys(
+            params, dep_data, {gene: columns for gene, columns in gene_columns.items() if columns[2]}
+        )
+        cached = _load_checkpoint(results_cache)
+        hits = {gene: cached[key] for gene, key in cache_keys.items() if key in cached}
+        results.update(hits)
+        pending.update(hits)
+        print(f"Results cache: {len(hits)} hits, {len(cache_keys) - len(hits)} misses.")
+        instrumentation.emit(
+            "cache", function="compute_monte_carlo_stats", hits=len(hits), misses=len(cache_keys) - len(hits)
+        )
+
+    # Estimate the cost of each gene from the number of sampled models, genes without enough models are almost free
+    costs: Dict[str, float] = {
+        gene: n_iterations * (choose_n + 1) if choose_n else 1
+        for gene, (_, _, choose_n) in gene_columns.items()
+        if gene not in results
+    }
+    instrumentation.emit(
+        "stage",
+        stage="scheduling",
+        function="compute_monte_carlo_stats",
+        duration=time.perf_counter() - prep_end,
+        n_genes=len(costs),
+    )
+    shared_kwargs: Dict[str, Any] = dict(
+        candidate_models=candidate_models,
+        cnv_cutoffs=cnv_cutoffs,
+        complete_lof=complete_lof,
+        filter_amp=filter_amp,
+        verbose=verbose,
+        search_mode=search_mode,
+        model_sample_rate=model_sample_rate,
+        n_min_cell_lines=n_min_cell_lines,
+        n_iterations=n_iterations,
+        eval_function=eval_function,
+        eval_kwargs=eval_kwargs,
+        fixed_cell_line_sampling=fixed_cell_line_sampling,
+        target_ci_width=target_ci_width,
+        stop_on_sign=stop_on_sign,
+        min_iterations=min_iterations,
+        confidence=confidence,
+        paired=paired,
     )
-    invalid_genes = genes_of_interest_index.difference(available_genes)
-    if not invalid_genes.empty:  # type: ignore
-        print(f"{invalid_genes} not found in data.")
 
-    results = {}
-    future_results = {}
-    with cf.ProcessPoolExecutor(n_workers, mp_context=mp.get_context("spawn")) as executor:
-        for gene_of_interest in available_genes:
-            fut = executor.submit(
-                _compute_stats_for_gene,
-                gene_of_interest=gene_of_interest,
-                candidate_models=candidate_models,
-                dep_data=dep_data,
-                cnv_data=cnv_data,
-                mutation_data=mutation_data,
-                cnv_cutoffs=cnv_cutoffs,
-                complete_lof=complete_lof,
-                filter_amp=filter_amp,
-                verbose=verbose,
-                search_mode=search_mode,
-                model_sample_rate=model_sample_rate,
-                n_min_cell_lines=n_min_cell_lines,
-                n_iterations=n_iterations,
-                seed=seed,
-                eval_function=eval_function,
-                eval_kwargs=eval_kwargs,
-                fixed_cell_line_sampling=fixed_cell_line_sampling,
-            )
-            future_results[fut] = gene_of_interest
-        for fut in cf.as_completed(future_results):
-            gene_of_interest = future_results[fut]
-            results[gene_of_interest] = fut.result()
+    def _collect(batch_results: Dict[str, Dict[str, Any]]):
+        results.update(batch_results)
+        pending.update(batch_results)
+        cache_pending.update({cache_keys[gene]: result for gene, result in batch_results.items() if gene in cache_keys})
+        if checkpoint_dir is not None and len(pending) >= checkpoint_every:
+            _write_checkpoint(pending, checkpoint_dir)
+            pending.clear()
+        if results_cache is not None and len(cache_pending) >= checkpoint_every:
+            _write_checkpoint(cache_pending, results_cache)
+            cache_pending.clear()
+
+    try:
+        busy_time, worker_peak_rss_mb = _run_monte_carlo_tasks(
+            _gene_task, costs, dep_data, shared_kwargs, n_workers, max_in_flight, _collect, checkpoint_every
+        )
+    finally:
+        if checkpoint_dir is not None:
+            _write_checkpoint(pending, checkpoint_dir)
+        if results_cache is not None:
+            _write_checkpoint(cache_pending, results_cache)
+    if instrumentation.is_enabled():
+        run_end = time.perf_counter()
+        instrumentation.emit(
+            "run",
+            function="compute_monte_carlo_stats",
+            duration=run_end - run_start,
+            n_genes=len(costs),
+            n_workers=n_workers,
+            # fraction of the worker time spent computing genes since the workers were started
+            worker_utilization=busy_time / (n_workers * (run_end - prep_end)) if costs else 0.0,
+            peak_rss_mb=instrumentation.peak_rss_mb(),
+            worker_peak_rss_mb=worker_peak_rss_mb,
+        )
     return pd.DataFrame.from_dict(results, orient="index")
+
+
+SWEEP_PARAMETERS = ("search_mode", "cnv_cutoffs", "complete_lof", "filter_amp")
+
+
+def sweep_monte_carlo_stats(
+    genes_of_interest: List[str],
+    dependency_data: pd.DataFrame,
+    cnv_data: pd.DataFrame,
+    mutation_data: pd.DataFrame,
+    candidate_models: List[str],
+    grid: Dict[str, List[Any]],
+    model_sample_rate: float = 0.8,
+    n_min_cell_lines: int = 25,
+    n_iterations: int = 100,
+    seed: int = 42,
+    center_genes: bool = True,
+    eval_function: Callable = genome_proximity_bias_score,
+    eval_kwargs: Dict[str, Any] = {"n_samples": 100, "n_trials": 50, "return_samples": False},
+    verbose: bool = False,
+    n_workers: int = int(os.getenv("SLURM_JOB_CPUS_PER_NODE", 1)),
+    fixed_cell_line_sampling: bool = False,
+    dtype: Optional[str] = None,
+    max_in_flight: Optional[int] = None,
+    target_ci_width: Optional[float] = None,
+    stop_on_sign: bool = False,
+    min_iterations: int = 10,
+    confidence: float = 0.95,
+    paired: bool = False,
+) -> pd.DataFrame:
+    """
+    Run `compute_monte_carlo_stats` for every combination of model split settings in `grid` at once. The models of
+    each gene are split for all settings in one pass over the copy number and mutation data, and settings that
+    split a gene into the same wild type and test models share a single evaluation. Per-gene seeds are the same as
+    in `compute_monte_carlo_stats`, so the results match separate runs with each setting.
+
+    Inputs:
+    -------
+    - grid: values to sweep, keyed by any of `search_mode`, `cnv_cutoffs`, `complete_lof` and `filter_amp`.
+        Settings missing from the grid keep the defaults of `compute_monte_carlo_stats`, e.g.
+        `{"search_mode": ["lof", "amp"], "cnv_cutoffs": [(0.6, 1.4), (0.75, 1.25)]}` sweeps 4 settings
+    - all other inputs are the same as for `compute_monte_carlo_stats`
+
+    Returns:
+    --------
+    - df: long-format dataframe with a row per setting and gene: the setting in the columns `search_mode`,
+        `cnv_cutoffs`, `complete_lof` and `filter_amp`, the gene in `gene` and the results of
+        `compute_monte_carlo_stats`. Genes with too few models for a setting have no row for it
+    """
+    unknown = set(grid).difference(SWEEP_PARAMETERS)
+    if unknown:
+        raise ValueError(f"Only {SWEEP_PARAMETERS} can be swept, got {sorted(unknown)}.")
+    axes: Dict[str, List[Any]] = {
+        "search_mode": ["lof"],
+        "cnv_cutoffs": [(CN_LOSS_CUTOFF, CN_GAIN_CUTOFF)],
+        "complete_lof": [False],
+        "filter_amp": [False],
+        **grid,
+    }
+    settings = [
+        dict(zip(SWEEP_PARAMETERS, values)) for values in itertools.product(*(axes[p] for p in SWEEP_PARAMETERS))
+    ]
+
+    run_start = time.perf_counter()
+    dep_data, available_genes = _prepare_monte_carlo_inputs(
+        genes_of_interest, dependency_data, cnv_data, mutation_data, candidate_models, center_genes, dtype
+    )
+    prep_end = time.perf_counter()
+    instrumentation.emit("stage", stage="prep", function="sweep_monte_carlo_stats", duration=prep_end - run_start)
+
+    mutation_rows_by_gene = mutation_data.groupby("HugoSymbol", observed=True).indices
+    # Distinct (gene, wt models, test models, sample size) evaluations, with the first setting that needs each
+    task_ids: Dict[Tuple[str, bytes, bytes, int], int] = {}
+    task_settings: List[Tuple[str, Dict[str, Any]]] = []
+    costs: Dict[int, float] = {}
+    rows: List[Tuple[int, str, int]] = []
+    for gene_of_interest in available_genes:
+        status = _model_status(
+            gene_of_interest,
+            dep_data.columns,
+            cnv_data,
+            mutation_data.iloc[mutation_rows_by_gene[gene_of_interest]],
+            candidate_models,
+        )
+        for setting_index, setting in enumerate(settings):
+            wt_columns, test_columns = _split_columns(status, **setting)
+            choose_n = _gene_sample_size(
+                len(test_columns), len(wt_columns), n_min_cell_lines, model_sample_rate, fixed_cell_line_sampling
+            )
+            if not choose_n:
+                continue
+            task_id = task_ids.setdefault(
+                (gene_of_interest, wt_columns.tobytes(), test_columns.tobytes(), choose_n), len(task_ids)
+            )
+            if task_id == len(task_settings):
+                task_settings.append((gene_of_interest, setting))
+                costs[task_id] = n_iterations * (choose_n + 1)
+            rows.append((setting_index, gene_of_interest, task_id))
+    instrumentation.emit(
+        "stage",
+        stage="scheduling",
+        function="sweep_monte_carlo_stats",
+        duration=time.perf_counter() - prep_end,
+        n_genes=len(available_genes),
+        n_settings=len(settings),
+        n_results=len(rows),
+        n_evaluations=len(costs),
+    )
+    if verbose:
+        print(f"{len(costs)} distinct evaluations for {len(rows)} gene / setting combinations.")
+
+    def _sweep_task(task_id: int) -> Dict[str, Any]:
+        gene_of_interest, setting = task_settings[task_id]
+        return {
+            "gene_of_interest": gene_of_interest,
+            "cnv_data": cnv_data.loc[[gene_of_interest]],
+            "mutation_data": mutation_data.iloc[mutation_rows_by_gene[gene_of_interest]],
+            "seed": _gene_seed_sequence(seed, gene_of_interest),
+            **setting,
+        }
+
+    shared_kwargs: Dict[str, Any] = dict(
+        candidate_models=candidate_models,
+        verbose=verbose,
+        model_sample_rate=model_sample_rate,
+        n_min_cell_lines=n_min_cell_lines,
+        n_iterations=n_iterations,
+        eval_function=eval_function,
+        eval_kwargs=eval_kwargs,
+        fixed_cell_line_sampling=fixed_cell_line_sampling,
+        target_ci_width=target_ci_width,
+        stop_on_sign=stop_on_sign,
+        min_iterations=min_iterations,
+        confidence=confidence,
+        paired=paired,
+    )
+    results: Dict[int, Dict[str, Any]] = {}
+    busy_time, worker_peak_rss_mb = _run_monte_carlo_tasks(
+        _sweep_task, costs, dep_data, shared_kwargs, n_workers, max_in_flight, results.update
+    )
+    if instrumentation.is_enabled():
+        run_end = time.perf_counter()
+        instrumentation.emit(
+            "run",
+            function="sweep_monte_carlo_stats",
+            duration=run_end - run_start,
+            n_evaluations=len(costs),
+            n_workers=n_workers,
+            worker_utilization=busy_time / (n_workers * (run_end - prep_end)) if costs else 0.0,
+            peak_rss_mb=instrumentation.peak_rss_mb(),
+            worker_peak_rss_mb=worker_peak_rss_mb,
+        )
+    # The setting overrides the search mode of a shared evaluation
+    return pd.DataFrame.from_records(
+        [
+            {**settings[setting_index], "gene": gene_of_interest, **results[task_id], **settings[setting_index]}
+            for setting_index, gene_of_interest, task_id in sorted(rows)
+        ]
+    )
@@ -1,24 +1,20 @@
-from typing import List, Optional, Tuple, Union
+import concurrent.futures as cf
+from typing import TYPE_CHECKING, List, Optional, Tuple, Union
 
 import numpy as np
 import pandas as pd
-from efaar_benchmarking.constants import BENCHMARK_SOURCES, N_NULL_SAMPLES, RANDOM_SEED
-from efaar_benchmarking.utils import (
-    generate_null_cossims,
-    generate_query_cossims,
-    get_benchmark_data,
-    get_feats_w_indices,
-)
-from numba import jit  # type: ignore[attr-defined]
+from numba import njit, prange  # type: ignore[attr-defined]
 from numba.typed import List as NumbaList
-from scipy.stats import combine_pvalues, spearmanr
-from sklearn.metrics.pairwise import cosine_similarity as sk_cossim
-from sklearn.utils import Bunch
-from statsmodels.stats.nonparametric import rank_compare_2indep
 
 from proxbias.utils.chromosome_info import get_chromosome_info_as_dfs, get_chromosome_info_as_dicts
 from proxbias.utils.constants import ARMS_ORD
 from proxbias.utils.cosine_similarity import cosine_similarity
+from proxbias.utils.instrumentation import stage
+
+# efaar_benchmarking, scikit-learn, statsmodels and scipy.stats take seconds to import together, so they are imported
+# by the functions that use them. This keeps importing the package, e.g. in spawned workers, cheap.
+if TYPE_CHECKING:
+    from sklearn.utils import Bunch
 
 
 def _monte_carlo_brunner_munzel(
@@ -26,6 +22,9 @@ def _monte_carlo_brunner_munzel(
     population_b_samples: np.ndarray,
     combined: bool = True,
 ) -> Union[Tuple[np.ndarray, np.ndarray], Tuple[np.float32, np.float32]]:
+    from scipy.stats import combine_pvalues
+    from statsmodels.stats.nonparametric import rank_compare_2indep
+
     n_trials = population_a_samples.shape[0]
     probability_a_greater = []
     pvalues = []
@@ -45,11 +44,14 @@ def _monte_carlo_brunner_munzel(
     return np.array(probability_a_greater), np.array(pvalues)
 
 
-def _prep_data(
+def _filter_genes_by_arm(
     gene_df: pd.DataFrame,
     min_samples_in_arm: Optional[int] = None,
-) -> Tuple[np.ndarray, pd.Series, List[np.ndarray]]:
-    gene_df = gene_df.copy()
+) -> Tuple[pd.DataFrame, pd.DataFrame]:
+    """
+    Restrict `gene_df` to genes with a known chromosome arm, on arms with more than `min_samples_in_arm` genes.
+    Returns the restricted embeddings and their gene info, indexed by the position of the gene in the embeddings.
+    """
     gene_info, _, _ = get_chromosome_info_as_dfs()
     gene_info = gene_info.loc[gene_info.index.intersection(gene_df.index)].sort_values(  # type: ignore
         "chrom_arm_name", ascending=True
@@ -64,12 +66,23 @@ def _prep_data(
         allowed_genes = gene_df.index.intersection(gene_info.index)  # type: ignore
     gene_info = gene_info.loc[allowed_genes]
     gene_df = gene_df.loc[allowed_genes]
+    # Renumber the remaining arms, so that the codes index the per-arm gene lists of the samplers
+    gene_info["chrom_arm_code"] = gene_info.chrom_arm_name.astype("category").cat.remove_unused_categories().cat.codes
 
     gene_lookup = {gene_df.index[i]: i for i in range(len(gene_df.index))}
     gene_info.index.name = "gene_name"
     gene_info["gene_code"] = gene_info.index.map(lambda x: gene_lookup[x])
     gene_info = gene_info.reset_index().set_index("gene_code").sort_index()
+    return gene_df, gene_info
+
+
+def _prep_data(
+    gene_df: pd.DataFrame,
+    min_samples_in_arm: Optional[int] = None,
+) -> Tuple[np.ndarray, pd.Series, List[np.ndarray]]:
+    from sklearn.metrics.pairwise import cosine_similarity as sk_cossim
 
+    gene_df, gene_info = _filter_genes_by_arm(gene_df, min_samples_in_arm=min_samples_in_arm)
     gigb = gene_info.groupby("chrom_arm_code")
     gene_codes_by_arm = gigb.apply(lambda x: x.index.to_numpy(dtype=np.int32)).to_list()  # type: ignore
     typed_gene_codes_by_arm = NumbaList()
@@ -80,7 +93,7 @@ def _prep_data(
     return cossims, gene_to_arm, typed_gene_codes_by_arm
 
 
-@jit(fastmath=True, nopython=True)
+@njit(fastmath=True, parallel=True, cache=True)
 def _get_intra_samples(
     cossims: np.ndarray,
     i_indices: np.ndarray,
@@ -102,21 +115,18 @@ def _get_intra_samples(
     total_samples = len(i_flat)
 
     samples = np.empty(shape=total_samples, dtype=np.float64)
-    for index in range(total_samples):
+    for index in prange(total_samples):
         i_index = i_flat[index]
         j_lookup = j_flat[index]
         arm_genes = genes_by_arm[gene_to_arm[i_index]]
-        potentials = np.take(
-            arm_genes,
-            indices=np.asarray([j_lookup, j_lookup + 1], dtype=np.int32) % len(arm_genes),
-        )
-
-        samples[index] = cossims[i_index, potentials[0] if potentials[0] != i_index else potentials[1]]
+        first = arm_genes[j_lookup % len(arm_genes)]
+        second = arm_genes[(j_lookup + 1) % len(arm_genes)]
+        samples[index] = cossims[i_index, first if first != i_index else second]
 
     return samples.reshape(original_shape)
 
 
-@jit(fastmath=True, nopython=True)
+@njit(fastmath=True, parallel=True, cache=True)
 def _get_inter_samples(
     cossims: np.ndarray,
     i_indices: np.ndarray,
@@ -130,13 +140,13 @@ def _get_inter_samples(
 
     total_samples = len(i_flat)
 
-    gene_set = set(np.arange(cossims.shape[0], dtype=np.int32))
+    # genes on other arms than each arm, in ascending gene code order
     allowed_genes_by_arm = genes_by_arm.copy()
     for arm_idx in range(len(genes_by_arm)):
-        allowed_genes_by_arm[arm_idx] = np.asarray(list(gene_set - set(genes_by_arm[arm_idx])))
+        allowed_genes_by_arm[arm_idx] = np.flatnonzero(gene_to_arm != arm_idx).astype(np.int32)
 
     samples = np.empty(shape=total_samples, dtype=np.float64)
-    for index in range(total_samples):
+    for index in prange(total_samples):
         i_index = i_flat[index]
         j_lookup = j_flat[index]
         i_arm = gene_to_arm[i_index]
@@ -146,6 +156,125 @@ def _get_inter_samples(
     return samples.reshape(original_shape)
 
 
+def warm_up_samplers():
+    """
+    Compile the pair samplers of `genome_proximity_bias_score` for float32 and float64 similarities ahead of time.
+    Compiled code is cached on disk, so later processes, e.g. spawned workers, only load it.
+    """
+    genes_by_arm = NumbaList()
+    genes_by_arm.append(np.array([0, 1], dtype=np.int32))
+    genes_by_arm.append(np.array([2, 3], dtype=np.int32))
+    gene_to_arm = np.array([0, 0, 1, 1], dtype=np.int32)
+    indices = np.zeros((1, 1), dtype=np.int32)
+    for dtype in (np.float32, np.float64):
+        cossims = np.eye(4, dtype=dtype)
+        _get_intra_samples(cossims, indices, indices, gene_to_arm, genes_by_arm)
+        _get_inter_samples(cossims, indices, indices, gene_to_arm, genes_by_arm)
+
+
+SAMPLING_DESIGNS = ("uniform", "stratified", "sobol")
+
+
+def _design_points(rng: np.random.Generator, sampling: str, n_trials: int, n_samples: int) -> np.ndarray:
+    """
+    Points in [0, 1)^2 of shape (2, n_trials, n_samples), a set of `n_samples` per trial. "stratified" draws a Latin
+    hypercube, with exactly one point per coordinate in each of `n_samples` equal strata. "sobol" takes the first
+    `n_samples` points of a scrambled Sobol sequence. Either way each point is marginally uniform.
+    """
+    if sampling == "stratified":
+        strata = rng.permuted(np.tile(np.arange(n_samples), (2, n_trials, 1)), axis=-1)
+        return (strata + rng.random(size=(2, n_trials, n_samples))) / n_samples
+    if sampling == "sobol":
+        from scipy.stats import qmc
+
+        m = int(np.ceil(np.log2(n_samples)))
+        points = np.stack([qmc.Sobol(2, seed=rng).random_base2(m)[:n_samples] for _ in range(n_trials)])
+        return np.moveaxis(points, -1, 0)
+    raise ValueError(f"sampling must be one of {SAMPLING_DESIGNS}, got {sampling}.")
+
+
+def _design_pair_indices(
+    points: np.ndarray,
+    gene_to_arm: np.ndarray,
+    genes_by_arm: List[np.ndarray],
+    intra: bool,
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Map design points to the anchor / partner lookups of the pair samplers, stratified by the arm of intra-arm pairs
+    and by the ordered pair of arms of inter-arm pairs. The strata are laid out along the first coordinate with their
+    probability under uniform sampling, size_a / N for arm a and size_a / N x size_b / (N - size_a) for arms a and b,
+    so each stratum gets its proportional share of the points, up to one point of rounding. The rounding is random
+    with the exact share as its expectation, so the sampled pairs have the same distribution as with uniform sampling
+    and need no weights. The position within the stratum picks the anchor on arm a, and the second coordinate picks
+    the partner on the same arm or on arm b.
+    """
+    arm_sizes = np.array([len(arm_genes) for arm_genes in genes_by_arm])
+    num_genes = len(gene_to_arm)
+    if intra:
+        anchor_arms = partner_arms = np.arange(len(arm_sizes))
+        weights = arm_sizes / num_genes
+    else:
+        anchor_arms, partner_arms = np.nonzero(~np.eye(len(arm_sizes), dtype=bool))
+        weights = arm_sizes[anchor_arms] * arm_sizes[partner_arms] / (num_genes * (num_genes - arm_sizes[anchor_arms]))
+    upper = np.cumsum(weights) / np.sum(weights)
+    lower = upper - weights / np.sum(weights)
+    strata = np.minimum(np.searchsorted(upper, points[0], side="right"), len(weights) - 1)
+    within = (points[0] - lower[strata]) / (upper[strata] - lower[strata])
+
+    genes_in_arm_order = np.concatenate(list(genes_by_arm))
+    arm_offsets = np.cumsum(arm_sizes) - arm_sizes
+    anchor_arm, partner_arm = anchor_arms[strata], partner_arms[strata]
+    anchor_sizes, partner_sizes = arm_sizes[anchor_arm], arm_sizes[partner_arm]
+    anchors = genes_in_arm_order[
+        arm_offsets[anchor_arm] + np.clip((within * anchor_sizes).astype(np.int64), 0, anchor_sizes - 1)
+    ]
+    partners = np.minimum((points[1] * partner_sizes).astype(np.int64), partner_sizes - 1)
+    if not intra:
+        # lookup of the partner among the genes on other arms than the anchor, in ascending gene code order
+        partner_genes = genes_in_arm_order[arm_offsets[partner_arm] + partners]
+        partners = partner_genes.astype(np.int64)
+        for arm in np.unique(anchor_arm):
+            on_arm = anchor_arm == arm
+            partners[on_arm] -= np.searchsorted(genes_by_arm[arm], partner_genes[on_arm])
+    return anchors.astype(np.int32), partners.astype(np.int32)
+
+
+def _sample_intra_inter(
+    cossims: np.ndarray,
+    gene_to_arm: np.ndarray,
+    genes_by_arm: List[np.ndarray],
+    rng: np.random.Generator,
+    n_trials: int,
+    n_samples: int,
+    sampling: str = "uniform",
+) -> Tuple[np.ndarray, np.ndarray]:
+    num_genes = cossims.shape[0]
+    if sampling == "uniform":
+        sample_indices = rng.integers(num_genes, size=(4, n_trials, n_samples), dtype=np.int32)
+    else:
+        intra_points, inter_points = (_design_points(rng, sampling, n_trials, n_samples) for _ in range(2))
+        sample_indices = np.stack(
+            _design_pair_indices(intra_points, gene_to_arm, genes_by_arm, intra=True)
+            + _design_pair_indices(inter_points, gene_to_arm, genes_by_arm, intra=False)
+        )
+
+    intra_arm_samples = _get_intra_samples(
+        cossims,
+        sample_indices[0].copy(),
+        sample_indices[1].copy(),
+        gene_to_arm,
+        genes_by_arm,
+    )
+    inter_arm_samples = _get_inter_samples(
+        cossims,
+        sample_indices[2].copy(),
+        sample_indices[3].copy(),
+        gene_to_arm,
+        genes_by_arm,
+    )
+    return intra_arm_samples, inter_arm_samples
+
+
 def genome_proximity_bias_score(
     gene_df: pd.DataFrame,
     n_trials: int = 200,
@@ -154,37 +283,479 @@ def genome_proximity_bias_score(
     return_samples: bool = True,
     combined: bool = True,
     min_samples_in_arm: int = 5,
+    target_se: Optional[float] = None,
+    batch_trials: int = 20,
+    sampling: str = "uniform",
 ) -> Union[
     Tuple[Union[np.ndarray, np.float32], Union[np.ndarray, np.float32], np.ndarray, np.ndarray],
     Tuple[Union[np.ndarray, np.float32], Union[np.ndarray, np.float32]],
+    Tuple[Union[np.ndarray, np.float32], Union[np.ndarray, np.float32], np.ndarray, np.ndarray, int],
+    Tuple[Union[np.ndarray, np.float32], Union[np.ndarray, np.float32], int],
 ]:
-    cossims, gene_to_arm, genes_by_arm = _prep_data(gene_df, min_samples_in_arm=min_samples_in_arm)
-    num_genes = cossims.shape[0]
+    """
+    Monte Carlo estimate of the probability that a random intra-arm cosine similarity is greater than a random
+    inter-arm one, from `n_trials` Brunner-Munzel tests on `n_samples` sampled pairs each.
+
+    Inputs:
+    -------
+    - gene_df: embeddings with genes as index
+    - n_trials: number of trials, or the maximum number of trials with `target_se`
+    - n_samples: number of intra- and inter-arm pairs sampled per trial
+    - seed: random seed
+    - return_samples: whether to also return the sampled cosine similarities
+    - combined: whether to return the mean probability and the Fisher-combined p-value instead of per-trial values
+    - min_samples_in_arm: genes on arms with no more genes than this are excluded
+    - target_se: enables adaptive trials. Trials are drawn in batches of `batch_trials` until the standard error of
+        the mean probability across trials is at most `target_se`, or `n_trials` are drawn.
+        The number of trials used is then returned as the last element
+    - batch_trials: number of trials per batch with `target_se`
+    - sampling: design of the sampled pairs in each trial. "uniform" draws anchor genes and their partners
+        independently. "stratified" (Latin hypercube) and "sobol" (scrambled Sobol points) allocate the intra-arm
+        pairs to arms and the inter-arm pairs to pairs of arms in proportion to their probability under uniform
+        sampling, and spread anchors and partners evenly within them. The estimand is the same. These designs only
+        remove the variance between arms, e.g. half of it when only some arms carry a proximity signal, and
+        hardly any when most of the variance is between the pairs within an arm. The p-values assume
+        independent samples and are conservative for these designs
+
+    Outputs:
+    --------
+    - probability (or per-trial probabilities) that intra-arm similarities are greater
+    - p-value (or per-trial p-values)
+    - intra- and inter-arm samples, if `return_samples`
+    - number of trials used, if `target_se` is set
+    """
+    if sampling not in SAMPLING_DESIGNS:
+        raise ValueError(f"sampling must be one of {SAMPLING_DESIGNS}, got {sampling}.")
+    with stage("prep", function="genome_proximity_bias_score"):
+        cossims, gene_to_arm, genes_by_arm = _prep_data(gene_df, min_samples_in_arm=min_samples_in_arm)
+        gene_to_arm_codes = gene_to_arm.to_numpy(dtype=np.dtype(np.int32))  # type: ignore
     rng = np.random.default_rng(seed)
-    sample_indices = rng.integers(num_genes, size=(4, n_trials, n_samples), dtype=np.int32)
+    if target_se is None:
+        with stage("sampling", function="genome_proximity_bias_score"):
+            intra_arm_samples, inter_arm_samples = _sample_intra_inter(
+                cossims, gene_to_arm_codes, genes_by_arm, rng, n_trials, n_samples, sampling
+            )
+        with stage("bm_test", function="genome_proximity_bias_score"):
+            prob_intra_greater, pvalue = _monte_carlo_brunner_munzel(
+                intra_arm_samples,
+                inter_arm_samples,
+                combined=combined,
+            )
+        if return_samples:
+            return prob_intra_greater, pvalue, intra_arm_samples, inter_arm_samples
+        return prob_intra_greater, pvalue
 
-    intra_arm_samples = _get_intra_samples(
-        cossims,
-        sample_indices[0].copy(),
-        sample_indices[1].copy(),
-        gene_to_arm.to_numpy(dtype=np.dtype(np.int32)),  # type: ignore
-        genes_by_arm,
+    from scipy.stats import combine_pvalues
+
+    intra_batches, inter_batches, prob_batches, pvalue_batches = [], [], [], []
+    n_trials_used = 0
+    while n_trials_used < n_trials:
+        n_batch = min(batch_trials, n_trials - n_trials_used)
+        with stage("sampling", function="genome_proximity_bias_score"):
+            intra_batch, inter_batch = _sample_intra_inter(
+                cossims, gene_to_arm_codes, genes_by_arm, rng, n_batch, n_samples, sampling
+            )
+        with stage("bm_test", function="genome_proximity_bias_score"):
+            prob_batch, pvalue_batch = _monte_carlo_brunner_munzel(intra_batch, inter_batch, combined=False)
+        intra_batches.append(intra_batch)
+        inter_batches.append(inter_batch)
+        prob_batches.append(prob_batch)
+        pvalue_batches.append(pvalue_batch)
+        n_trials_used += n_batch
+        probs = np.concatenate(prob_batches)
+        if n_trials_used > 1 and np.std(probs, ddof=1) / np.sqrt(n_trials_used) <= target_se:
+            break
+
+    with stage("aggregation", function="genome_proximity_bias_score"):
+        probs = np.concatenate(prob_batches)
+        pvalues = np.concatenate(pvalue_batches)
+        if combined:
+            prob_intra_greater = np.mean(probs)
+            _, pvalue = combine_pvalues(pvalues, method="fisher")
+        else:
+            prob_intra_greater, pvalue = probs, pvalues
+    if return_samples:
+        return (
+            prob_intra_greater,
+            pvalue,
+            np.concatenate(intra_batches),
+            np.concatenate(inter_batches),
+            n_trials_used,
+        )
+    return prob_intra_greater, pvalue, n_trials_used
+
+
+def _exact_prob_intra_greater(
+    embeddings: np.ndarray,
+    arm_codes: np.ndarray,
+    chunk_size: int = 1024,
+) -> Tuple[float, int, int]:
+    """
+    P(intra > inter) + 0.5 * P(intra == inter) over all gene pairs, where intra and inter are the cosine similarities
+    of pairs of genes on the same and on different arms. The intra-arm similarities (a small fraction of all pairs)
+    are computed per arm. The inter-arm similarities are computed and sorted in chunks of `chunk_size` rows, and the
+    intra-arm ones are counted against each sorted chunk, so the full similarity matrix is never held in memory.
+    Each of the N / chunk_size chunks looks up all ~N^2 / (2 x n_arms) intra-arm similarities, so the lookups take
+    O((N / chunk_size) x (N^2 / n_arms) x log N) time, on top of O(N^2 x d) for the similarities and O(N^2 log N)
+    for sorting them.
+    """
+    norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+    normed = embeddings / np.where(norms == 0, 1, norms)
+    # sorted, so that the lookups into the sorted inter-arm chunks are cache friendly
+    intra = np.sort(
+        np.concatenate(
+            [
+                (normed[arm_genes] @ normed[arm_genes].T)[np.triu_indices(len(arm_genes), 1)]
+                for arm_genes in (np.flatnonzero(arm_codes == arm) for arm in np.unique(arm_codes))
+            ]
+        )
     )
-    inter_arm_samples = _get_inter_samples(
-        cossims,
-        sample_indices[2].copy(),
-        sample_indices[3].copy(),
-        gene_to_arm.to_numpy(dtype=np.dtype(np.int32)),  # type: ignore
-        genes_by_arm,
+    n_intra = len(intra)
+    n_greater = 0.0
+    n_ties = 0.0
+    n_inter = 0
+    for start in range(0, len(normed), chunk_size):
+        rows = np.arange(start, min(start + chunk_size, len(normed)))
+        sims = normed[rows] @ normed.T
+        # upper triangle of the full matrix, on different arms
+        inter_mask = (np.arange(len(normed)) > rows[:, np.newaxis]) & (arm_codes != arm_codes[rows, np.newaxis])
+        inter = np.sort(sims[inter_mask])
+        # number of inter-arm similarities below / equal to each intra-arm one
+        below = np.searchsorted(inter, intra, side="left")
+        below_or_equal = np.searchsorted(inter, intra, side="right")
+        n_greater += np.sum(below, dtype=np.float64)
+        n_ties += np.sum(below_or_equal - below, dtype=np.float64)
+        n_inter += len(inter)
+    return (n_greater + 0.5 * n_ties) / (n_intra * n_inter), n_intra, n_inter
+
+
+def exact_genome_proximity_bias_score(
+    gene_df: pd.DataFrame,
+    min_samples_in_arm: int = 5,
+    chunk_size: int = 1024,
+) -> Tuple[float, int, int]:
+    """
+    Exact counterpart of `genome_proximity_bias_score`: the probability that the cosine similarity of a pair of genes
+    on the same arm is greater than that of a pair on different arms, over all gene pairs instead of sampled ones.
+    Unlike the sampled score, which draws genes uniformly and then a partner, every pair has the same weight.
+    Without Monte Carlo variance, with O(chunk_size x N) memory for the similarities. Time is dominated by looking up
+    every intra-arm similarity in each sorted chunk, O((N / chunk_size) x (N^2 / n_arms) x log N), plus O(N^2 x d)
+    for the similarities and O(N^2 log N) for sorting, so larger chunks trade memory for speed.
+
+    Inputs:
+    -------
+    - gene_df: embeddings with genes as index
+    - min_samples_in_arm: genes on arms with no more genes than this are excluded
+    - chunk_size: number of genes whose similarities are computed at a time
+
+    Outputs:
+    --------
+    - probability that intra-arm similarities are greater (ties count half)
+    - number of intra-arm pairs
+    - number of inter-arm pairs
+    """
+    with stage("prep", function="exact_genome_proximity_bias_score"):
+        gene_df, gene_info = _filter_genes_by_arm(gene_df, min_samples_in_arm=min_samples_in_arm)
+    with stage("bm_test", function="exact_genome_proximity_bias_score"):
+        return _exact_prob_intra_greater(
+            gene_df.to_numpy(dtype=np.float64), gene_info.chrom_arm_code.to_numpy(), chunk_size=chunk_size
+        )
+
+
+def _condensed_cosine_ranks(embeddings: np.ndarray, chunk_size: int = 1024) -> np.ndarray:
+    """
+    Ranks of the upper-triangle cosine similarities of `embeddings`, in the condensed order of
+    `scipy.spatial.distance.pdist`. Ties get their average rank. The ranks are centered and scaled to
+    (rank - (M + 1) / 2) / M for M pairs, which keeps float32 sums of many of them precise.
+    """
+    n = len(embeddings)
+    norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+    normed = embeddings / np.where(norms == 0, 1, norms)
+    sims = np.empty(n * (n - 1) // 2, dtype=np.float32)
+    for start in range(0, n, chunk_size):
+        chunk = normed[start : start + chunk_size] @ normed.T
+        for k, i in enumerate(range(start, min(start + chunk_size, n))):
+            offset = i * n - i * (i + 1) // 2
+            sims[offset : offset + n - i - 1] = chunk[k, i + 1 :]
+    order = np.argsort(sims)
+    sorted_sims = sims[order]
+    del sims
+    starts = np.flatnonzero(np.concatenate([[True], sorted_sims[1:] != sorted_sims[:-1]]))
+    del sorted_sims
+    ends = np.append(starts[1:], len(order))
+    ranks = np.empty(len(order), dtype=np.float32)
+    n_pairs = len(order)
+    ranks[order] = np.repeat(((starts + ends - 1) / 2 - (n_pairs - 1) / 2) / n_pairs, ends - starts)
+    return ranks
+
+
+@njit(cache=True)
+def _condensed_row_sums(values: np.ndarray, n: int) -> np.ndarray:
+    """Row sums of the symmetric matrix with zero diagonal whose upper triangle is `values` in condensed order."""
+    sums = np.zeros(n)
+    k = 0
+    for i in range(n):
+        for j in range(i + 1, n):
+            sums[i] += values[k]
+            sums[j] += values[k]
+            k += 1
+    return sums
+
+
+@njit(fastmath=True, parallel=True, cache=True)
+def _same_label_upper_sums(values: np.ndarray, labels: np.ndarray) -> np.ndarray:
+    """
+    For every row i and every column p of `labels` (n_genes x n_labelings), the sum of the condensed upper-triangle
+    `values` of the pairs (i, j > i) with labels[i, p] == labels[j, p].
+    """
+    n, n_labelings = labels.shape
+    sums = np.zeros((n, n_labelings))
+    # rows i and n - 1 - i together hold n - 1 pairs, which balances the work of the threads
+    for k in prange((n + 1) // 2):
+        for t in range(1 if k == n - 1 - k else 2):
+            i = np.int64(k + t * (n - 1 - 2 * k))
+            offset = i * n - i * (i + 1) // 2 - i - 1
+            acc = np.zeros(n_labelings)
+            labels_i = labels[i]
+            for j in range(i + 1, n):
+                value = values[offset + j]
+                labels_j = labels[j]
+                for p in range(n_labelings):
+                    acc[p] += value * (labels_i[p] == labels_j[p])
+            sums[i] = acc
+    return sums
+
+
+def _arm_rank_sums(
+    ranks: np.ndarray, row_sums: np.ndarray, labels: np.ndarray, n_arms: int
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Sums of the ranks of the within-arm and of the between-arm pairs of each arm, for every labeling (column) of
+    `labels`. Returns two n_labelings x n_arms arrays.
+    """
+    upper = _same_label_upper_sums(ranks, labels)
+    n_labelings = labels.shape[1]
+    # flat index of (labeling, arm) for every (gene, labeling)
+    bins = (np.arange(n_labelings) * n_arms + labels).ravel()
+    within = np.bincount(bins, weights=upper.ravel(), minlength=n_labelings * n_arms).reshape(n_labelings, n_arms)
+    total = np.bincount(bins, weights=np.repeat(row_sums, n_labelings), minlength=n_labelings * n_arms).reshape(
+        n_labelings, n_arms
     )
-    prob_intra_greater, pvalue = _monte_carlo_brunner_munzel(
-        intra_arm_samples,
-        inter_arm_samples,
-        combined=combined,
+    return within, total - 2 * within
+
+
+def arm_permutation_test(
+    gene_df: pd.DataFrame,
+    n_permutations: int = 1000,
+    seed: Optional[int] = None,
+    min_samples_in_arm: int = 5,
+    batch_size: int = 256,
+    chunk_size: int = 1024,
+) -> Tuple[pd.DataFrame, pd.DataFrame]:
+    """
+    Permutation test of proximity bias for the whole genome and each chromosome arm. The null distribution shuffles
+    the arm labels of the genes, keeping the size of every arm, so unlike the p-values of `bm_metrics` it does not
+    assume that the cosine similarities of pairs sharing a gene are independent.
+    The upper-triangle cosine similarities are ranked once. Each permutation then only sums the ranks of the pairs
+    that share a label, for `batch_size` permutations at a time in one parallel pass over the pairs. This takes
+    O(N^2 log N + N^2 x n_permutations) time and O(N^2) memory for the ranks (4 bytes per pair).
+
+    Inputs:
+    -------
+    - gene_df: embeddings with genes as index
+    - n_permutations: number of label permutations
+    - seed: random seed
+    - min_samples_in_arm: genes on arms with no more genes than this are excluded
+    - batch_size: number of permutations evaluated per pass over the pairs
+    - chunk_size: number of genes whose similarities are computed at a time
+
+    Outputs:
+    --------
+    - all_df: whole genome statistics. `prob` is the probability that a within-arm similarity is greater than a
+        between-arm one (ties count half), as the `prob` of `bm_metrics`
+    - per_arm_df: statistics of each arm. `rank_diff` is the difference between the mean rank of the within-arm
+        pairs and that of the between-arm pairs of the arm, as a fraction of the number of pairs
+
+    Both contain the observed statistic, the mean and standard deviation of its null distribution, the one-sided
+    permutation p-value (1 + #null >= observed) / (1 + n_permutations) and the numbers of pairs. per_arm_df also has
+    Bonferroni corrected p-values.
+    """
+    with stage("prep", function="arm_permutation_test"):
+        gene_df, gene_info = _filter_genes_by_arm(gene_df, min_samples_in_arm=min_samples_in_arm)
+        arm_codes = gene_info.chrom_arm_code.to_numpy(dtype=np.int16)
+        arm_names = gene_info.groupby("chrom_arm_code").chrom_arm_name.first().to_numpy()
+        n_genes, n_arms = len(arm_codes), len(arm_names)
+        ranks = _condensed_cosine_ranks(gene_df.to_numpy(dtype=np.float64), chunk_size=chunk_size)
+        row_sums = _condensed_row_sums(ranks, n_genes)
+
+    arm_sizes = np.bincount(arm_codes, minlength=n_arms)
+    n_within = arm_sizes * (arm_sizes - 1) // 2
+    n_between = arm_sizes * (n_genes - arm_sizes)
+
+    def _statistics(labels: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        within, between = _arm_rank_sums(ranks, row_sums, labels, n_arms)
+        rank_diff = within / n_within - between / n_between
+        # Mann-Whitney U of the within-arm pairs from their rank sum, the ranks being centered and scaled
+        all_within, n_all_within = within.sum(axis=1), n_within.sum()
+        n_pairs = len(ranks)
+        n_all_between = n_pairs - n_all_within
+        rank_sum = n_all_within * (n_pairs + 1) / 2 + n_pairs * all_within
+        prob = (rank_sum - n_all_within * (n_all_within + 1) / 2) / (n_all_within * n_all_between)
+        return prob, rank_diff
+
+    with stage("permutation", function="arm_permutation_test", n_permutations=1):
+        observed_prob, observed_diff = _statistics(arm_codes[:, np.newaxis])
+    rng = np.random.default_rng(seed)
+    null_prob, null_diff = [], []
+    for start in range(0, n_permutations, batch_size):
+        n_batch = min(batch_size, n_permutations - start)
+        with stage("permutation", function="arm_permutation_test", n_permutations=n_batch):
+            labels = rng.permuted(np.tile(arm_codes[:, np.newaxis], (1, n_batch)), axis=0)
+            prob, rank_diff = _statistics(labels)
+        null_prob.append(prob)
+        null_diff.append(rank_diff)
+
+    with stage("aggregation", function="arm_permutation_test"):
+        null_prob_arr = np.concatenate(null_prob)
+        null_diff_arr = np.concatenate(null_diff)
+        all_df = pd.DataFrame(
+            {
+                "prob": observed_prob[0],
+                "null_mean": null_prob_arr.mean(),
+                "null_std": null_prob_arr.std(),
+                "pval": (1 + np.sum(null_prob_arr >= observed_prob[0])) / (1 + n_permutations),
+                "n_within": n_within.sum(),
+                "n_between": len(ranks) - n_within.sum(),
+            },
+            index=["all"],
+        )
+        per_arm_df = pd.DataFrame(
+            {
+                "rank_diff": observed_diff[0],
+                "null_mean": null_diff_arr.mean(axis=0),
+                "null_std": null_diff_arr.std(axis=0),
+                "pval": (1 + np.sum(null_diff_arr >= observed_diff, axis=0)) / (1 + n_permutations),
+                "n_within": n_within,
+                "n_between": n_between,
+            },
+            index=arm_names,
+        )
+        per_arm_df = per_arm_df.assign(bonf_p=per_arm_df.pval * per_arm_df.shape[0])
+    return all_df, per_arm_df
+
+
+def _arm_within_between(
+    values: np.ndarray,
+    rows: np.ndarray,
+    in_arm: np.ndarray,
+    between_sample: Optional[np.ndarray],
+) -> Tuple[np.ndarray, np.ndarray]:
+    """Within-arm (upper triangle) and between-arm cosine similarities of the `rows` of an arm."""
+    arm_values = values[rows]
+    within = arm_values[:, in_arm][np.triu_indices(len(rows), 1)]
+    between = arm_values[:, ~in_arm].flatten()
+    if between_sample is not None:
+        between = between[between_sample]
+    return within, between
+
+
+def _arm_pair_genes(
+    rows: np.ndarray,
+    in_arm: np.ndarray,
+    col_genes: np.ndarray,
+    between_sample: Optional[np.ndarray],
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Positions in the index of the two genes of each pair returned by `_arm_within_between`, within-arm pairs first.
+    `col_genes` are the positions in the index of the genes of the columns. The positions are int32, which holds any
+    gene count and halves the memory of the pairs, kept for all arms during the bootstrap.
+    """
+    tri_rows, tri_cols = np.triu_indices(len(rows), 1)
+    out_genes = col_genes[~in_arm].astype(np.int32)
+    between_pairs = np.arange(len(rows) * len(out_genes)) if between_sample is None else between_sample
+    out_rows, out_cols = np.divmod(between_pairs, len(out_genes))
+    rows = rows.astype(np.int32)
+    first = np.concatenate([rows[tri_rows], rows[out_rows]])
+    second = np.concatenate([col_genes[in_arm].astype(np.int32)[tri_cols], out_genes[out_cols]])
+    return first, second
+
+
+def _bootstrap_gene_weights(
+    rng: np.random.Generator, arm_rows: List[np.ndarray], n_genes: int, n_replicates: int
+) -> np.ndarray:
+    """
+    Number of times each gene is drawn in each bootstrap replicate (n_replicates x n_genes + 1), resampling the genes
+    of every arm with replacement. Genes outside of the arms, and the last column, keep a weight of 1.
+    """
+    weights = np.ones((n_replicates, n_genes + 1))
+    for rows in arm_rows:
+        if len(rows) == 0:
+            continue
+        draws = rng.integers(0, len(rows), size=(n_replicates, len(rows)))
+        bins = (np.arange(n_replicates)[:, np.newaxis] * len(rows) + draws).ravel()
+        weights[:, rows] = np.bincount(bins, minlength=n_replicates * len(rows)).reshape(n_replicates, len(rows))
+    return weights
+
+
+@njit(fastmath=True, parallel=True, cache=True)
+def _weighted_prob_greater(
+    first: np.ndarray,
+    second: np.ndarray,
+    is_within: np.ndarray,
+    group_ends: np.ndarray,
+    gene_weights: np.ndarray,
+    block_size: int = 16,
+) -> np.ndarray:
+    """
+    P(within > between) + 0.5 * P(within == between) for every column r of `gene_weights` (n_genes x n_replicates),
+    where the pair of genes (first[k], second[k]) counts gene_weights[first[k], r] * gene_weights[second[k], r] times.
+    The pairs are sorted by similarity, and `group_ends` are the ends of the runs of tied similarities.
+    Each thread sweeps the pairs once for `block_size` replicates, whose weights are contiguous.
+    """
+    n_replicates = gene_weights.shape[1]
+    probs = np.empty(n_replicates)
+    for block in prange((n_replicates + block_size - 1) // block_size):
+        lo = block * block_size
+        width = min(block_size, n_replicates - lo)
+        greater = np.zeros(width)
+        below = np.zeros(width)
+        total_within = np.zeros(width)
+        group_within = np.zeros(width)
+        group_between = np.zeros(width)
+        start = 0
+        for end in group_ends:
+            group_within[:] = 0.0
+            group_between[:] = 0.0
+            for k in range(start, end):
+                within = 1.0 if is_within[k] else 0.0
+                first_weights = gene_weights[first[k], lo : lo + width]
+                second_weights = gene_weights[second[k], lo : lo + width]
+                for r in range(width):
+                    pair_weight = first_weights[r] * second_weights[r]
+                    group_within[r] += pair_weight * within
+                    group_between[r] += pair_weight - pair_weight * within
+            for r in range(width):
+                greater[r] += group_within[r] * (below[r] + 0.5 * group_between[r])
+                below[r] += group_between[r]
+                total_within[r] += group_within[r]
+            start = end
+        probs[lo : lo + width] = greater / (total_within * below)
+    return probs
+
+
+def _bootstrap_probs(
+    similarities: np.ndarray, first: np.ndarray, second: np.ndarray, is_within: np.ndarray, weights: np.ndarray
+) -> np.ndarray:
+    """
+    Brunner-Munzel probability of every bootstrap replicate (row of `weights`). The pairs are sorted once for all
+    replicates.
+    """
+    order = np.argsort(similarities, kind="stable")
+    sorted_similarities = similarities[order]
+    group_ends = np.append(np.flatnonzero(sorted_similarities[1:] != sorted_similarities[:-1]) + 1, len(order))
+    return _weighted_prob_greater(
+        first[order], second[order], is_within[order], group_ends, np.ascontiguousarray(weights.T)
     )
-    if return_samples:
-        return prob_intra_greater, pvalue, intra_arm_samples, inter_arm_samples
-    return prob_intra_greater, pvalue
 
 
 def bm_metrics(
@@ -192,10 +763,18 @@ def bm_metrics(
     arms_ord: list = ARMS_ORD,
     verbose: bool = False,
     sample_frac: float = 1.0,
+    n_workers: int = 1,
+    n_bootstrap: int = 0,
+    ci: float = 0.95,
+    seed: Optional[int] = None,
 ) -> Tuple[pd.DataFrame, pd.DataFrame]:
     """
     Calculate Brunner-Munzel statistics for the whole genome and each chromosome arm
     Arms with less than 20 within-arm pairs are skipped.
+    With `n_bootstrap`, percentile bootstrap confidence intervals of `prob` are added as `prob_ci_low` and
+    `prob_ci_high`. The genes of every arm are resampled with replacement, and a replicate weighs each pair of distinct
+    genes by the product of the number of times they are drawn. The pairs are sorted once, and the replicates only
+    reweigh them, in parallel.
 
     Inputs:
     -------
@@ -204,47 +783,74 @@ def bm_metrics(
     - arms_ord: list or chromosome arm names in order. These should match names in the index/columns of df
     - verbose: whether to print progress
     - sample_frac: factor to downsample between-arm relationships in bigger datasets
+    - n_workers: number of threads evaluating arms concurrently. All arms read from the same array of
+          similarities, and the results do not depend on the number of threads
+    - n_bootstrap: number of bootstrap replicates, 0 for no confidence intervals
+    - ci: confidence level of the intervals
+    - seed: random seed of the bootstrap
 
     Outputs:
     --------
     - bm_all_df: dataframe of statistics for the whole genome tests
     - bm_per_arm_df: dataframe of statistics for each chromosome arm
     """
-    bm_per_arm = {}
-    all_within = []
-    all_between = []
+    from statsmodels.stats.nonparametric import rank_compare_2indep
 
+    values = df.to_numpy()
+    arm_labels = df.index.get_level_values("chromosome_arm")
+    arm_inputs = []
     for arm in arms_ord:
-        arm_mat = df.query(f'chromosome_arm=="{arm}"')
-        ind = np.array([x in arm_mat.index for x in arm_mat.columns])
-        within = arm_mat.values[:, ind][np.triu_indices(arm_mat.shape[0], 1)]
-        between = arm_mat.values[:, ~ind].flatten()
-        if verbose:
-            print(arm, within.shape, between.shape)
-        within_l = len(within)
-        between_l = len(between)
+        rows = np.flatnonzero(arm_labels == arm)
+        in_arm = df.columns.isin(df.index[rows])
+        between_l = len(rows) * int(np.sum(~in_arm))
+        between_sample = None
         if sample_frac < 1 and between_l > 10000:
-            # Sample the between relationships to save memory
-            between = np.random.choice(between, int(between_l * sample_frac))
-        all_within.append(within)
-        all_between.append(between)
-        if within_l > 20 and between_l > 20:
+            # Sample the between relationships to save memory. The indices are drawn here, in arm order, so that the
+            # samples do not depend on `n_workers`. These are the draws of `np.random.choice(between, n)`.
+            between_sample = np.random.randint(0, between_l, int(between_l * sample_frac))
+        arm_inputs.append((arm, rows, in_arm, between_sample))
+
+    def _evaluate_arm(
+        arm: str, rows: np.ndarray, in_arm: np.ndarray, between_sample: Optional[np.ndarray]
+    ) -> Tuple[np.ndarray, np.ndarray, Optional[tuple]]:
+        with stage("sampling", function="bm_metrics", arm=arm):
+            within, between = _arm_within_between(values, rows, in_arm, between_sample)
+        within_l = len(within)
+        between_l = len(rows) * int(np.sum(~in_arm))
+        if within_l <= 20 or between_l <= 20:
+            return within, between, None
+        with stage("bm_test", function="bm_metrics", arm=arm):
             bm_result = rank_compare_2indep(within, between, use_t=False)
-            bm_per_arm[arm] = (
+        return (
+            within,
+            between,
+            (
                 bm_result.statistic,
                 bm_result.prob1,
                 bm_result.test_prob_superior(alternative="larger").pvalue,
                 within_l,
                 between_l,
-            )
+            ),
+        )
 
-    bm_per_arm_df = pd.DataFrame(bm_per_arm).T
-    bm_per_arm_df.columns = ["stat", "prob", "pval", "n_within", "n_between"]  # type: ignore
-    bm_per_arm_df = bm_per_arm_df.assign(bonf_p=bm_per_arm_df.pval * bm_per_arm_df.shape[0])
+    if n_workers > 1:
+        with cf.ThreadPoolExecutor(n_workers) as executor:
+            arm_results = list(executor.map(lambda args: _evaluate_arm(*args), arm_inputs))
+    else:
+        arm_results = [_evaluate_arm(*args) for args in arm_inputs]
+    if verbose:
+        for (arm, rows, in_arm, _), (within, _, _) in zip(arm_inputs, arm_results):
+            print(arm, within.shape, (len(rows) * int(np.sum(~in_arm)),))
 
-    all_w = np.concatenate(all_within)
-    all_b = np.concatenate(all_between)
-    bm_result = rank_compare_2indep(all_w, all_b, use_t=False)
+    with stage("aggregation", function="bm_metrics"):
+        bm_per_arm = {arm: result for (arm, *_), (_, _, result) in zip(arm_inputs, arm_results) if result is not None}
+        bm_per_arm_df = pd.DataFrame(bm_per_arm).T
+        bm_per_arm_df.columns = ["stat", "prob", "pval", "n_within", "n_between"]  # type: ignore
+        bm_per_arm_df = bm_per_arm_df.assign(bonf_p=bm_per_arm_df.pval * bm_per_arm_df.shape[0])
+        all_w = np.concatenate([within for within, _, _ in arm_results])
+        all_b = np.concatenate([between for _, between, _ in arm_results])
+    with stage("bm_test", function="bm_metrics", arm="all"):
+        bm_result = rank_compare_2indep(all_w, all_b, use_t=False)
     bm_all = {
         "stat": bm_result.statistic,
         "prob": bm_result.prob1,
@@ -254,9 +860,103 @@ def bm_metrics(
     }
     bm_all_df = pd.DataFrame(bm_all, index=["all"])
 
+    if n_bootstrap > 0:
+        with stage("bootstrap", function="bm_metrics", n_bootstrap=n_bootstrap):
+            rng = np.random.default_rng(seed)
+            weights = _bootstrap_gene_weights(rng, [rows for _, rows, _, _ in arm_inputs], len(df), n_bootstrap)
+            # columns missing from the index get the last weight, which is always 1
+            col_genes = df.index.get_indexer(df.columns)
+            pools = []
+            for (_, rows, in_arm, between_sample), (within, between, _) in zip(arm_inputs, arm_results):
+                first, second = _arm_pair_genes(rows, in_arm, col_genes, between_sample)
+                pools.append((np.concatenate([within, between]), first, second, np.arange(len(first)) < len(within)))
+            quantiles = [(1 - ci) / 2, (1 + ci) / 2]
+            arm_cis = {
+                arm: np.nanquantile(_bootstrap_probs(*pool, weights), quantiles)
+                for (arm, *_), pool, (_, _, result) in zip(arm_inputs, pools, arm_results)
+                if result is not None
+            }
+            similarities, first, second, is_within = (np.concatenate(parts) for parts in zip(*pools))
+            all_cis = np.nanquantile(_bootstrap_probs(similarities, first, second, is_within, weights), quantiles)
+        bm_all_df = bm_all_df.assign(prob_ci_low=all_cis[0], prob_ci_high=all_cis[1])
+        bm_per_arm_df = bm_per_arm_df.assign(
+            prob_ci_low=[arm_cis[arm][0] for arm in bm_per_arm_df.index],
+            prob_ci_high=[arm_cis[arm][1] for arm in bm_per_arm_df.index],
+        )
+
     return bm_all_df, bm_per_arm_df
 
 
+def arm_mean_cosine_similarity(
+    df: pd.DataFrame,
+    arms_ord: list = ARMS_ORD,
+) -> Tuple[pd.DataFrame, pd.DataFrame, pd.DataFrame]:
+    """
+    Exact mean cosine similarities between and within chromosome arms, computed from the embeddings in O(N x d)
+    without any pairwise similarity matrix. With S_A the sum of the unit vectors of the genes of arm A, the mean
+    similarity between arms A and B is S_A . S_B / (|A| |B|), and the mean over the pairs of distinct genes of arm A
+    is (|S_A|^2 - |A|) / (|A| (|A| - 1)). This makes a quick proximity bias screen possible where the N x N matrices
+    of `bm_metrics` do not fit in memory.
+
+    Inputs:
+    -------
+    - df: embeddings with genes as rows. Index should contain `chromosome_arm`
+    - arms_ord: list of chromosome arm names in order. These should match names in the index of df
+
+    Outputs:
+    --------
+    - all_df: mean similarity of all within-arm and all between-arm pairs, as in the whole genome test of `bm_metrics`
+    - per_arm_df: for each arm, the mean similarity of the pairs of distinct genes of the arm (`within`), of the
+        pairs of a gene of the arm with a gene elsewhere (`between`), their difference and the number of genes
+    - arm_cos_df: arm x arm dataframe of mean similarities, with the within-arm means on the diagonal
+    """
+    with stage("prep", function="arm_mean_cosine_similarity"):
+        values = df.to_numpy(dtype=np.float64)
+        norms = np.linalg.norm(values, axis=1, keepdims=True)
+        unit = values / np.where(norms == 0, 1, norms)
+        arm_labels = df.index.get_level_values("chromosome_arm")
+        present = set(arm_labels)
+        arms = [arm for arm in arms_ord if arm in present]
+        arm_codes = pd.Categorical(arm_labels, categories=arms).codes
+    with stage("segment_sums", function="arm_mean_cosine_similarity"):
+        order = np.argsort(arm_codes, kind="stable")
+        # arms absent from arms_ord have code -1 and are sorted first
+        bounds = np.searchsorted(arm_codes[order], np.arange(len(arms) + 1))
+        arm_sums = np.add.reduceat(unit[order], bounds[:-1], axis=0) if arms else np.zeros((0, unit.shape[1]))
+        # the self similarity of a gene is 1, or 0 for a zero vector
+        self_sums = np.add.reduceat(np.sum(unit[order] ** 2, axis=1), bounds[:-1]) if arms else np.zeros(0)
+        total_sum = unit.sum(axis=0)
+    with stage("aggregation", function="arm_mean_cosine_similarity"):
+        n_genes = np.diff(bounds)
+        dots = arm_sums @ arm_sums.T
+        within_sums = (np.diag(dots) - self_sums) / 2
+        n_within = n_genes * (n_genes - 1) // 2
+        between_sums = arm_sums @ total_sum - np.diag(dots)
+        n_between = n_genes * (len(df) - n_genes)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            arm_cos = dots / np.outer(n_genes, n_genes)
+            within = within_sums / n_within
+            between = between_sums / n_between
+        np.fill_diagonal(arm_cos, within)
+        arm_cos_df = pd.DataFrame(arm_cos, index=arms, columns=arms)
+        per_arm_df = pd.DataFrame(
+            {"within": within, "between": between, "diff": within - between, "n_genes": n_genes}, index=arms
+        )
+        all_within = within_sums.sum() / n_within.sum()
+        all_between = between_sums.sum() / n_between.sum()
+        all_df = pd.DataFrame(
+            {
+                "within": all_within,
+                "between": all_between,
+                "diff": all_within - all_between,
+                "n_within": n_within.sum(),
+                "n_between": n_between.sum(),
+            },
+            index=["all"],
+        )
+    return all_df, per_arm_df, arm_cos_df
+
+
 def compute_gene_bm_metrics(
     df: pd.DataFrame,
     min_n_genes: int = 20,
@@ -275,29 +975,34 @@ def compute_gene_bm_metrics(
     --------
     - bm_per_gene_df : DataFrame of Brunner-Munzel test results per gene.
     """
+    from statsmodels.stats.nonparametric import rank_compare_2indep
+
     bm_per_row = []
     index_level_names = df.index.names
     for chrom_arm, chrom_arm_df in df.groupby("chromosome_arm"):
         if chrom_arm_df.shape[0] >= min_n_genes:
-            other_arms_df = df.query(f'chromosome_arm != "{chrom_arm!r}"')
-            inter_cos_df = cosine_similarity(chrom_arm_df, other_arms_df)
-            intra_cos_df = cosine_similarity(chrom_arm_df)
-            for idx, row in chrom_arm_df.iterrows():  # type: ignore
-                inter_cos = inter_cos_df.loc[idx].values  # type: ignore
-                intra_cos = intra_cos_df.loc[idx].drop(idx).values  # type: ignore
-                bm_result = rank_compare_2indep(intra_cos, inter_cos, use_t=False)
-                bm_dict = {
-                    "stat": bm_result.statistic,
-                    "prob": bm_result.prob1,
-                    "pval": bm_result.test_prob_superior(alternative="larger").pvalue,
-                    "n_within": intra_cos.shape[0],
-                    "n_between": inter_cos.shape[0],
-                }
-                for idx_level_name, idx_val in zip(index_level_names, idx):  # type: ignore
-                    bm_dict[idx_level_name] = idx_val
-                row_bm = pd.Series(bm_dict)
-                bm_per_row.append(row_bm)
-    bm_per_gene_df = pd.concat(bm_per_row, axis=1).T.set_index(index_level_names)
+            with stage("prep", function="compute_gene_bm_metrics", arm=chrom_arm):
+                other_arms_df = df.query(f'chromosome_arm != "{chrom_arm!r}"')
+                inter_cos_df = cosine_similarity(chrom_arm_df, other_arms_df)
+                intra_cos_df = cosine_similarity(chrom_arm_df)
+            with stage("bm_test", function="compute_gene_bm_metrics", arm=chrom_arm):
+                for idx, row in chrom_arm_df.iterrows():  # type: ignore
+                    inter_cos = inter_cos_df.loc[idx].values  # type: ignore
+                    intra_cos = intra_cos_df.loc[idx].drop(idx).values  # type: ignore
+                    bm_result = rank_compare_2indep(intra_cos, inter_cos, use_t=False)
+                    bm_dict = {
+                        "stat": bm_result.statistic,
+                        "prob": bm_result.prob1,
+                        "pval": bm_result.test_prob_superior(alternative="larger").pvalue,
+                        "n_within": intra_cos.shape[0],
+                        "n_between": inter_cos.shape[0],
+                    }
+                    for idx_level_name, idx_val in zip(index_level_names, idx):  # type: ignore
+                        bm_dict[idx_level_name] = idx_val
+                    row_bm = pd.Series(bm_dict)
+                    bm_per_row.append(row_bm)
+    with stage("aggregation", function="compute_gene_bm_metrics"):
+        bm_per_gene_df = pd.concat(bm_per_row, axis=1).T.set_index(index_level_names)
     return bm_per_gene_df
 
 
@@ -320,6 +1025,8 @@ def compute_bm_centro_telo_rank_correlations(
     - arm_corr_df : DataFrame of Spearman correlation results per arm
     - sample_sizes_table : Numbers of genes used for each arm
     """
+    from scipy.stats import spearmanr
+
     arm2corr = {}
     arm2sample_size = {}
     for chrom_arm, arm_df in bm_per_gene_df.groupby("chromosome_arm"):
@@ -355,6 +1062,89 @@ def compute_bm_centro_telo_rank_correlations(
     return arm_corr_df, sample_sizes_table
 
 
+def local_proximity_bias_track(
+    gene_df: pd.DataFrame,
+    n_neighbors: int = 20,
+) -> Tuple[pd.DataFrame, pd.DataFrame]:
+    """
+    Positional track of proximity bias along the chromosomes. For each gene, the mean cosine similarity to its
+    `n_neighbors` nearest genes in genomic order on the same chromosome arm (`local`) is compared with its mean
+    similarity to the genes on other arms (`background`). The window is centered on the gene and shifted to stay
+    within the arm, and covers the whole arm for arms with at most `n_neighbors` other genes. Both means are dot
+    products with prefix sums of the unit vectors, so the track takes O(N x d) time.
+
+    Inputs:
+    -------
+    - gene_df: embeddings with genes as index
+    - n_neighbors: number of neighboring genes averaged per gene
+
+    Outputs:
+    --------
+    - track_df: per gene in genomic order, its chromosome, arm, coordinates and cytoband, `local`, `background`,
+        their difference `diff` and the number of neighbors used
+    - band_df: per cytoband in genomic order, the means of `local`, `background` and `diff` and the number of genes
+    """
+    with stage("prep", function="local_proximity_bias_track"):
+        gene_info, _, bands = get_chromosome_info_as_dfs()
+        gene_info = gene_info.loc[gene_info.index.isin(gene_df.index)].sort_values(
+            ["chrom_int", "chrom_arm_int", "start", "end"], kind="stable"
+        )
+        values = gene_df.loc[gene_info.index].to_numpy(dtype=np.float64)
+        norms = np.linalg.norm(values, axis=1, keepdims=True)
+        unit = values / np.where(norms == 0, 1, norms)
+        # bounds of the arm of each gene, in genomic order
+        first_of_arm = gene_info.chrom_arm_name.ne(gene_info.chrom_arm_name.shift()).to_numpy()
+        arm_codes = np.cumsum(first_of_arm) - 1
+        arm_bounds = np.append(np.flatnonzero(first_of_arm), len(first_of_arm))
+        arm_start, arm_end = arm_bounds[arm_codes], arm_bounds[arm_codes + 1]
+
+    with stage("track", function="local_proximity_bias_track"):
+        prefix = np.vstack([np.zeros((1, unit.shape[1])), np.cumsum(unit, axis=0)])
+        positions = np.arange(len(unit))
+        window = np.minimum(n_neighbors + 1, arm_end - arm_start)
+        start = np.clip(positions - n_neighbors // 2, arm_start, arm_end - window)
+        self_sims = np.sum(unit**2, axis=1)
+        local_sums = np.einsum("ij,ij->i", unit, prefix[start + window] - prefix[start]) - self_sims
+        arm_sums = prefix[arm_end] - prefix[arm_start]
+        background_sums = np.einsum("ij,ij->i", unit, prefix[-1] - arm_sums)
+        with np.errstate(divide="ignore", invalid="ignore"):
+            local = local_sums / (window - 1)
+            background = background_sums / (len(unit) - (arm_end - arm_start))
+
+    with stage("aggregation", function="local_proximity_bias_track"):
+        track_df = (
+            gene_info[["chrom", "chrom_arm_name", "start", "end"]]
+            .rename_axis("gene")
+            .assign(local=local, background=background, diff=local - background, n_neighbors=window - 1)
+        )
+        bands = bands.sort_values("band_start")
+        track_df["band"] = (
+            pd.merge_asof(
+                track_df.reset_index().sort_values("start"),
+                bands[["chrom", "name", "band_start"]],
+                left_on="start",
+                right_on="band_start",
+                by="chrom",
+            )
+            .set_index("gene")
+            .name
+        )
+        band_df = (
+            track_df.groupby(["chrom", "band"], sort=False)
+            .agg(
+                chrom_arm_name=("chrom_arm_name", "first"),
+                start=("start", "min"),
+                end=("end", "max"),
+                local=("local", "mean"),
+                background=("background", "mean"),
+                diff=("diff", "mean"),
+                n_genes=("diff", "size"),
+            )
+            .reset_index()
+        )
+    return track_df, band_df
+
+
 def _compute_recall(null_cossims, query_cossims, pct_thresholds) -> dict:
     null_sorted = np.sort(null_cossims)
     percentiles = np.searchsorted(null_sorted, query_cossims) / len(null_sorted)
@@ -362,7 +1152,7 @@ def _compute_recall(null_cossims, query_cossims, pct_thresholds) -> dict:
 
 
 def compute_within_cross_arm_pairwise_metrics(
-    data: Bunch,
+    data: "Bunch",
     pert_label_col: str = "gene",
     pct_thresholds: list = [0.05, 0.95],
 ) -> tuple:
@@ -383,6 +1173,14 @@ def compute_within_cross_arm_pairwise_metrics(
     tuple
         Results for within-arm and cross-arm pairs, respectively.
     """
+    from efaar_benchmarking.constants import BENCHMARK_SOURCES, N_NULL_SAMPLES, RANDOM_SEED
+    from efaar_benchmarking.utils import (
+        generate_null_cossims,
+        generate_query_cossims,
+        get_benchmark_data,
+        get_feats_w_indices,
+    )
+
     np.random.seed(RANDOM_SEED)
     within = {}
     between = {}
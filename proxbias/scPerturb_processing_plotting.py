@@ -1,26 +1,25 @@
-import itertools
 import os
 from ast import literal_eval
 from re import findall
-from typing import List, Optional
+from typing import TYPE_CHECKING, Dict, List, Optional, Tuple
 
-import infercnvpy
-import matplotlib.pyplot as plt
 import numpy as np
 import pandas as pd
-import scanpy
-import seaborn as sns
-import wget
-from scanpy import AnnData
-from scipy.stats import zscore
-from skimage.measure import block_reduce
 from tqdm.auto import tqdm
 
-from proxbias import utils
+from proxbias import cnv_smoothing, utils
+from proxbias.utils.instrumentation import stage
+
+# scanpy, infercnvpy, scipy.stats and the plotting libraries take seconds to import, so they are imported by the
+# functions that use them rather than at module load.
+if TYPE_CHECKING:
+    from anndata import AnnData
+
+CNV_ENGINES = ("infercnvpy", "native")
 
 
 def _compute_chromosomal_loss(
-    anndat: AnnData,
+    anndat: "AnnData",
     blocksize: int,
     neigh: int = 150,
     frac_cutoff: float = 0.7,
@@ -49,88 +48,101 @@ def _compute_chromosomal_loss(
         pd.DataFrame: DataFrame containing the computed loss values.
 
     """
-    avar = anndat.var
-    cnvarr = anndat.obsm["X_cnv"].toarray() <= cnv_cutoff
-    pert_genes = list(set(anndat.obs.gene).intersection(avar.index))
-    pert_gene_chr_arm = {
-        x: y for x, y in {x: tuple(avar.loc[x][["chromosome", "arm"]]) for x in pert_genes}.items() if not pd.isna(y[0])
-    }
-    pert_genes_w_chr_info = pert_gene_chr_arm.keys()
-    list_aff, list_ko = zip(*itertools.product(pert_genes_w_chr_info, pert_genes))
-
-    loss = pd.DataFrame({"ko_gene": list_ko, "aff_gene": list_aff})
-    loss["ko_chr"] = loss.ko_gene.apply(lambda x: pert_gene_chr_arm[x][0] if x in pert_gene_chr_arm else None)
-    loss["ko_arm"] = loss.ko_gene.apply(lambda x: pert_gene_chr_arm[x][1] if x in pert_gene_chr_arm else None)
-    loss["aff_chr"] = loss.aff_gene.apply(lambda x: pert_gene_chr_arm[x][0])
-    loss["aff_arm"] = loss.aff_gene.apply(lambda x: pert_gene_chr_arm[x][1])
-
-    sorted_genes_on_chr = {}
-    start_block_of_chr = {}
-    end_block_of_chr = {}
-    for c in set(map(lambda chr_arm: chr_arm[0], pert_gene_chr_arm.values())):
-        sorted_genes_on_chr[c] = list(avar[avar.chromosome == c].sort_values("start").index)
-        start_block_of_chr[c] = anndat.uns["cnv"]["chr_pos"][c]
-        end_block_of_chr[c] = start_block_of_chr[c] + len(sorted_genes_on_chr[c]) // blocksize
-
-    ko_gene_ixs_dict = {ko_gene: anndat.obs.gene == ko_gene for ko_gene in pert_genes}
-    ko_gene_sum_dict = {ko_gene: sum(ixs) for ko_gene, ixs in ko_gene_ixs_dict.items()}
-
-    loss_5p_cells: List[List[str]] = [[]] * len(loss)
-    loss_5p_ko_cell_count = np.empty(len(loss))
-    loss_5p_ko_cell_frac = np.empty(len(loss))
-    loss_3p_cells: List[List[str]] = [[]] * len(loss)
-    loss_3p_ko_cell_count = np.empty(len(loss))
-    loss_3p_ko_cell_frac = np.empty(len(loss))
-    i5p = 0
-    i3p = 0
-
-    for aff_gene in tqdm(pert_genes_w_chr_info):
-        aff_chr = pert_gene_chr_arm[aff_gene][0]
-        # get all genes in the same chromosome with the KO gene, sorted
-        sorted_genes = sorted_genes_on_chr[aff_chr]
-        # get position of the gene in the chromosome
-        aff_gene_ordpos = sorted_genes.index(aff_gene)
-        # get block position of the gene in the chromosome
-        aff_gene_blocknum_ = aff_gene_ordpos // blocksize
-        # get start block of the chromosome gene is in
-        aff_chr_startblocknum = start_block_of_chr[aff_chr]
-        # get end block of the chromosome gene is in
-        aff_chr_endblocknum = end_block_of_chr[aff_chr]
-        # get block position of the gene in the genome
-        aff_gene_blocknum = aff_chr_startblocknum + aff_gene_blocknum_
-
-        block_count_5p = min(int(neigh / blocksize) - 1, aff_gene_blocknum - aff_chr_startblocknum)
-        block_count_3p = min(int(neigh / blocksize) - 1, aff_chr_endblocknum - aff_gene_blocknum)
-
-        blocks_5p = np.arange(aff_gene_blocknum - block_count_5p, aff_gene_blocknum + 1)
-        blocks_3p = np.arange(aff_gene_blocknum, aff_gene_blocknum + block_count_3p + 1)
-
-        for t, blocks in {"5p": blocks_5p, "3p": blocks_3p}.items():
-            low_frac = np.sum(cnvarr[:, blocks], axis=1) / len(blocks)
-            for ko_gene in pert_genes:
-                ko_gene_ixs = ko_gene_ixs_dict[ko_gene]
-                cells = list(anndat.obs.index[(low_frac >= frac_cutoff) & ko_gene_ixs])
-                if t == "5p":
-                    loss_5p_cells[i5p] = cells
-                    loss_5p_ko_cell_count[i5p] = len(cells)
-                    loss_5p_ko_cell_frac[i5p] = len(cells) / ko_gene_sum_dict[ko_gene]
-                    i5p += 1
-                elif t == "3p":
-                    loss_3p_cells[i3p] = cells
-                    loss_3p_ko_cell_count[i3p] = len(cells)
-                    loss_3p_ko_cell_frac[i3p] = len(cells) / ko_gene_sum_dict[ko_gene]
-                    i3p += 1
-
-    loss["loss5p_cells"] = loss_5p_cells
-    loss["loss3p_cells"] = loss_3p_cells
-    loss["loss5p_cellcount"] = loss_5p_ko_cell_count
-    loss["loss3p_cellcount"] = loss_3p_ko_cell_count
-    loss["loss5p_cellfrac"] = loss_5p_ko_cell_frac
-    loss["loss3p_cellfrac"] = loss_3p_ko_cell_frac
+    with stage("prep", function="_compute_chromosomal_loss"):
+        avar = anndat.var
+        cnvarr = anndat.obsm["X_cnv"].toarray() <= cnv_cutoff
+        pert_genes = pd.Index(list(set(anndat.obs.gene).intersection(avar.index)))
+        gene_pos = _get_gene_block_positions(avar, pert_genes, anndat.uns["cnv"]["chr_pos"], blocksize)
+        n_ko = len(pert_genes)
+        aff_codes = pert_genes.get_indexer(gene_pos.index)
+
+        # Rows are all (aff_gene, ko_gene) pairs with aff_gene in the outer loop, built from codes into `pert_genes`
+        ko_rep = np.tile(np.arange(n_ko), len(aff_codes))
+        aff_rep = np.repeat(aff_codes, n_ko)
+        pert_chr = pd.Categorical(avar.loc[pert_genes, "chromosome"].where(pert_genes.isin(gene_pos.index)))
+        pert_arm = pd.Categorical(avar.loc[pert_genes, "arm"].where(pert_genes.isin(gene_pos.index)))
+        loss = pd.DataFrame(
+            {
+                "ko_gene": pd.Categorical.from_codes(ko_rep, categories=pert_genes),
+                "aff_gene": pd.Categorical.from_codes(aff_rep, categories=pert_genes),
+                "ko_chr": pd.Categorical.from_codes(pert_chr.codes[ko_rep], categories=pert_chr.categories),
+                "ko_arm": pd.Categorical.from_codes(pert_arm.codes[ko_rep], categories=pert_arm.categories),
+                "aff_chr": pd.Categorical.from_codes(pert_chr.codes[aff_rep], categories=pert_chr.categories),
+                "aff_arm": pd.Categorical.from_codes(pert_arm.codes[aff_rep], categories=pert_arm.categories),
+            }
+        )
+
+        cell_ko_codes = pert_genes.get_indexer(anndat.obs.gene)
+        ko_cell_counts = np.bincount(cell_ko_codes[cell_ko_codes >= 0], minlength=n_ko)
+        cell_names = anndat.obs.index.to_numpy()
+        max_blocks = int(neigh / blocksize) - 1
+
+    with stage("loss", function="_compute_chromosomal_loss"):
+        loss_cells: Dict[str, List[List[str]]] = {"5p": [], "3p": []}
+        loss_cell_count = {t: np.empty(len(loss)) for t in loss_cells}
+        for row, aff in enumerate(tqdm(gene_pos.itertuples(), total=len(gene_pos))):
+            block_count_5p = min(max_blocks, aff.block - aff.chr_start_block)
+            block_count_3p = min(max_blocks, aff.chr_end_block - aff.block)
+            blocks_5p = np.arange(aff.block - block_count_5p, aff.block + 1)
+            blocks_3p = np.arange(aff.block, aff.block + block_count_3p + 1)
+
+            for t, blocks in {"5p": blocks_5p, "3p": blocks_3p}.items():
+                low_frac = np.sum(cnvarr[:, blocks], axis=1) / len(blocks)
+                hit = (low_frac >= frac_cutoff) & (cell_ko_codes >= 0)
+                hit_codes = cell_ko_codes[hit]
+                hit_cells = cell_names[hit]
+                counts = np.bincount(hit_codes, minlength=n_ko)
+                cells_by_ko = np.split(hit_cells[np.argsort(hit_codes, kind="stable")], np.cumsum(counts)[:-1])
+                loss_cells[t].extend(list(cells) for cells in cells_by_ko)
+                loss_cell_count[t][row * n_ko : (row + 1) * n_ko] = counts
+
+    with stage("aggregation", function="_compute_chromosomal_loss"):
+        for t in loss_cells:
+            loss[f"loss{t}_cells"] = loss_cells[t]
+        for t in loss_cells:
+            loss[f"loss{t}_cellcount"] = loss_cell_count[t]
+        for t in loss_cells:
+            loss[f"loss{t}_cellfrac"] = loss_cell_count[t] / ko_cell_counts[ko_rep]
 
     return loss
 
 
+def _get_gene_block_positions(
+    avar: pd.DataFrame,
+    genes: pd.Index,
+    chr_pos: Dict[str, int],
+    blocksize: int,
+) -> pd.DataFrame:
+    """
+    Build a lookup table with the chromosome, arm, ordinal position and CNV block of each gene in `genes` that has
+    chromosome information. Ordinal positions are ranks by start position among all genes of `avar` on the same
+    chromosome, and blocks are the corresponding column in the CNV matrix as generated by infercnv.
+
+    Args:
+        avar (pd.DataFrame): AnnData `var` DataFrame with "chromosome", "arm" and "start" columns.
+        genes (pd.Index): Genes to look up.
+        chr_pos (Dict[str, int]): Mapping of chromosome to its first CNV block, i.e. `anndat.uns["cnv"]["chr_pos"]`.
+        blocksize (int): Block size that was used for computing the CNV values.
+
+    Returns:
+        pd.DataFrame: DataFrame indexed by gene, in the order of `genes`, with the columns "chromosome", "arm",
+            "ordpos", "block", "chr_start_block" and "chr_end_block".
+    """
+    gene_pos = avar.loc[genes, ["chromosome", "arm"]]
+    gene_pos = gene_pos.loc[~gene_pos.chromosome.isna()].copy()
+    gene_pos["ordpos"] = 0
+    gene_pos["chr_start_block"] = 0
+    gene_pos["chr_end_block"] = 0
+    for c in gene_pos.chromosome.unique():
+        sorted_genes_on_chr = avar[avar.chromosome == c].sort_values("start").index
+        on_chr = gene_pos.chromosome == c
+        gene_pos.loc[on_chr, "ordpos"] = sorted_genes_on_chr.get_indexer(gene_pos.index[on_chr])
+        gene_pos.loc[on_chr, "chr_start_block"] = chr_pos[c]
+        gene_pos.loc[on_chr, "chr_end_block"] = chr_pos[c] + len(sorted_genes_on_chr) // blocksize
+    gene_pos["block"] = gene_pos.chr_start_block + gene_pos.ordpos // blocksize
+    return gene_pos
+
+
 def _get_chromosome_info() -> pd.DataFrame:
     """
     Retrieve chromosome information for genes and return it as a DataFrame.
@@ -144,7 +156,51 @@ def _get_chromosome_info() -> pd.DataFrame:
     return pd.DataFrame.from_dict(gene_dict, orient="index").rename(columns={"chrom": "chromosome"})
 
 
-def apply_infercnv_and_save_loss_info(filename: str, blocksize: int = 5, window: int = 100, neigh: int = 150) -> None:
+def _apply_infercnv(anndat: "AnnData", reference_key: str, blocksize: int, window: int, cnv_engine: str) -> None:
+    """
+    Compute CNV values for the given AnnData object in place, using control cells as the reference.
+
+    Args:
+        anndat (AnnData): AnnData object with log-normalized expression and gene positions in `var`.
+        reference_key (str): Column in `anndat.obs` that marks the control cells with the value "control".
+        blocksize (int): Step size between CNV windows.
+        window (int): Window size for the running mean.
+        cnv_engine (str): Either "infercnvpy" to run `infercnvpy.tl.infercnv` or "native" to use the cumulative-sum
+            implementation in `proxbias.cnv_smoothing`.
+
+    Returns:
+        None
+
+    Raises:
+        ValueError: If `cnv_engine` is not one of CNV_ENGINES.
+    """
+    if cnv_engine == "infercnvpy":
+        import infercnvpy
+
+        infercnvpy.tl.infercnv(
+            anndat,
+            reference_key=reference_key,
+            reference_cat="control",
+            window_size=window,
+            step=blocksize,
+            exclude_chromosomes=None,
+        )
+    elif cnv_engine == "native":
+        cnv_smoothing.infercnv(
+            anndat,
+            reference_key=reference_key,
+            reference_cat="control",
+            window_size=window,
+            step=blocksize,
+            exclude_chromosomes=None,
+        )
+    else:
+        raise ValueError(f"cnv_engine must be one of {CNV_ENGINES}, got {cnv_engine}.")
+
+
+def apply_infercnv_and_save_loss_info(
+    filename: str, blocksize: int = 5, window: int = 100, neigh: int = 150, cnv_engine: str = "infercnvpy"
+) -> None:
     """
     Apply infercnv and compute loss info on the given data file, and save the results.
     The function loads and processes the data file using the _load_and_process_data() function, applies
@@ -159,6 +215,7 @@ def apply_infercnv_and_save_loss_info(filename: str, blocksize: int = 5, window:
         blocksize (int, optional): Block size for infercnv analysis. Default is 5.
         window (int, optional): Window size for infercnv analysis. Default is 100.
         neigh (int, optional): Number of neighboring genes to consider in loss computation. Default is 150.
+        cnv_engine (str, optional): CNV implementation to use, "infercnvpy" or "native". Default is "infercnvpy".
 
     Returns:
         None
@@ -166,18 +223,11 @@ def apply_infercnv_and_save_loss_info(filename: str, blocksize: int = 5, window:
     res_path = _get_infercnv_result_file_path(filename, blocksize, window, neigh)
     if not os.path.exists(res_path):
         anndat = _load_and_process_data(filename)
-        infercnvpy.tl.infercnv(
-            anndat,
-            reference_key="perturbation_label",
-            reference_cat="control",
-            window_size=window,
-            step=blocksize,
-            exclude_chromosomes=None,
-        )
+        _apply_infercnv(anndat, "perturbation_label", blocksize, window, cnv_engine)
         _compute_chromosomal_loss(anndat, blocksize, neigh).to_csv(res_path, index=False)
 
 
-def _load_and_process_data(filename: str, chromosome_info: Optional[pd.DataFrame] = None) -> AnnData:
+def _load_and_process_data(filename: str, chromosome_info: Optional[pd.DataFrame] = None) -> "AnnData":
     """
     Load and process the specified file prior to applying `infercnv()`
     The result of the processing is an AnnData object with a 'perturbation_label'
@@ -198,6 +248,8 @@ def _load_and_process_data(filename: str, chromosome_info: Optional[pd.DataFrame
     print(filename)
     destination_path = os.path.join(str(utils.constants.DATA_DIR), f"{filename}.h5ad")
     if not os.path.exists(destination_path):
+        import wget
+
         source_path = f"https://zenodo.org/record/7416068/files/{filename}.h5ad?download=1"
         wget.download(source_path, destination_path)
     ad = read_and_log_transform_h5ad_file(destination_path)
@@ -316,7 +368,12 @@ def _get_short_filename(filename: str) -> str:
 
 
 def generate_specific_loss_and_summary_tables(
-    filenames: List[str], blocksize: int = 5, window: int = 100, neigh: int = 150, zscore_cutoff: float = 3.0
+    filenames: List[str],
+    blocksize: int = 5,
+    window: int = 100,
+    neigh: int = 150,
+    zscore_cutoff: float = 3.0,
+    cnv_engine: str = "infercnvpy",
 ) -> None:
     """
     Generates and saves summary chromosomal loss results based on a list of scPerturb AnnData files.
@@ -334,6 +391,7 @@ def generate_specific_loss_and_summary_tables(
         window (int, optional): Window size for infercnv analysis. Defaults to 100.
         neigh (int, optional): Neighbor parameter for loss computation. Defaults to 150.
         zscore_cutoff (float, optional): The loss z-score cutoff value for filtering specific loss. Defaults to 3.0.
+        cnv_engine (str, optional): CNV implementation to use, "infercnvpy" or "native". Defaults to "infercnvpy".
 
     Returns:
         None
@@ -342,9 +400,10 @@ def generate_specific_loss_and_summary_tables(
         >>> filenames = ["PapalexiSatija2021_eccite_RNA", "TianKampmann2021_CRISPRi"]
         >>> generate_specific_loss_and_summary_tables(filenames)
     """
+    from scipy.stats import zscore
 
     for filename in filenames:
-        apply_infercnv_and_save_loss_info(filename, blocksize, window, neigh)
+        apply_infercnv_and_save_loss_info(filename, blocksize, window, neigh, cnv_engine)
     spec_genes_dict = {}
     for filename in filenames:
         res = pd.read_csv(_get_infercnv_result_file_path(filename, blocksize, window, neigh))
@@ -533,7 +592,7 @@ def _get_perturbation_type(filename_short: str):
     }[filename_short]
 
 
-def read_and_log_transform_h5ad_file(filename: str) -> AnnData:
+def read_and_log_transform_h5ad_file(filename: str) -> "AnnData":
     """
     Read and log-transform the specified h5ad single-cell perturb-seq file.
 
@@ -543,17 +602,66 @@ def read_and_log_transform_h5ad_file(filename: str) -> AnnData:
     Returns:
         AnnData: The log-transformed dataset as an AnnData object.
     """
+    import scanpy
+
     ad = scanpy.read_h5ad(filename)
     scanpy.pp.log1p(ad)
     return ad
 
 
+def _stack_loss_cells(
+    ad: "AnnData",
+    res: pd.DataFrame,
+    perts2check_df: pd.DataFrame,
+    perts2check: List[str],
+    blocksize: int,
+) -> Tuple[np.ndarray, List[int], List[int]]:
+    """
+    Gather the CNV values of the cells with specific loss for each perturbation in `perts2check`, stacked in the order
+    of `perts2check`. All cell indices are collected first so that the CNV matrix is sliced and densified only once.
+
+    Args:
+        ad (AnnData): AnnData object with CNV values in `obsm["X_cnv"]`.
+        res (pd.DataFrame): Loss table as generated by `_compute_chromosomal_loss()`, read from CSV.
+        perts2check_df (pd.DataFrame): Rows of the specific loss table for the perturbations to plot.
+        perts2check (List[str]): Perturbed genes to plot.
+        blocksize (int): Block size that was used for computing the CNV values.
+
+    Returns:
+        Tuple[np.ndarray, List[int], List[int]]: Stacked cells x blocks CNV values, the cumulative cell counts marking
+            the end of each perturbation's rows, and the CNV block of each perturbed gene.
+
+    Raises:
+        KeyError: If loss cells in `res` are not in `ad`.
+    """
+    loss_cell_inds = []
+    for p in perts2check:
+        res_p = res[(res.ko_gene == p) & (res.aff_gene == p)]
+        direcs = list(perts2check_df[perts2check_df["Perturbed gene"] == p]["Tested loss direction"])
+        loss_cells: List[str] = sum([literal_eval(res_p[f"loss{d[0]}p_cells"].iloc[0]) for d in direcs], [])
+        inds = ad.obs.index.get_indexer(loss_cells)
+        if (inds < 0).any():
+            missing = [cell for cell, ind in zip(loss_cells, inds) if ind < 0]
+            raise KeyError(f"Loss cells of {p} are not in the AnnData object: {missing}")
+        loss_cell_inds.append(inds)
+    all_inds = np.concatenate(loss_cell_inds)
+    x_cnv = ad.obsm["X_cnv"]
+    loss_arr = np.empty((len(all_inds), x_cnv.shape[1]), dtype=x_cnv.dtype)
+    x_cnv[all_inds].toarray(out=loss_arr)
+    loss_seps = np.cumsum([len(inds) for inds in loss_cell_inds]).tolist()
+    gene_pos = _get_gene_block_positions(ad.var, pd.Index(perts2check), ad.uns["cnv"]["chr_pos"], blocksize)
+    return loss_arr, loss_seps, gene_pos.block.loc[perts2check].tolist()
+
+
 def plot_loss_for_selected_genes(
     filenames: List[str],
     chromosome_info: Optional[pd.DataFrame] = None,
     blocksize: int = 5,
     window: int = 100,
     neigh: int = 150,
+    cnv_engine: str = "infercnvpy",
+    rasterized: bool = True,
+    dpi: int = 150,
 ) -> None:
     """
     Plot the specific losses using infercnv analysis for the given list of filenames.
@@ -563,6 +671,8 @@ def plot_loss_for_selected_genes(
     with specific loss in the `allres.csv`. Also applies a filter to only plot genes passing the cell count threshold.
     Heatmaps are generated to visualize the CNV values and specific block numbers are marked on the heatmaps.
     The resulting plots are saved as SVG files with filenames corresponding to the original filenames and displayed.
+    By default the heatmap cells are embedded as a single raster image in the SVG, while the axes, labels and marker
+    lines stay vector graphics, which keeps the file size manageable for large numbers of cells.
 
     The function depends on several helper functions, such as _get_chromosome_info(),  _get_short_filename(),
     _get_infercnv_result_file(), and _get_mid_ticks().
@@ -573,6 +683,9 @@ def plot_loss_for_selected_genes(
         blocksize (int, optional): Block size for infercnv analysis. Defaults to 5.
         window (int, optional): Window size for infercnv analysis. Defaults to 100.
         neigh (int, optional): Number of neighboring genes to consider in loss computation. Defaults to 150.
+        cnv_engine (str, optional): CNV implementation to use, "infercnvpy" or "native". Defaults to "infercnvpy".
+        rasterized (bool, optional): Whether to render the heatmap as a raster image inside the SVG. Defaults to True.
+        dpi (int, optional): Resolution of the rasterized heatmap. Defaults to 150.
 
     Returns:
         None
@@ -582,6 +695,10 @@ def plot_loss_for_selected_genes(
     """
     if chromosome_info is None:
         chromosome_info = _get_chromosome_info()
+    import matplotlib.pyplot as plt
+    import seaborn as sns
+    from skimage.measure import block_reduce
+
     allres = pd.read_csv(get_specific_loss_file_path())
     sns.set(font_scale=1.7)
     plt.rcParams["svg.fonttype"] = "none"
@@ -603,49 +720,19 @@ def plot_loss_for_selected_genes(
             ad.obs["gene"] = ad.obs.perturbation.apply(lambda x: x if x != "control" else "").fillna("").astype(str)
         ad.obs.loc[ad.obs.perturbation == "control", "gene"] = "control"
         ad = ad[ad.obs.gene.isin(perts2check + ["control"])]
-        infercnvpy.tl.infercnv(
-            ad,
-            reference_key="gene",
-            reference_cat="control",
-            window_size=window,
-            step=blocksize,
-            exclude_chromosomes=None,
-        )
+        _apply_infercnv(ad, "gene", blocksize, window, cnv_engine)
         res = pd.read_csv(_get_infercnv_result_file_path(filename, blocksize, window, neigh))
-        loss_arrs: List[float] = []
-        other_arrs: List[float] = []
-        loss_seps: List[int] = []
-        other_seps: List[int] = []
-        blocknums = []
-        for p in perts2check:
-            res_p = res[(res.ko_gene == p) & (res.aff_gene == p)]
-            direcs = list(perts2check_df[perts2check_df["Perturbed gene"] == p]["Tested loss direction"])
-            loss_cell_inds: List[str] = sum(
-                [[ad.obs.index.get_loc(x) for x in literal_eval(res_p[f"loss{d[0]}p_cells"].iloc[0])] for d in direcs],
-                [],
-            )
-            other_cell_inds = list(
-                set(ad.obs.index.get_loc(x) for x in ad.obs.loc[ad.obs.gene == p].index).difference(loss_cell_inds)
-            )
-            arr1 = ad.obsm["X_cnv"].toarray()[loss_cell_inds]
-            arr2 = ad.obsm["X_cnv"].toarray()[other_cell_inds]
-            aff_chr = ad.var.loc[p].chromosome
-            aff_chr_startblocknum = ad.uns["cnv"]["chr_pos"][aff_chr]
-            blocknum_p = (
-                aff_chr_startblocknum
-                + ad.var[ad.var.chromosome == aff_chr].sort_values("start").index.get_loc(p) // blocksize
-            )
-            blocknums.append(blocknum_p)
-            loss_arrs = arr1 if len(loss_arrs) == 0 else np.concatenate((loss_arrs, arr1), axis=0)
-            other_arrs = arr2 if len(other_arrs) == 0 else np.concatenate((other_arrs, arr2), axis=0)
-            loss_seps.append(len(loss_cell_inds) if len(loss_seps) == 0 else len(loss_cell_inds) + loss_seps[-1])
-            other_seps.append(len(other_cell_inds) if len(other_seps) == 0 else len(other_cell_inds) + other_seps[-1])
+        loss_arr, loss_seps, blocknums = _stack_loss_cells(ad, res, perts2check_df, perts2check, blocksize)
 
         crunch = _get_crunch_size(filename_short)
-        plt.figure(figsize=[20, int(loss_seps[-1] / 15)])  # type: ignore[arg-type]
-        tmp = block_reduce(loss_arrs, (1, crunch), np.mean)
+        plt.figure(figsize=[20, int(loss_seps[-1] / 15)])
+        tmp = block_reduce(loss_arr, (1, crunch), np.mean)
         ax = sns.heatmap(
-            tmp, cmap="seismic", center=0, cbar_kws=dict(use_gridspec=False, location="top", shrink=0.5, pad=0.01)
+            tmp,
+            cmap="seismic",
+            center=0,
+            cbar_kws=dict(use_gridspec=False, location="top", shrink=0.5, pad=0.01),
+            rasterized=rasterized,
         )
         x_tick_loc = _get_mid_ticks(list(ad.uns["cnv"]["chr_pos"].values()) + [ad.obsm["X_cnv"].shape[1]])
         x_tick_lab = list(ad.uns["cnv"]["chr_pos"].keys())
@@ -660,5 +747,5 @@ def plot_loss_for_selected_genes(
         for j in ad.uns["cnv"]["chr_pos"].values():
             ax.vlines(j / crunch, *ax.get_ylim())
         plt.gcf().set_facecolor("white")
-        plt.savefig(f"{filename}.svg", format="svg", bbox_inches="tight")
+        plt.savefig(f"{filename}.svg", format="svg", bbox_inches="tight", dpi=dpi)
         plt.show()
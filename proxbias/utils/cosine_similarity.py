@@ -2,7 +2,6 @@ from typing import Optional, Union
 
 import numpy as np
 import pandas as pd
-from sklearn.metrics.pairwise import cosine_similarity as sk_cosine_sim
 
 
 def cosine_similarity(
@@ -11,6 +10,9 @@ def cosine_similarity(
     as_long: bool = False,
     triu: bool = False,
 ) -> Union[pd.DataFrame, pd.Series]:
+    # scikit-learn takes over a second to import, so only load it once needed
+    from sklearn.metrics.pairwise import cosine_similarity as sk_cosine_sim
+
     index = a.index.copy()
     if isinstance(b, pd.DataFrame) and not b.empty:
         if triu:
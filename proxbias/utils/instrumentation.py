@@ -0,0 +1,108 @@
+import json
+import os
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from typing import Any, Callable, Dict, Iterator, List, Optional
+
+Hook = Callable[[Dict[str, Any]], None]
+
+_HOOKS: List[Hook] = []
+
+
+def add_hook(hook: Hook):
+    """
+    Register `hook` to receive instrumentation events. Each event is a dict with at least the keys
+    `event` (the event type, e.g. "stage" or "gene"), `time` (unix timestamp) and `pid`.
+    """
+    _HOOKS.append(hook)
+
+
+def remove_hook(hook: Hook):
+    _HOOKS.remove(hook)
+
+
+def is_enabled() -> bool:
+    return bool(_HOOKS)
+
+
+def emit(event: str, **fields):
+    """Send an event to all registered hooks. Does nothing if no hook is registered."""
+    if not _HOOKS:
+        return
+    dispatch({"event": event, "time": time.time(), "pid": os.getpid(), **fields})
+
+
+def dispatch(record: Dict[str, Any]):
+    """Send an already formed event, e.g. one recorded in a worker process, to all registered hooks."""
+    for hook in list(_HOOKS):
+        hook(record)
+
+
+@contextmanager
+def stage(name: str, **fields) -> Iterator[None]:
+    """Time the enclosed block and emit a "stage" event with its `duration` in seconds."""
+    if not _HOOKS:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        emit("stage", stage=name, duration=time.perf_counter() - start, **fields)
+
+
+def peak_rss_mb() -> float:
+    """Peak resident set size of the current process in MiB, NaN where it is not available."""
+    try:
+        import resource
+    except ImportError:  # Windows
+        return float("nan")
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # bytes on macOS, KiB on Linux
+    return peak / 2**20 if sys.platform == "darwin" else peak / 2**10
+
+
+class JsonLinesLog:
+    """Hook appending events as JSON lines to `path`."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def __call__(self, record: Dict[str, Any]):
+        line = json.dumps(record, default=str)
+        with self._lock, open(self.path, "a") as fh:
+            fh.write(line + "\n")
+
+
+class EventRecorder:
+    """Hook collecting events in memory, e.g. to send the events of a worker process back to the driver."""
+
+    def __init__(self):
+        self.events: List[Dict[str, Any]] = []
+
+    def __call__(self, record: Dict[str, Any]):
+        self.events.append(record)
+
+
+@contextmanager
+def instrument(hook: Optional[Hook] = None, log_path: Optional[str] = None) -> Iterator[None]:
+    """
+    Enable instrumentation for the enclosed block, sending events to `hook` and/or appending them to the
+    JSON-lines file `log_path`.
+
+    Examples
+    --------
+    >>> with instrument(log_path="run.jsonl"):
+    >>>     res = compute_monte_carlo_stats(...)
+    """
+    hooks = ([hook] if hook is not None else []) + ([JsonLinesLog(log_path)] if log_path is not None else [])
+    for h in hooks:
+        add_hook(h)
+    try:
+        yield
+    finally:
+        for h in hooks:
+            remove_hook(h)
@@ -0,0 +1,113 @@
+import numpy as np
+import pandas as pd
+import pytest
+import scipy.sparse
+from packaging.version import Version
+from scanpy import AnnData
+
+from proxbias.cnv_smoothing import _running_mean, infercnv
+
+
+def _convolve_running_mean(x, window_size, step, mode="same"):
+    if window_size >= x.shape[1]:
+        if mode == "valid":
+            return x.mean(axis=1, keepdims=True)
+        r = np.arange(1, x.shape[1] + 1)
+        pyramid = np.minimum(r, r[::-1])
+        return (x @ pyramid.reshape(-1, 1)) / pyramid.sum()
+    r = np.arange(1, window_size + 1)
+    pyramid = np.minimum(r, r[::-1])
+    smoothed = np.apply_along_axis(lambda row: np.convolve(row, pyramid, mode=mode), axis=1, arr=x)
+    return smoothed[:, ::step] / pyramid.sum()
+
+
+@pytest.mark.parametrize("mode", ["same", "valid"])
+def test_running_mean(mode):
+    rng = np.random.default_rng(0)
+    x = rng.normal(size=(7, 53))
+    for window_size in [1, 4, 9, 20, 53, 80]:
+        for step in [1, 3, 5]:
+            np.testing.assert_allclose(
+                _running_mean(x, window_size, step, mode),
+                _convolve_running_mean(x, window_size, step, mode),
+                atol=1e-10,
+            )
+
+
+def _small_adata():
+    rng = np.random.default_rng(0)
+    n_cells, n_genes = 60, 400
+    x = scipy.sparse.random(n_cells, n_genes, density=0.2, random_state=0, format="csr", dtype=np.float32)
+    starts = rng.permutation(n_genes)
+    var = pd.DataFrame(
+        {
+            "chromosome": rng.choice(["chr1", "chr2", "chr10", "chr21"], size=n_genes, p=[0.5, 0.3, 0.18, 0.02]),
+            "start": starts,
+            "end": starts + 1,
+        },
+        index=[f"gene{i}" for i in range(n_genes)],
+    )
+    obs = pd.DataFrame({"label": ["control"] * 20 + ["ko"] * 40}, index=[f"cell{i}" for i in range(n_cells)])
+    return AnnData(x, obs=obs, var=var)
+
+
+def test_infercnv():
+    adata = _small_adata()
+    x, var = adata.X.copy(), adata.var
+    n_cells = adata.shape[0]
+    infercnv(adata, reference_key="label", reference_cat="control", window_size=20, step=5, chunksize=25)
+
+    dense = x.toarray()
+    centered = np.clip(dense - dense[:20].mean(axis=0), -3, 3)
+    chromosomes = ["chr1", "chr2", "chr10", "chr21"]
+    blocks = [
+        _convolve_running_mean(
+            centered[:, var.index.get_indexer(var[var.chromosome == c].sort_values("start").index)], 20, 5
+        )
+        for c in chromosomes
+    ]
+    expected_pos = dict(zip(chromosomes, np.cumsum([0] + [b.shape[1] for b in blocks])))
+    assert adata.uns["cnv"]["chr_pos"] == expected_pos
+
+    expected_chunks = []
+    for start in range(0, n_cells, 25):
+        smoothed = np.hstack(blocks)[start : start + 25]
+        smoothed = smoothed - np.median(smoothed, axis=1)[:, np.newaxis]
+        smoothed[np.abs(smoothed) < 1.5 * np.std(smoothed)] = 0
+        expected_chunks.append(smoothed)
+    np.testing.assert_allclose(adata.obsm["X_cnv"].toarray(), np.vstack(expected_chunks), atol=1e-5)
+
+
+def test_infercnv_invalid_mode():
+    with pytest.raises(ValueError):
+        infercnv(_small_adata(), reference_key="label", reference_cat="control", mode="full")
+
+
+def test_infercnv_parity():
+    infercnvpy = pytest.importorskip("infercnvpy")
+    # infercnvpy switched from "same" to "valid" convolution in 0.5.0
+    mode = "same" if Version(infercnvpy.__version__) < Version("0.5") else "valid"
+    expected = _small_adata()
+    infercnvpy.tl.infercnv(
+        expected,
+        reference_key="label",
+        reference_cat="control",
+        window_size=20,
+        step=5,
+        exclude_chromosomes=None,
+        chunksize=25,
+        n_jobs=1,
+    )
+    adata = _small_adata()
+    infercnv(
+        adata,
+        reference_key="label",
+        reference_cat="control",
+        window_size=20,
+        step=5,
+        exclude_chromosomes=None,
+        chunksize=25,
+        mode=mode,
+    )
+    assert adata.uns["cnv"]["chr_pos"] == expected.uns["cnv"]["chr_pos"]
+    np.testing.assert_allclose(adata.obsm["X_cnv"].toarray(), expected.obsm["X_cnv"].toarray(), atol=1e-5)
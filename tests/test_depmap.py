@@ -0,0 +1,612 @@
+import hashlib
+import itertools
+import threading
+import urllib.error
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+import pandas as pd
+import pyarrow.parquet as pq
+import pytest
+
+from proxbias.depmap.constants import (
+    CN_GAIN_CUTOFF,
+    CN_LOSS_CUTOFF,
+    CNV_FILENAME,
+    COMPLETE_LOF_MUTATION_TYPES,
+    CRISPR_DEPENDENCY_EFFECT_FILENAME,
+    MUTATION_FILENAME,
+)
+from proxbias.depmap.fetch import download_file, fetch_release_files, get_release_files
+from proxbias.depmap.load import (
+    _cache_matrix,
+    _cache_mutations,
+    _format_model_by_gene,
+    _load_cached_matrix,
+    _load_cached_mutations,
+    center_gene_effects,
+    get_depmap_data,
+    load_gene_mutations,
+)
+from proxbias.depmap.process import (
+    _compute_stats_for_gene,
+    _is_settled,
+    _schedule_gene_batches,
+    _select_gene_columns,
+    compute_monte_carlo_stats,
+    merge_monte_carlo_shards,
+    split_models,
+    sweep_monte_carlo_stats,
+)
+from proxbias.utils.instrumentation import instrument
+
+
+class _RangeHandler(BaseHTTPRequestHandler):
+    files: dict = {}
+    requests: list = []
+
+    def do_GET(self):
+        self.requests.append((self.path, self.headers.get("Range")))
+        body = self.files.get(self.path)
+        if body is None:
+            self.send_error(404)
+            return
+        start = 0
+        if self.headers.get("Range"):
+            start = int(self.headers["Range"].split("=")[1].rstrip("-"))
+            self.send_response(206)
+        else:
+            self.send_response(200)
+        self.send_header("Content-Length", str(len(body) - start))
+        self.end_headers()
+        self.wfile.write(body[start:])
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def http_server():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), _RangeHandler)
+    _RangeHandler.files = {}
+    _RangeHandler.requests = []
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield f"http://127.0.0.1:{server.server_address[1]}", _RangeHandler
+    server.shutdown()
+
+
+def test_format_model_by_gene():
+    raw = pd.DataFrame(
+        [[0.1, -1.0], [0.2, -0.5], [0.3, 0.0]],
+        index=["ACH-1", "ACH-2", "ACH-3"],
+        columns=["TP53 (7157)", "A1BG (1)"],
+    )
+    formatted = _format_model_by_gene(raw)
+    assert formatted.index.tolist() == ["TP53", "A1BG"]
+    assert formatted.columns.tolist() == ["ACH-1", "ACH-2", "ACH-3"]
+    assert formatted.columns.name == "ModelID"
+    assert formatted.loc["A1BG", "ACH-2"] == -0.5
+
+
+def test_matrix_cache_roundtrip(tmp_path):
+    df = pd.DataFrame(
+        np.arange(6, dtype=np.float64).reshape(2, 3),
+        index=pd.Index(["TP53", "A1BG"]),
+        columns=pd.Index(["ACH-1", "ACH-2", "ACH-3"], name="ModelID"),
+    )
+    path = f"{tmp_path}/CRISPRGeneEffect"
+    _cache_matrix(df, path)
+    pd.testing.assert_frame_equal(_load_cached_matrix(path), df)
+    mapped = _load_cached_matrix(path, mmap_mode="r")
+    assert not mapped.values.flags.writeable
+    pd.testing.assert_frame_equal(mapped, df)
+
+
+def test_center_gene_effects_inplace():
+    rng = np.random.default_rng(0)
+    df = pd.DataFrame(rng.normal(size=(20, 8)), columns=[f"ACH-{i}" for i in range(8)])
+    df.iloc[3, 2] = np.nan
+    expected = center_gene_effects(df)
+    df32 = df.astype("float32")
+    values = df32.to_numpy()
+    centered = center_gene_effects(df32, inplace=True)
+    assert centered is df32
+    assert centered.dtypes.eq(np.float32).all()
+    assert np.shares_memory(values, centered.to_numpy())
+    np.testing.assert_allclose(centered, expected, atol=1e-6)
+
+    read_only = np.zeros((2, 2))
+    read_only.flags.writeable = False
+    with pytest.raises(ValueError):
+        center_gene_effects(pd.DataFrame(read_only, copy=False), inplace=True)
+
+
+def test_download_file_resumes(http_server, tmp_path):
+    url, handler = http_server
+    body = b"ModelID,TP53\n" + b"ACH-1,0.5\n" * 1000
+    handler.files["/crispr.csv"] = body
+    target = f"{tmp_path}/crispr.csv"
+    with open(f"{target}.part", "wb") as fh:
+        fh.write(body[:100])
+    download_file(f"{url}/crispr.csv", target, md5_hash=hashlib.md5(body).hexdigest())
+    with open(target, "rb") as fh:
+        assert fh.read() == body
+    assert handler.requests == [("/crispr.csv", "bytes=100-")]
+
+    with pytest.raises(IOError):
+        download_file(f"{url}/crispr.csv", f"{tmp_path}/bad.csv", md5_hash="0" * 32, n_retries=1)
+
+
+def test_fetch_release_files(http_server, tmp_path):
+    url, handler = http_server
+    handler.files["/a.csv"] = b"a\n1\n"
+    handler.files["/b.csv"] = b"b\n2\n"
+    handler.files["/files"] = (
+        f"release,filename,url\nR1,a.csv,{url}/a.csv\nR1,b.csv,{url}/b.csv\nR2,a.csv,{url}/a.csv\n".encode()
+    )
+    release_files = get_release_files(str(tmp_path), url=f"{url}/files")
+    assert get_release_files(str(tmp_path), url=f"{url}/files").equals(release_files)
+    assert [path for path, _ in handler.requests] == ["/files"]
+
+    paths = fetch_release_files(release_files, {"R1": ["a.csv", "b.csv"], "R2": ["a.csv"]}, str(tmp_path))
+    assert paths == [f"{tmp_path}/R1/a.csv", f"{tmp_path}/R1/b.csv", f"{tmp_path}/R2/a.csv"]
+    assert pd.read_csv(paths[1]).b.tolist() == [2]
+    n_requests = len(handler.requests)
+    fetch_release_files(release_files, {"R1": ["a.csv", "b.csv"]}, str(tmp_path))
+    assert len(handler.requests) == n_requests
+    with pytest.raises(KeyError):
+        fetch_release_files(release_files, {"R2": ["b.csv"]}, str(tmp_path))
+
+
+def test_fetch_release_files_expired_url(http_server, tmp_path):
+    url, handler = http_server
+    handler.files["/a.csv"] = b"a\n1\n"
+    handler.files["/files"] = f"release,filename,url\nR1,a.csv,{url}/expired/a.csv\n".encode()
+    release_files = get_release_files(str(tmp_path), url=f"{url}/files")
+    # the signed url in the cached index has expired since, the current index has a new one
+    handler.files["/files"] = f"release,filename,url\nR1,a.csv,{url}/a.csv\n".encode()
+    with pytest.raises(urllib.error.HTTPError):
+        fetch_release_files(release_files, {"R1": ["a.csv"]}, str(tmp_path))
+    # expired urls are not retried
+    assert [path for path, _ in handler.requests] == ["/files", "/expired/a.csv"]
+
+    (path,) = fetch_release_files(
+        release_files,
+        {"R1": ["a.csv"]},
+        str(tmp_path),
+        refresh_index=lambda: get_release_files(str(tmp_path), ttl=0, url=f"{url}/files"),
+    )
+    assert pd.read_csv(path).a.tolist() == [1]
+    assert [path for path, _ in handler.requests][2:] == ["/expired/a.csv", "/files", "/a.csv"]
+    assert get_release_files(str(tmp_path), url=f"{url}/files").url.tolist() == [f"{url}/a.csv"]
+
+
+def test_mutation_cache(tmp_path):
+    genes = [f"GENE{i:03d}" for i in range(50)]
+    mutation_data = pd.DataFrame(
+        {
+            "ModelID": [f"ACH-{i % 7}" for i in range(500)],
+            "HugoSymbol": [genes[(i * 13) % 50] for i in range(500)],
+            "VariantInfo": ["MISSENSE", "NONSENSE", np.nan, "SPLICE_SITE", "FRAME_SHIFT_DEL"] * 100,
+        }
+    )
+    path = f"{tmp_path}/DepMap Public 22Q4/OmicsSomaticMutations.parquet"
+    (tmp_path / "DepMap Public 22Q4").mkdir()
+    _cache_mutations(mutation_data, path, row_group_size=40)
+    assert pq.ParquetFile(path).metadata.num_row_groups == 13
+
+    # stored sorted by gene, loaded in the original order and with the original dtypes
+    assert pq.read_table(path).column("HugoSymbol").to_pandas().is_monotonic_increasing
+    pd.testing.assert_frame_equal(_load_cached_mutations(path), mutation_data)
+
+    tp = load_gene_mutations(["GENE007", "GENE042"], depmap_release="DepMap Public 22Q4", cache_base_dir=str(tmp_path))
+    expected = mutation_data.loc[mutation_data.HugoSymbol.isin(["GENE007", "GENE042"])]
+    pd.testing.assert_frame_equal(tp, expected.reset_index(drop=True))
+    assert len(load_gene_mutations("GENE001", "DepMap Public 22Q4", str(tmp_path))) == 10
+
+
+def test_get_depmap_data_mutation_cache(tmp_path):
+    release = tmp_path / "DepMap Public 22Q4"
+    release.mkdir()
+    models = [f"ACH-{i}" for i in range(5)]
+    genes = [f"GENE{i} ({i})" for i in range(4)]
+    for filename in [CRISPR_DEPENDENCY_EFFECT_FILENAME, CNV_FILENAME]:
+        pd.DataFrame(np.arange(20.0).reshape(5, 4), index=models, columns=genes).to_csv(release / filename)
+    pd.DataFrame(
+        {
+            "DepMap_ID": [models[i % 5] for i in range(12)],
+            "HugoSymbol": [f"GENE{(i * 3) % 4}" for i in range(12)],
+            "VariantInfo": ["MISSENSE", None, "NONSENSE"] * 4,
+        }
+    ).to_csv(release / MUTATION_FILENAME, index=False)
+
+    kwargs = dict(depmap_release="DepMap Public 22Q4", rnai_release="", cache_base_dir=str(tmp_path))
+    *_, from_csv = get_depmap_data(cache=False, **kwargs)
+    assert not (release / "OmicsSomaticMutations.parquet").exists()
+    *_, cached_on_write = get_depmap_data(cache=True, **kwargs)
+    *_, from_cache = get_depmap_data(cache=True, **kwargs)
+    assert (release / "OmicsSomaticMutations.parquet").exists()
+    # same rows, order and dtypes whether the mutations come from the csv or from the parquet cache
+    pd.testing.assert_frame_equal(cached_on_write, from_csv)
+    pd.testing.assert_frame_equal(from_cache, from_csv)
+    assert from_cache.HugoSymbol.unique().tolist() == from_csv.HugoSymbol.unique().tolist()
+
+
+def _mean_eval(gene_df, seed):
+    return float(gene_df.to_numpy().mean()), None
+
+
+def _monte_carlo_inputs(genes):
+    rng = np.random.default_rng(0)
+    models = [f"ACH-{i}" for i in range(40)]
+    dependency_data = pd.DataFrame(rng.normal(size=(len(genes), 40)), index=genes, columns=models)
+    cnv_data = pd.DataFrame(np.log2(rng.uniform(0.2, 3, size=(len(genes), 40)) / 2 + 1), index=genes, columns=models)
+    mutation_data = pd.DataFrame(
+        {"ModelID": np.resize(models[:10], 2 * len(genes)), "HugoSymbol": genes * 2, "VariantInfo": "MISSENSE"}
+    )
+    return dependency_data, cnv_data, mutation_data, models
+
+
+def test_compute_monte_carlo_stats_checkpoint(tmp_path):
+    genes = ["A1BG", "TP53", "KRAS", "MYC", "EGFR"]
+    dependency_data, cnv_data, mutation_data, models = _monte_carlo_inputs(genes)
+    kwargs = dict(
+        genes_of_interest=genes,
+        dependency_data=dependency_data,
+        cnv_data=cnv_data,
+        mutation_data=mutation_data,
+        candidate_models=models,
+        n_min_cell_lines=12,
+        n_iterations=3,
+        eval_kwargs={},
+        n_workers=1,
+        output_path=str(tmp_path),
+        checkpoint_every=1,
+    )
+    expected = compute_monte_carlo_stats(eval_function=_mean_eval, **{**kwargs, "output_path": None})
+    assert sorted(expected.index) == ["A1BG", "KRAS", "MYC", "TP53"]
+    first = compute_monte_carlo_stats(eval_function=_mean_eval, **kwargs)
+    pd.testing.assert_frame_equal(first.sort_index(), expected.sort_index())
+    (checkpoint_dir,) = [p for p in tmp_path.iterdir() if p.is_dir()]
+    n_parts = len(list(checkpoint_dir.glob("part-*.parquet")))
+    assert n_parts > 1
+
+    # restarting with the same parameters reuses everything
+    resumed = compute_monte_carlo_stats(eval_function=_mean_eval, **kwargs)
+    pd.testing.assert_frame_equal(resumed.loc[expected.index, expected.columns], expected)
+    assert len(list(checkpoint_dir.glob("part-*.parquet"))) == n_parts
+
+    # interrupted runs only recompute the missing genes, with the same seeds
+    for part in sorted(checkpoint_dir.glob("part-*.parquet"))[:2]:
+        part.unlink()
+    resumed = compute_monte_carlo_stats(eval_function=_mean_eval, **kwargs)
+    pd.testing.assert_frame_equal(resumed.loc[expected.index, expected.columns], expected)
+
+    # different parameters do not reuse the checkpoint
+    compute_monte_carlo_stats(eval_function=_mean_eval, **{**kwargs, "n_iterations": 2})
+    assert len([p for p in tmp_path.iterdir() if p.is_dir()]) == 2
+
+
+@pytest.mark.parametrize("dtype", [None, "float32"])
+def test_compute_monte_carlo_stats_copy_on_write(dtype):
+    genes = ["A1BG", "TP53", "KRAS", "MYC", "EGFR"]
+    dependency_data, cnv_data, mutation_data, models = _monte_carlo_inputs(genes)
+    original = dependency_data.copy()
+    kwargs = dict(
+        genes_of_interest=genes,
+        dependency_data=dependency_data,
+        cnv_data=cnv_data,
+        mutation_data=mutation_data,
+        candidate_models=models[:30],
+        n_min_cell_lines=5,
+        n_iterations=3,
+        eval_function=_mean_eval,
+        eval_kwargs={},
+        n_workers=1,
+        dtype=dtype,
+    )
+    expected = compute_monte_carlo_stats(**kwargs)
+    with pd.option_context("mode.copy_on_write", True):
+        result = compute_monte_carlo_stats(**kwargs)
+    pd.testing.assert_frame_equal(result, expected)
+    # the candidate models are centered on a copy
+    pd.testing.assert_frame_equal(dependency_data, original)
+
+
+def test_compute_monte_carlo_stats_shards(tmp_path):
+    genes = ["A1BG", "TP53", "KRAS", "MYC", "EGFR", "BRAF", "PTEN"]
+    dependency_data, cnv_data, mutation_data, models = _monte_carlo_inputs(genes)
+    kwargs = dict(
+        genes_of_interest=genes,
+        dependency_data=dependency_data,
+        cnv_data=cnv_data,
+        mutation_data=mutation_data,
+        candidate_models=models,
+        n_min_cell_lines=5,
+        n_iterations=3,
+        eval_function=_mean_eval,
+        eval_kwargs={},
+        n_workers=1,
+    )
+    unsharded = compute_monte_carlo_stats(**kwargs)
+    with pytest.raises(ValueError):
+        compute_monte_carlo_stats(shard_index=0, n_shards=2, **kwargs)
+
+    shard_results = [
+        compute_monte_carlo_stats(shard_index=i, n_shards=3, output_path=str(tmp_path / "three"), **kwargs)
+        for i in range(3)
+    ]
+    assert sorted(gene for res in shard_results for gene in res.index) == sorted(genes)
+    merged = merge_monte_carlo_shards(str(tmp_path / "three"))
+    compute_monte_carlo_stats(shard_index=0, n_shards=1, output_path=str(tmp_path / "one"), **kwargs)
+    pd.testing.assert_frame_equal(merge_monte_carlo_shards(str(tmp_path / "one")), merged, check_exact=True)
+    pd.testing.assert_frame_equal(unsharded.sort_index(), merged, check_exact=True)
+    # per-gene seeds do not depend on the genes processed together
+    single = compute_monte_carlo_stats(**{**kwargs, "genes_of_interest": ["KRAS"]})
+    assert single.loc["KRAS", "test_stats"] == merged.loc["KRAS", "test_stats"]
+
+
+def test_schedule_gene_batches():
+    costs = {"A": 1.0, "B": 50.0, "C": 2.0, "D": 30.0, "E": 1.0, "F": 16.0}
+    batches = _schedule_gene_batches(costs, n_batches=4)
+    # batches cost at most the mean cost of a gene
+    assert batches == [["B"], ["D"], ["F"], ["C", "A", "E"]]
+    assert sorted(gene for batch in batches for gene in batch) == sorted(costs)
+    assert _schedule_gene_batches({}, n_batches=4) == []
+    assert _schedule_gene_batches(costs, n_batches=4, max_genes=2) == [["B"], ["D"], ["F"], ["C", "A"], ["E"]]
+
+
+@pytest.mark.parametrize("n_batches", [1, 4, 1000])
+@pytest.mark.parametrize("max_genes", [None, 1, 10])
+def test_schedule_gene_batches_cap(n_batches, max_genes):
+    rng = np.random.default_rng(0)
+    # a few expensive genes and many cheap ones, e.g. without enough models
+    costs = dict(enumerate(np.concatenate([rng.integers(100, 5000, size=50), np.ones(400)]).tolist()))
+    batches = _schedule_gene_batches(costs, n_batches=n_batches, max_genes=max_genes)
+    assert sorted(gene for batch in batches for gene in batch) == sorted(costs)
+    max_cost = sum(costs.values()) / max(n_batches, len(costs))
+    for batch in batches:
+        assert max_genes is None or len(batch) <= max_genes
+        # only genes costing more than the cap on their own exceed it
+        assert len(batch) == 1 or sum(costs[gene] for gene in batch) <= max_cost
+
+
+def test_compute_stats_for_gene_early_stopping():
+    dependency_data, cnv_data, mutation_data, models = _monte_carlo_inputs(["A1BG", "TP53"])
+    kwargs = dict(
+        gene_of_interest="TP53",
+        dep_data=dependency_data,
+        cnv_data=cnv_data,
+        mutation_data=mutation_data,
+        candidate_models=models,
+        model_sample_rate=0.8,
+        search_mode="lof",
+        n_min_cell_lines=5,
+        n_iterations=40,
+        seed=7,
+        cnv_cutoffs=(1.5, 2.5),
+        eval_function=_mean_eval,
+        eval_kwargs={},
+        complete_lof=False,
+        filter_amp=False,
+        verbose=False,
+        fixed_cell_line_sampling=False,
+    )
+    full = _compute_stats_for_gene(**kwargs)
+    assert full["n_iterations"] == 40
+    early = _compute_stats_for_gene(target_ci_width=10.0, min_iterations=12, **kwargs)
+    assert early["n_iterations"] == 12
+    assert early["test_stats"] == full["test_stats"][:12]
+    assert early["wt_stats"] == full["wt_stats"][:12]
+    assert _compute_stats_for_gene(target_ci_width=1e-9, **kwargs)["n_iterations"] == 40
+
+
+def test_compute_stats_for_gene_verbose(capsys):
+    dependency_data, cnv_data, mutation_data, models = _monte_carlo_inputs(["A1BG", "TP53"])
+    kwargs = dict(
+        gene_of_interest="TP53",
+        dep_data=dependency_data,
+        cnv_data=cnv_data,
+        mutation_data=mutation_data,
+        candidate_models=models,
+        model_sample_rate=0.8,
+        search_mode="lof",
+        n_min_cell_lines=5,
+        n_iterations=3,
+        seed=7,
+        cnv_cutoffs=(1.5, 2.5),
+        eval_function=_mean_eval,
+        eval_kwargs={},
+        complete_lof=False,
+        filter_amp=False,
+        fixed_cell_line_sampling=False,
+    )
+    # the per-gene line is only printed on request, the "gene" instrumentation event carries the same data
+    _compute_stats_for_gene(verbose=False, **kwargs)
+    assert capsys.readouterr().out == ""
+    _compute_stats_for_gene(verbose=True, **kwargs)
+    assert capsys.readouterr().out.startswith("Stats for TP53 computed in")
+
+
+def test_is_settled_stop_on_sign_false_stops():
+    # no effect: stopping on the sign is a false stop, and must happen for at most 1 - confidence of the genes
+    # although the sign is checked after every iteration
+    rng = np.random.default_rng(0)
+    n_iterations, min_iterations = 100, 10
+    false_stops = 0
+    for diffs in rng.normal(size=(500, n_iterations)):
+        false_stops += any(
+            _is_settled(list(diffs[:n]), None, True, 0.95, n_iterations) for n in range(min_iterations, n_iterations)
+        )
+    assert false_stops / 500 <= 0.06
+    # a clear effect still stops early
+    diffs = list(rng.normal(loc=1.0, size=n_iterations))
+    assert _is_settled(diffs[:15], None, True, 0.95, n_iterations)
+
+
+def _sampled_rows_eval(gene_df, seed):
+    # mean over randomly sampled genes, like the sampled gene pairs of genome_proximity_bias_score
+    rows = np.random.default_rng(seed).integers(len(gene_df), size=3)
+    return float(gene_df.to_numpy()[rows].mean()), None
+
+
+def test_compute_stats_for_gene_paired():
+    genes = [f"GENE{i}" for i in range(30)]
+    dependency_data, cnv_data, mutation_data, models = _monte_carlo_inputs(genes)
+    # gene effects vary much more between genes than between models
+    dependency_data = dependency_data.add(np.arange(len(genes)) * 10.0, axis=0)
+    kwargs = dict(
+        gene_of_interest="GENE3",
+        dep_data=dependency_data,
+        cnv_data=cnv_data,
+        mutation_data=mutation_data,
+        candidate_models=models,
+        model_sample_rate=0.8,
+        search_mode="lof",
+        n_min_cell_lines=5,
+        n_iterations=30,
+        seed=7,
+        cnv_cutoffs=(1.5, 2.5),
+        eval_function=_sampled_rows_eval,
+        eval_kwargs={},
+        complete_lof=False,
+        filter_amp=False,
+        verbose=False,
+        fixed_cell_line_sampling=False,
+    )
+    independent = _compute_stats_for_gene(**kwargs)
+    paired = _compute_stats_for_gene(paired=True, **kwargs)
+    assert paired["wt_stats"] == independent["wt_stats"]
+    paired_diffs = np.subtract(paired["test_stats"], paired["wt_stats"])
+    independent_diffs = np.subtract(independent["test_stats"], independent["wt_stats"])
+    assert np.std(paired_diffs) < np.std(independent_diffs) / 10
+    early = _compute_stats_for_gene(paired=True, target_ci_width=1.0, **kwargs)
+    assert early["n_iterations"] < _compute_stats_for_gene(target_ci_width=1.0, **kwargs)["n_iterations"]
+
+
+def test_select_gene_columns_matches_split_models():
+    dependency_data, cnv_data, mutation_data, models = _monte_carlo_inputs(["A1BG", "TP53", "KRAS"])
+    rng = np.random.default_rng(1)
+    mutation_data = mutation_data.assign(
+        VariantInfo=rng.choice(np.array(list(COMPLETE_LOF_MUTATION_TYPES) + ["MISSENSE", None], dtype=object), 6)
+    )
+    cnv_data = cnv_data.iloc[:, 5:]
+    dep_columns = dependency_data.columns[2:]
+    candidate_models = models[:-3]
+    for gene, cutoffs, complete_lof, filter_amp, search_mode in itertools.product(
+        ["A1BG", "TP53", "KRAS"], [(0.5, 1.5), (0.8, 1.2)], [False, True], [False, True], ["lof", "amp"]
+    ):
+        lof, wt, amp, _ = split_models(
+            gene, candidate_models, cnv_data, mutation_data, cutoffs, complete_lof, filter_amp
+        )
+        wt_columns, test_columns = _select_gene_columns(
+            gene, dep_columns, cnv_data, mutation_data, candidate_models, search_mode, cutoffs, complete_lof, filter_amp
+        )
+        assert wt_columns.tolist() == np.flatnonzero(dep_columns.isin(list(wt))).tolist()
+        assert (
+            test_columns.tolist()
+            == np.flatnonzero(dep_columns.isin(list(lof if search_mode == "lof" else amp))).tolist()
+        )
+
+
+def test_sweep_monte_carlo_stats():
+    genes = ["A1BG", "TP53", "KRAS", "MYC", "EGFR"]
+    dependency_data, cnv_data, mutation_data, models = _monte_carlo_inputs(genes)
+    kwargs = dict(
+        genes_of_interest=genes,
+        dependency_data=dependency_data,
+        cnv_data=cnv_data,
+        mutation_data=mutation_data,
+        candidate_models=models,
+        n_min_cell_lines=5,
+        n_iterations=3,
+        eval_function=_mean_eval,
+        eval_kwargs={},
+        n_workers=1,
+    )
+    # the two loss cutoffs split all models the same way
+    grid = {"search_mode": ["lof", "amp"], "cnv_cutoffs": [(1.5, 2.5), (1.5 + 1e-9, 2.5)], "filter_amp": [False, True]}
+    events = []
+    with instrument(hook=events.append):
+        sweep = sweep_monte_carlo_stats(grid=grid, **kwargs)
+    (scheduling,) = [e for e in events if e["event"] == "stage" and e["stage"] == "scheduling"]
+    assert scheduling["n_settings"] == 8
+    assert scheduling["n_results"] == len(sweep)
+    # none of the amp models has a complete loss of function mutation, so only search mode and gene matter
+    assert scheduling["n_evaluations"] == len(sweep) / 4
+
+    for search_mode, cnv_cutoffs, filter_amp in itertools.product(*grid.values()):
+        expected = compute_monte_carlo_stats(
+            search_mode=search_mode, cnv_cutoffs=cnv_cutoffs, filter_amp=filter_amp, **kwargs
+        ).sort_index()
+        setting = sweep.loc[
+            (sweep.search_mode == search_mode)
+            & (sweep.cnv_cutoffs == cnv_cutoffs)
+            & (sweep.filter_amp == filter_amp)
+            & ~sweep.complete_lof
+        ].set_index("gene")
+        assert setting.index.tolist() == expected.index.tolist()
+        pd.testing.assert_frame_equal(setting[expected.columns], expected, check_names=False)
+
+    with pytest.raises(ValueError):
+        sweep_monte_carlo_stats(grid={"n_iterations": [1, 2]}, **kwargs)
+
+
+def test_compute_monte_carlo_stats_results_cache(tmp_path):
+    genes = ["A1BG", "TP53", "KRAS", "MYC", "EGFR", "BRAF"]
+    dependency_data, cnv_data, mutation_data, models = _monte_carlo_inputs(genes)
+    kwargs = dict(
+        genes_of_interest=genes,
+        mutation_data=mutation_data,
+        candidate_models=models,
+        n_min_cell_lines=5,
+        n_iterations=3,
+        center_genes=False,
+        eval_function=_mean_eval,
+        eval_kwargs={},
+        n_workers=1,
+        results_cache=str(tmp_path),
+    )
+
+    def _run(dependency_data, cnv_data):
+        events = []
+        with instrument(hook=events.append):
+            res = compute_monte_carlo_stats(dependency_data=dependency_data, cnv_data=cnv_data, **kwargs)
+        (cache,) = [event for event in events if event["event"] == "cache"]
+        computed = {event["gene"] for event in events if event["event"] == "gene" and not event["skipped"]}
+        return res.sort_index(), cache["hits"], cache["misses"], computed
+
+    first, hits, misses, computed = _run(dependency_data, cnv_data)
+    assert (hits, misses) == (0, len(first))
+    again, hits, misses, computed = _run(dependency_data, cnv_data)
+    assert (hits, misses, computed) == (len(first), 0, set())
+    pd.testing.assert_frame_equal(again, first)
+
+    # a new release changes the copy number of KRAS and the dependency data of one model
+    cnv_data.loc["KRAS"] = cnv_data.loc["TP53"]
+    dependency_data = dependency_data.copy()
+    dependency_data["ACH-30"] += 1
+    changed = {"KRAS"}
+    for gene in first.index:
+        wt_columns, test_columns = _select_gene_columns(
+            gene,
+            dependency_data.columns,
+            cnv_data,
+            mutation_data,
+            models,
+            "lof",
+            (CN_LOSS_CUTOFF, CN_GAIN_CUTOFF),
+            False,
+            False,
+        )
+        if "ACH-30" in dependency_data.columns[np.concatenate([wt_columns, test_columns])]:
+            changed.add(gene)
+    assert changed != set(first.index)
+    release, hits, misses, computed = _run(dependency_data, cnv_data)
+    assert computed == changed
+    assert (hits, misses) == (len(release) - len(changed), len(changed))
+    expected = compute_monte_carlo_stats(
+        dependency_data=dependency_data, cnv_data=cnv_data, **{**kwargs, "results_cache": None}
+    )
+    pd.testing.assert_frame_equal(release, expected.sort_index())
@@ -0,0 +1,48 @@
+import subprocess
+import sys
+from typing import Dict
+
+import pytest
+
+HEAVY_MODULES = [
+    "efaar_benchmarking",
+    "sklearn",
+    "statsmodels",
+    "scipy.stats",
+    "scanpy",
+    "infercnvpy",
+    "seaborn",
+    "wget",
+]
+
+
+def _import_times(module: str) -> Dict[str, int]:
+    """Cumulative import time in microseconds of every module loaded by a fresh interpreter importing `module`."""
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"], capture_output=True, text=True, check=True
+    )
+    times = {}
+    for line in proc.stderr.splitlines():
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:") :].split("|")
+        times[name.strip()] = int(cumulative)
+    return times
+
+
+@pytest.mark.parametrize(
+    "module",
+    [
+        "proxbias.metrics",
+        "proxbias.depmap.process",
+        "proxbias.depmap.load",
+        "proxbias.cnv_smoothing",
+        "proxbias.scPerturb_processing_plotting",
+    ],
+)
+def test_heavy_dependencies_are_imported_lazily(module):
+    times = _import_times(module)
+    assert module in times
+    heavy = sorted(name for name in times if any(name == m or name.startswith(f"{m}.") for m in HEAVY_MODULES))
+    slowest = sorted(times.items(), key=lambda x: -x[1])[:10]
+    assert not heavy, f"importing {module} loads {heavy}, slowest imports (us): {slowest}"
@@ -0,0 +1,23 @@
+import json
+
+from proxbias.utils import instrumentation
+
+
+def test_stage_events(tmp_path):
+    events = []
+    with instrumentation.stage("prep"):
+        pass
+    log_path = f"{tmp_path}/run.jsonl"
+    with instrumentation.instrument(hook=events.append, log_path=log_path):
+        assert instrumentation.is_enabled()
+        with instrumentation.stage("prep", function="f"):
+            pass
+        instrumentation.emit("gene", gene="TP53", duration=0.5)
+    assert not instrumentation.is_enabled()
+    instrumentation.emit("gene", gene="KRAS", duration=0.5)
+
+    assert [event["event"] for event in events] == ["stage", "gene"]
+    assert events[0]["stage"] == "prep" and events[0]["function"] == "f" and events[0]["duration"] >= 0
+    with open(log_path) as fh:
+        assert [json.loads(line) for line in fh] == events
+    assert instrumentation.peak_rss_mb() > 0
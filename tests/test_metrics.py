@@ -0,0 +1,424 @@
+import numpy as np
+import pandas as pd
+import pytest
+from numba.typed import List as NumbaList
+from scipy.stats import combine_pvalues, rankdata
+from sklearn.metrics.pairwise import cosine_similarity
+from statsmodels.stats.nonparametric import rank_compare_2indep
+
+import proxbias.metrics
+from proxbias.metrics import (
+    _arm_pair_genes,
+    _arm_rank_sums,
+    _arm_within_between,
+    _bootstrap_gene_weights,
+    _bootstrap_probs,
+    _condensed_cosine_ranks,
+    _condensed_row_sums,
+    _design_pair_indices,
+    _design_points,
+    _exact_prob_intra_greater,
+    _get_inter_samples,
+    _get_intra_samples,
+    _prep_data,
+    arm_mean_cosine_similarity,
+    arm_permutation_test,
+    bm_metrics,
+    exact_genome_proximity_bias_score,
+    genome_proximity_bias_score,
+    local_proximity_bias_track,
+    warm_up_samplers,
+)
+
+
+def test_exact_prob_intra_greater():
+    rng = np.random.default_rng(0)
+    arm_codes = rng.integers(0, 12, size=300)
+    embeddings = rng.normal(size=(300, 16)) + 0.3 * rng.normal(size=(12, 16))[arm_codes]
+
+    cossims = cosine_similarity(embeddings)
+    rows, cols = np.triu_indices(300, 1)
+    same_arm = arm_codes[rows] == arm_codes[cols]
+    expected = rank_compare_2indep(cossims[rows, cols][same_arm], cossims[rows, cols][~same_arm], use_t=False).prob1
+
+    prob, n_intra, n_inter = _exact_prob_intra_greater(embeddings, arm_codes, chunk_size=37)
+    assert n_intra == same_arm.sum()
+    assert n_inter == (~same_arm).sum()
+    np.testing.assert_allclose(prob, expected, rtol=1e-9)
+    assert prob > 0.5
+
+
+def test_samplers():
+    warm_up_samplers()
+    rng = np.random.default_rng(0)
+    gene_to_arm = np.sort(rng.integers(0, 5, size=50)).astype(np.int32)
+    genes_by_arm = NumbaList()
+    for arm in range(5):
+        genes_by_arm.append(np.flatnonzero(gene_to_arm == arm).astype(np.int32))
+    cossims = rng.normal(size=(50, 50)).astype(np.float32)
+    i_indices, j_indices = rng.integers(50, size=(2, 3, 40), dtype=np.int32)
+
+    intra = _get_intra_samples(cossims, i_indices, j_indices, gene_to_arm, genes_by_arm)
+    inter = _get_inter_samples(cossims, i_indices, j_indices, gene_to_arm, genes_by_arm)
+    assert intra.shape == inter.shape == (3, 40)
+    for (t, k), i in np.ndenumerate(i_indices):
+        arm_genes = genes_by_arm[gene_to_arm[i]]
+        partner = arm_genes[j_indices[t, k] % len(arm_genes)]
+        if partner == i:
+            partner = arm_genes[(j_indices[t, k] + 1) % len(arm_genes)]
+        assert intra[t, k] == cossims[i, partner]
+        other_genes = np.flatnonzero(gene_to_arm != gene_to_arm[i])
+        assert inter[t, k] == cossims[i, other_genes[j_indices[t, k] % len(other_genes)]]
+
+
+@pytest.mark.parametrize("sampling", ["stratified", "sobol"])
+def test_design_pair_indices(sampling):
+    rng = np.random.default_rng(0)
+    gene_to_arm = rng.integers(0, 6, size=90).astype(np.int32)
+    arm_sizes = np.bincount(gene_to_arm)
+    genes_by_arm = [np.flatnonzero(gene_to_arm == arm).astype(np.int32) for arm in range(6)]
+    points = _design_points(rng, sampling, 2000, 64)
+    assert points.shape == (2, 2000, 64)
+    assert points.min() >= 0 and points.max() < 1
+    for intra in (True, False):
+        anchors, partners = _design_pair_indices(points, gene_to_arm, genes_by_arm, intra=intra)
+        # each trial spreads its anchors over the arms in proportion to their size
+        for trial_anchors in anchors[:20]:
+            counts = np.bincount(gene_to_arm[trial_anchors], minlength=6)
+            assert np.all(np.abs(counts - 64 * arm_sizes / 90) < 2)
+        n_partners = arm_sizes[gene_to_arm[anchors]] if intra else 90 - arm_sizes[gene_to_arm[anchors]]
+        assert partners.min() >= 0 and np.all(partners < n_partners)
+        # while anchors and partners stay uniform, as with uniform sampling
+        np.testing.assert_allclose(np.bincount(anchors.ravel(), minlength=90) / anchors.size, 1 / 90, rtol=0.1)
+        np.testing.assert_allclose(np.mean((partners + 0.5) / n_partners), 0.5, atol=0.01)
+
+    # inter-arm pairs are also spread over the ordered pairs of arms in proportion to their probability
+    anchors, partners = _design_pair_indices(points, gene_to_arm, genes_by_arm, intra=False)
+    partner_arms = np.array(
+        [
+            gene_to_arm[np.flatnonzero(gene_to_arm != gene_to_arm[i])[j]]
+            for i, j in zip(anchors.ravel(), partners.ravel())
+        ]
+    ).reshape(anchors.shape)
+    expected = 64 * arm_sizes[:, np.newaxis] * arm_sizes / (90 * (90 - arm_sizes[:, np.newaxis]))
+    np.fill_diagonal(expected, 0)
+    for trial in range(20):
+        counts = np.zeros((6, 6))
+        np.add.at(counts, (gene_to_arm[anchors[trial]], partner_arms[trial]), 1)
+        assert np.all(np.abs(counts - expected) < 2)
+
+
+def _cossim_df(arm_sizes, seed=0):
+    rng = np.random.default_rng(seed)
+    arms = [f"arm{i}" for i in range(len(arm_sizes))]
+    labels = np.repeat(arms, arm_sizes)
+    embeddings = rng.normal(size=(len(labels), 8)) + 0.5 * np.repeat(rng.normal(size=(len(arms), 8)), arm_sizes, axis=0)
+    index = pd.MultiIndex.from_arrays([[f"g{i}" for i in range(len(labels))], labels], names=["gene", "chromosome_arm"])
+    return pd.DataFrame(cosine_similarity(embeddings), index=index, columns=index), arms
+
+
+@pytest.mark.parametrize("sample_frac", [1.0, 0.3])
+def test_bm_metrics_workers(sample_frac):
+    df, arms = _cossim_df([60, 40, 3, 50, 70])
+    np.random.seed(0)
+    bm_all, bm_per_arm = bm_metrics(df, arms, sample_frac=sample_frac)
+    np.random.seed(0)
+    bm_all_par, bm_per_arm_par = bm_metrics(df, arms, sample_frac=sample_frac, n_workers=4)
+    pd.testing.assert_frame_equal(bm_all, bm_all_par)
+    pd.testing.assert_frame_equal(bm_per_arm, bm_per_arm_par)
+    # the arm with 3 genes has too few within-arm pairs to be tested
+    assert bm_per_arm.index.tolist() == ["arm0", "arm1", "arm3", "arm4"]
+    assert bm_per_arm.loc["arm4", "n_between"] == 70 * 153
+    assert bm_all.loc["all", "n_within"] == 1770 + 780 + 3 + 1225 + 2415
+
+    rows, cols = np.triu_indices(60, 1)
+    expected = rank_compare_2indep(df.values[:60, :60][rows, cols], df.values[:60, 60:].ravel(), use_t=False)
+    assert bm_per_arm.loc["arm0", "prob"] == pytest.approx(expected.prob1)
+
+
+@pytest.mark.parametrize("n_genes", [9, 10])
+def test_arm_rank_sums(n_genes):
+    rng = np.random.default_rng(0)
+    embeddings = rng.normal(size=(n_genes, 3))
+    embeddings[2] = embeddings[1]  # tied similarities
+    ranks = _condensed_cosine_ranks(embeddings, chunk_size=4)
+    rows, cols = np.triu_indices(n_genes, 1)
+    sims = cosine_similarity(embeddings)[rows, cols].astype(np.float32)
+    np.testing.assert_allclose(ranks, (rankdata(sims) - (len(sims) + 1) / 2) / len(sims), atol=1e-7)
+
+    full = np.zeros((n_genes, n_genes))
+    full[rows, cols] = ranks
+    full += full.T
+    row_sums = _condensed_row_sums(ranks, n_genes)
+    np.testing.assert_allclose(row_sums, full.sum(axis=1), atol=1e-6)
+    labels = rng.integers(0, 3, size=(n_genes, 5)).astype(np.int16)
+    within, between = _arm_rank_sums(ranks, row_sums, labels, 3)
+    for p in range(5):
+        for arm in range(3):
+            in_arm = labels[:, p] == arm
+            assert within[p, arm] == pytest.approx(full[np.ix_(in_arm, in_arm)].sum() / 2, abs=1e-6)
+            assert between[p, arm] == pytest.approx(full[np.ix_(in_arm, ~in_arm)].sum(), abs=1e-6)
+
+
+def test_arm_permutation_test(monkeypatch):
+    rng = np.random.default_rng(0)
+    arm_sizes = [30, 25, 20, 35]
+    arms = np.repeat(["1p", "1q", "2p", "2q"], arm_sizes)
+    genes = [f"g{i}" for i in range(len(arms))]
+    embeddings = rng.normal(size=(len(arms), 6)) + 0.4 * np.repeat(rng.normal(size=(4, 6)), arm_sizes, axis=0)
+    # no proximity bias on 2q
+    embeddings[arms == "2q"] = rng.normal(size=(35, 6))
+    gene_df = pd.DataFrame(embeddings, index=genes)
+    gene_info = pd.DataFrame({"chrom_arm_name": arms}, index=genes)
+    monkeypatch.setattr(proxbias.metrics, "get_chromosome_info_as_dfs", lambda: (gene_info.copy(), None, None))
+
+    all_df, per_arm_df = arm_permutation_test(gene_df, n_permutations=199, seed=0, batch_size=64)
+    prob, n_within, n_between = exact_genome_proximity_bias_score(gene_df)
+    assert all_df.loc["all", "prob"] == pytest.approx(prob)
+    assert all_df.loc["all", "n_within"] == n_within
+    assert all_df.loc["all", "n_between"] == n_between
+    assert all_df.loc["all", "pval"] == 0.005
+    assert abs(all_df.loc["all", "null_mean"] - 0.5) < 2 * all_df.loc["all", "null_std"]
+    assert per_arm_df.index.tolist() == ["1p", "1q", "2p", "2q"]
+    assert (per_arm_df.loc[["1p", "1q", "2p"], "pval"] < 0.05).all()
+    assert per_arm_df.loc["2q", "pval"] > 0.05
+
+    # the same permutations whatever the batch size
+    all_df_batched, per_arm_df_batched = arm_permutation_test(gene_df, n_permutations=199, seed=0, batch_size=7)
+    pd.testing.assert_frame_equal(per_arm_df, per_arm_df_batched)
+
+
+def test_bootstrap_probs():
+    df, arms = _cossim_df([30, 20, 25])
+    labels = df.index.get_level_values("chromosome_arm")
+    arm_rows = [np.flatnonzero(labels == arm) for arm in arms]
+    rows, in_arm = arm_rows[0], labels == arms[0]
+    within, between = _arm_within_between(df.values, rows, in_arm, None)
+    first, second = _arm_pair_genes(rows, in_arm, np.arange(len(df)), None)
+    assert first.dtype == second.dtype == np.int32
+    pool = (np.concatenate([within, between]), first, second, np.arange(len(first)) < len(within))
+
+    # unit weights give the point estimate
+    expected = rank_compare_2indep(within, between, use_t=False).prob1
+    assert _bootstrap_probs(*pool, np.ones((1, len(df) + 1)))[0] == pytest.approx(expected)
+
+    # a replicate is the test on the pairs of distinct genes of the resampled genes
+    weights = _bootstrap_gene_weights(np.random.default_rng(0), arm_rows, len(df), 1)
+    assert np.all(weights.sum(axis=1) == len(df) + 1)
+    genes = np.repeat(np.arange(len(df)), weights[0, :-1].astype(int))
+    pairs = [(i, j) for i in range(len(genes)) for j in range(len(genes)) if genes[i] != genes[j]]
+    resampled_within = [
+        df.values[genes[i], genes[j]] for i, j in pairs if i < j and in_arm[genes[i]] & in_arm[genes[j]]
+    ]
+    resampled_between = [df.values[genes[i], genes[j]] for i, j in pairs if in_arm[genes[i]] & ~in_arm[genes[j]]]
+    expected = rank_compare_2indep(np.array(resampled_within), np.array(resampled_between), use_t=False).prob1
+    assert _bootstrap_probs(*pool, weights)[0] == pytest.approx(expected)
+
+
+@pytest.mark.parametrize("sample_frac", [1.0, 0.3])
+def test_bm_metrics_bootstrap(sample_frac):
+    df, arms = _cossim_df([60, 40, 3, 50, 70])
+    np.random.seed(0)
+    bm_all, bm_per_arm = bm_metrics(df, arms, sample_frac=sample_frac, n_bootstrap=200, seed=0)
+    assert (bm_per_arm.prob_ci_low < bm_per_arm.prob).all() and (bm_per_arm.prob < bm_per_arm.prob_ci_high).all()
+    assert bm_all.prob_ci_low["all"] < bm_all.prob["all"] < bm_all.prob_ci_high["all"]
+    # the bootstrap does not change the point estimates
+    np.random.seed(0)
+    bm_all_point, bm_per_arm_point = bm_metrics(df, arms, sample_frac=sample_frac)
+    pd.testing.assert_frame_equal(bm_per_arm.drop(columns=["prob_ci_low", "prob_ci_high"]), bm_per_arm_point)
+    pd.testing.assert_frame_equal(bm_all.drop(columns=["prob_ci_low", "prob_ci_high"]), bm_all_point)
+
+
+def test_arm_mean_cosine_similarity():
+    rng = np.random.default_rng(0)
+    arms = np.array(["2p", "1q", "1p", "Xp", "1q", "2p"])[rng.integers(0, 6, size=120)]
+    embeddings = rng.normal(size=(120, 5)) + np.array([[0, 0, 1, 0, 0]])
+    embeddings[3] = 0
+    index = pd.MultiIndex.from_arrays([[f"g{i}" for i in range(120)], arms], names=["gene", "chromosome_arm"])
+    df = pd.DataFrame(embeddings, index=index)
+    arms_ord = ["1p", "1q", "2p", "3p"]
+    all_df, per_arm_df, arm_cos_df = arm_mean_cosine_similarity(df, arms_ord)
+
+    cossims = cosine_similarity(embeddings)
+    assert arm_cos_df.index.tolist() == ["1p", "1q", "2p"]
+    within_sims, between_sims = [], []
+    for a in arm_cos_df.index:
+        in_a = arms == a
+        within = cossims[np.ix_(in_a, in_a)][np.triu_indices(in_a.sum(), 1)]
+        between = cossims[np.ix_(in_a, ~in_a)].ravel()
+        within_sims.append(within)
+        between_sims.append(between)
+        assert arm_cos_df.loc[a, a] == pytest.approx(within.mean())
+        assert per_arm_df.loc[a, "within"] == pytest.approx(within.mean())
+        assert per_arm_df.loc[a, "between"] == pytest.approx(between.mean())
+        assert per_arm_df.loc[a, "n_genes"] == in_a.sum()
+        for b in arm_cos_df.columns.drop(a):
+            assert arm_cos_df.loc[a, b] == pytest.approx(cossims[np.ix_(in_a, arms == b)].mean())
+    assert all_df.loc["all", "within"] == pytest.approx(np.concatenate(within_sims).mean())
+    assert all_df.loc["all", "between"] == pytest.approx(np.concatenate(between_sims).mean())
+    assert all_df.loc["all", "n_between"] == sum(map(len, between_sims))
+
+
+def test_local_proximity_bias_track(monkeypatch):
+    rng = np.random.default_rng(0)
+    # chr1p, chr1q and chr2p with 12, 9 and 3 genes, listed out of genomic order
+    chrom_arm_int = np.array([0] * 12 + [1] * 9 + [0] * 3)
+    gene_info = pd.DataFrame(
+        {
+            "chrom": ["chr1"] * 21 + ["chr2"] * 3,
+            "chrom_int": [1] * 21 + [2] * 3,
+            "chrom_arm_int": chrom_arm_int,
+            "chrom_arm_name": ["chr1p"] * 12 + ["chr1q"] * 9 + ["chr2p"] * 3,
+            "start": np.arange(24) * 100 + 10,
+            "end": np.arange(24) * 100 + 50,
+        },
+        index=pd.Index([f"g{i}" for i in range(24)], name="gene"),
+    ).sample(frac=1, random_state=0)
+    bands = pd.DataFrame(
+        {
+            "chrom": ["chr1", "chr1", "chr1", "chr2"],
+            "name": ["p2", "p1", "q1", "p1"],
+            "band_start": [0, 600, 1200, 0],
+            "band_end": [600, 1200, 2100, 300],
+        }
+    )
+    monkeypatch.setattr(proxbias.metrics, "get_chromosome_info_as_dfs", lambda: (gene_info, None, bands))
+    embeddings = rng.normal(size=(25, 4))
+    embeddings[5] = 0
+    gene_df = pd.DataFrame(embeddings, index=[f"g{i}" for i in range(25)]).sample(frac=1, random_state=1)
+
+    track_df, band_df = local_proximity_bias_track(gene_df, n_neighbors=4)
+    assert track_df.index.tolist() == [f"g{i}" for i in range(24)]
+    cossims = cosine_similarity(embeddings[:24])
+    arms = np.repeat([0, 1, 2], [12, 9, 3])
+    for i in range(24):
+        arm_genes = np.flatnonzero(arms == arms[i])
+        # the 4 nearest genes, 2 on each side where possible
+        start = np.clip(i - 2, arm_genes[0], max(arm_genes[-1] - 4, arm_genes[0]))
+        neighbors = [j for j in range(start, min(start + 5, arm_genes[-1] + 1)) if j != i]
+        assert track_df.n_neighbors.iloc[i] == len(neighbors)
+        assert track_df.local.iloc[i] == pytest.approx(cossims[i, neighbors].mean())
+        assert track_df.background.iloc[i] == pytest.approx(cossims[i, arms != arms[i]].mean())
+    np.testing.assert_allclose(track_df["diff"], track_df.local - track_df.background)
+    assert track_df.band.tolist() == ["p2"] * 6 + ["p1"] * 6 + ["q1"] * 9 + ["p1"] * 3
+    assert band_df[["chrom", "band"]].values.tolist() == [
+        ["chr1", "p2"],
+        ["chr1", "p1"],
+        ["chr1", "q1"],
+        ["chr2", "p1"],
+    ]
+    assert band_df.n_genes.tolist() == [6, 6, 9, 3]
+    assert band_df.local.iloc[2] == pytest.approx(track_df.local.iloc[12:21].mean())
+
+
+def _stub_gene_df(monkeypatch, arm_sizes, seed=0, signal=0.5):
+    """Embeddings with arm signal, and the chromosome info of their genes in place of the annotation data."""
+    rng = np.random.default_rng(seed)
+    arms = np.repeat([f"chr{i + 1}p" for i in range(len(arm_sizes))], arm_sizes)
+    genes = [f"g{i}" for i in range(len(arms))]
+    arm_signal = np.reshape(signal, (-1, 1)) * rng.normal(size=(len(arm_sizes), 6))
+    embeddings = rng.normal(size=(len(arms), 6)) + np.repeat(arm_signal, arm_sizes, 0)
+    gene_info = pd.DataFrame({"chrom_arm_name": arms}, index=genes)
+    monkeypatch.setattr(proxbias.metrics, "get_chromosome_info_as_dfs", lambda: (gene_info.copy(), None, None))
+    return pd.DataFrame(embeddings, index=genes)
+
+
+def test_genome_proximity_bias_score(monkeypatch):
+    gene_df = _stub_gene_df(monkeypatch, [30, 25, 40, 20])
+    prob, pvalue, intra, inter = genome_proximity_bias_score(gene_df, n_trials=30, n_samples=100, seed=0)
+    assert intra.shape == inter.shape == (30, 100)
+    assert genome_proximity_bias_score(gene_df, n_trials=30, n_samples=100, seed=0, return_samples=False) == (
+        prob,
+        pvalue,
+    )
+
+    # the pairs drawn as before the adaptive and design options: anchors and lookups uniform over all genes
+    cossims, gene_to_arm, genes_by_arm = _prep_data(gene_df, min_samples_in_arm=5)
+    gene_to_arm = gene_to_arm.to_numpy()
+    i_intra, j_intra, i_inter, j_inter = np.random.default_rng(0).integers(len(cossims), size=(4, 30, 100))
+    arm_genes = [genes_by_arm[arm] for arm in gene_to_arm[i_intra.ravel()]]
+    first = np.array([genes[j % len(genes)] for genes, j in zip(arm_genes, j_intra.ravel())])
+    second = np.array([genes[(j + 1) % len(genes)] for genes, j in zip(arm_genes, j_intra.ravel())])
+    expected_intra = cossims[i_intra.ravel(), np.where(first != i_intra.ravel(), first, second)].reshape(30, 100)
+    other_genes = [np.flatnonzero(gene_to_arm != arm) for arm in gene_to_arm[i_inter.ravel()]]
+    partners = [genes[j % len(genes)] for genes, j in zip(other_genes, j_inter.ravel())]
+    expected_inter = cossims[i_inter.ravel(), partners].reshape(30, 100)
+    np.testing.assert_array_equal(intra, expected_intra)
+    np.testing.assert_array_equal(inter, expected_inter)
+    results = [rank_compare_2indep(a, b, use_t=False) for a, b in zip(expected_intra, expected_inter)]
+    assert prob == pytest.approx(np.mean([r.prob1 for r in results]))
+    assert pvalue == pytest.approx(combine_pvalues([r.pvalue for r in results], method="fisher")[1])
+    assert prob > 0.5
+
+
+def test_genome_proximity_bias_score_target_se(monkeypatch):
+    gene_df = _stub_gene_df(monkeypatch, [30, 25, 40, 20])
+    # met after the first batch
+    prob, pvalue, intra, inter, n_trials_used = genome_proximity_bias_score(
+        gene_df, n_trials=100, n_samples=100, seed=0, target_se=0.05, batch_trials=10
+    )
+    assert n_trials_used == 10
+    assert intra.shape == inter.shape == (10, 100)
+    # the same trials as the first 10 of a fixed run
+    probs, _ = genome_proximity_bias_score(
+        gene_df, n_trials=10, n_samples=100, seed=0, return_samples=False, combined=False
+    )
+    assert prob == pytest.approx(np.mean(probs))
+
+    # never met, the last batch is cut to n_trials
+    prob, pvalue, n_trials_used = genome_proximity_bias_score(
+        gene_df, n_trials=25, n_samples=100, seed=0, return_samples=False, target_se=0.0, batch_trials=10
+    )
+    assert n_trials_used == 25
+    probs, pvalues, n_trials_used = genome_proximity_bias_score(
+        gene_df, n_trials=25, n_samples=100, seed=0, return_samples=False, combined=False, target_se=1e-6
+    )
+    assert n_trials_used == 25 and probs.shape == pvalues.shape == (25,)
+
+
+@pytest.mark.parametrize("sampling", ["stratified", "sobol"])
+def test_genome_proximity_bias_score_designs(monkeypatch, sampling):
+    gene_df = _stub_gene_df(monkeypatch, [30, 25, 40, 20])
+    prob, _, intra, inter = genome_proximity_bias_score(gene_df, n_trials=40, n_samples=128, seed=0, sampling=sampling)
+    assert intra.shape == inter.shape == (40, 128)
+    # every sample is a similarity of a pair of distinct genes on the same / on different arms
+    cossims, gene_to_arm, _ = _prep_data(gene_df, min_samples_in_arm=5)
+    same_arm = gene_to_arm.to_numpy()[:, np.newaxis] == gene_to_arm.to_numpy()
+    np.fill_diagonal(same_arm, False)
+    assert np.isin(intra, cossims[same_arm]).all()
+    assert np.isin(inter, cossims[gene_to_arm.to_numpy()[:, np.newaxis] != gene_to_arm.to_numpy()]).all()
+    exact, _, _ = exact_genome_proximity_bias_score(gene_df)
+    assert prob == pytest.approx(exact, abs=0.02)
+    with pytest.raises(ValueError, match="sampling"):
+        genome_proximity_bias_score(gene_df, sampling="halton")
+
+
+def test_genome_proximity_bias_score_designs_variance(monkeypatch):
+    # the proximity signal differs between arms, which is the variance the designs remove
+    gene_df = _stub_gene_df(monkeypatch, [60, 15, 40, 25, 80, 10, 30, 50], signal=[3, 0, 2, 0, 3, 0, 3, 0])
+    variances = {}
+    for sampling in ["uniform", "stratified", "sobol"]:
+        probs, _, _, _ = genome_proximity_bias_score(
+            gene_df, n_trials=300, n_samples=128, seed=0, combined=False, sampling=sampling
+        )
+        variances[sampling] = np.var(probs)
+    # about half the variance of uniform sampling here
+    assert variances["stratified"] < 0.75 * variances["uniform"]
+    assert variances["sobol"] < 0.75 * variances["uniform"]
+
+
+def test_genome_proximity_bias_score_filtered_arm(monkeypatch):
+    # chr2p has too few genes and is dropped, the arms after it must be renumbered to index the per-arm gene lists
+    gene_df = _stub_gene_df(monkeypatch, [30, 4, 25, 20])
+    cossims, gene_to_arm, genes_by_arm = _prep_data(gene_df, min_samples_in_arm=5)
+    assert len(cossims) == 75
+    assert sorted(gene_to_arm.unique()) == [0, 1, 2]
+    for arm, arm_genes in enumerate(genes_by_arm):
+        np.testing.assert_array_equal(arm_genes, np.flatnonzero(gene_to_arm.to_numpy() == arm))
+
+    _, _, intra, inter = genome_proximity_bias_score(gene_df, n_trials=20, n_samples=100, seed=0)
+    arm_codes = gene_to_arm.to_numpy()
+    same_arm = arm_codes[:, np.newaxis] == arm_codes
+    np.fill_diagonal(same_arm, False)
+    assert np.isin(intra, cossims[same_arm]).all()
+    assert np.isin(inter, cossims[arm_codes[:, np.newaxis] != arm_codes]).all()
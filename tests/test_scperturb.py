@@ -0,0 +1,89 @@
+import io
+
+import numpy as np
+import pandas as pd
+import pytest
+import scipy.sparse
+from scanpy import AnnData
+
+from proxbias.scPerturb_processing_plotting import (
+    _compute_chromosomal_loss,
+    _get_gene_block_positions,
+    _stack_loss_cells,
+)
+from proxbias.utils.instrumentation import instrument
+
+
+def _make_anndata():
+    var = pd.DataFrame(
+        {
+            "chromosome": ["chr1"] * 6 + ["chr2"] * 4 + [np.nan],
+            "arm": ["chr1p"] * 3 + ["chr1q"] * 3 + ["chr2p"] * 4 + [np.nan],
+            "start": [50, 10, 20, 30, 40, 60, 5, 1, 3, 2, 0],
+        },
+        index=[f"g{i}" for i in range(11)],
+    )
+    obs = pd.DataFrame(
+        {"gene": ["g0", "g0", "g0", "g7", "g7", "g10", "control", "control"]},
+        index=[f"c{i}" for i in range(8)],
+    )
+    adata = AnnData(scipy.sparse.csr_matrix((8, 11), dtype=np.float32), obs=obs, var=var)
+    cnv = np.zeros((8, 10))
+    # cells c0 and c1 lose the region around g0 (block 4), c3 loses the region around g7 (block 6)
+    cnv[[0, 1], 2:7] = -1
+    cnv[3, 6:9] = -1
+    adata.obsm["X_cnv"] = scipy.sparse.csr_matrix(cnv)
+    adata.uns["cnv"] = {"chr_pos": {"chr1": 0, "chr2": 6}}
+    return adata
+
+
+def test_get_gene_block_positions():
+    adata = _make_anndata()
+    gene_pos = _get_gene_block_positions(adata.var, pd.Index(["g7", "g0", "g10"]), adata.uns["cnv"]["chr_pos"], 1)
+    assert gene_pos.index.tolist() == ["g7", "g0"]
+    assert gene_pos.ordpos.tolist() == [0, 4]
+    assert gene_pos.block.tolist() == [6, 4]
+    assert gene_pos.chr_end_block.tolist() == [10, 6]
+
+
+def test_compute_chromosomal_loss():
+    adata = _make_anndata()
+    events = []
+    with instrument(hook=events.append):
+        loss = _compute_chromosomal_loss(adata, blocksize=1, neigh=3, frac_cutoff=0.7, cnv_cutoff=-0.5)
+    assert [event["stage"] for event in events] == ["prep", "loss", "aggregation"]
+    assert len(loss) == 2 * 3
+    assert set(loss.aff_gene) == {"g0", "g7"}
+    g0 = loss.loc[(loss.aff_gene == "g0") & (loss.ko_gene == "g0")].iloc[0]
+    assert g0.ko_arm == "chr1p"
+    assert g0.loss5p_cells == ["c0", "c1"]
+    assert g0.loss5p_cellfrac == 2 / 3
+    assert g0.loss3p_cellcount == 2
+    g7 = loss.loc[(loss.aff_gene == "g7") & (loss.ko_gene == "g7")].iloc[0]
+    assert g7.loss3p_cells == ["c3"]
+    assert g7.loss5p_cellcount == 1
+    assert loss.loc[(loss.aff_gene == "g7") & (loss.ko_gene == "g0"), "loss3p_cellcount"].iloc[0] == 0
+    assert loss.loc[loss.ko_gene == "g10", "ko_chr"].isna().all()
+
+
+def test_stack_loss_cells():
+    adata = _make_anndata()
+    buf = io.StringIO()
+    _compute_chromosomal_loss(adata, blocksize=1, neigh=3, frac_cutoff=0.7, cnv_cutoff=-0.5).to_csv(buf, index=False)
+    buf.seek(0)
+    res = pd.read_csv(buf)
+    perts2check_df = pd.DataFrame({"Perturbed gene": ["g0", "g7", "g7"], "Tested loss direction": ["5'", "5'", "3'"]})
+    loss_arr, loss_seps, blocknums = _stack_loss_cells(adata, res, perts2check_df, ["g0", "g7"], 1)
+    np.testing.assert_array_equal(loss_arr, adata.obsm["X_cnv"].toarray()[[0, 1, 3, 3]])
+    assert loss_seps == [2, 4]
+    assert blocknums == [4, 6]
+
+
+def test_stack_loss_cells_missing_cells():
+    adata = _make_anndata()
+    res = pd.DataFrame(
+        {"ko_gene": ["g0"], "aff_gene": ["g0"], "loss5p_cells": ["['c0', 'c9']"], "loss3p_cells": ["[]"]}
+    )
+    perts2check_df = pd.DataFrame({"Perturbed gene": ["g0"], "Tested loss direction": ["5'"]})
+    with pytest.raises(KeyError, match="c9"):
+        _stack_loss_cells(adata, res, perts2check_df, ["g0"], 1)